@@ -1,9 +1,10 @@
 from django.contrib import admin
 from django.contrib import messages
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.translation import ngettext
-from django.db.models import F, Value, CharField
+from django.db.models import Exists, F, OuterRef, Value, CharField
 from django.db.models.functions import Concat
 
 from datetime import datetime
@@ -13,6 +14,8 @@ from simple_history import register as register_history
 
 # Register your models here.
 from . import models
+from .slots import assign_missing_positions
+from profiles.admin import UserProfileListFilter
 
 admin.site.site_header = 'Arribere Lab NemaStocks Database'
 
@@ -23,8 +26,7 @@ register_history(models.OpenStrainEditing)
 class TubeAdmin(SimpleHistoryAdmin):
     @admin.action(description="Mark selected tubes as thawed")
     def thaw_tubes(self, request, queryset):
-        queryset.update(thawed=True)
-        updated = queryset.update(date_thawed=datetime.now())
+        updated = queryset.update(thawed=True, date_thawed=datetime.now())
         self.message_user(
             request,
             ngettext(
@@ -38,8 +40,9 @@ class TubeAdmin(SimpleHistoryAdmin):
 
     @admin.action(description="Mark selected tubes as unthawed")
     def unthaw_tubes(self, request, queryset):
-        queryset.update(thawed=False)
-        updated = queryset.update(date_thawed=None)
+        updated = queryset.update(thawed=False, date_thawed=None)
+        # Their old slots may have gone to other tubes since, so they get new ones (if their boxes have room):
+        assign_missing_positions(models.Box.objects.filter(pk__in=queryset.values('box_id')))
         self.message_user(
             request,
             ngettext(
@@ -59,7 +62,8 @@ class TubeAdmin(SimpleHistoryAdmin):
     @admin.display(ordering='box__dewar', description='Box')
     def box_link(self, obj):
         url = reverse("admin:ArribereNemaStocks_box_change", args=[obj.box.pk])
-        return format_html('<a href="{}">{}</a>', url, obj.box)
+        # Box.__str__ would check whether it's a default box with a query per row, see get_queryset:
+        return format_html('<a href="{}">{}</a>', url, obj.box.usage_repr(is_default=obj.box_is_default))
     
     @admin.display(ordering='freeze_group', description='Freeze Group')
     def freeze_group_link(self, obj):
@@ -68,7 +72,8 @@ class TubeAdmin(SimpleHistoryAdmin):
     
     list_display = ('id', 'strain_link', 'cap_color', 'date_created', 'date_thawed',
                     'box_link', 'freeze_group_link', 'thawed', 'thaw_requester')
-    list_filter = ('date_created', 'date_thawed', 'thawed', 'thaw_requester', 'cap_color')
+    list_select_related = ('strain', 'box', 'freeze_group__strain', 'thaw_requester__user')
+    list_filter = ('date_created', 'date_thawed', 'thawed', ('thaw_requester', UserProfileListFilter), 'cap_color')
     search_fields = ('date_created', 'date_thawed', 'strain__wja',
                      'thawed', 'thaw_requester__initials', 'cap_color',
                      'box__dewar', 'box__rack', 'box__box',
@@ -82,6 +87,10 @@ class TubeAdmin(SimpleHistoryAdmin):
 
     autocomplete_fields = ['strain', 'box', 'freeze_group']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            box_is_default=Exists(models.DefaultBox.objects.filter(box=OuterRef('box'))))
+
 
 class TubeInline(admin.TabularInline):
     model = models.Tube
@@ -97,9 +106,9 @@ class BoxAdmin(SimpleHistoryAdmin):
     
     inlines = [TubeInline,]
     
+    @admin.display(ordering='active_tube_counter', description='Active Tubes')
     def active_tubes(self, obj):
-        return obj.get_active_tubes().count()
-    active_tubes.short_description = 'Active Tubes'
+        return obj.active_tubes_count()
 
 
 @admin.register(models.DefaultBox)
@@ -151,9 +160,10 @@ class FreezeGroupAdmin(SimpleHistoryAdmin):
     list_display = ('id', 'strain_link', 'freezer',
                     'started_test', 'completed_test', 'passed_test', 'stored',
                     'tester', 'tester_comments')
-    list_filter = ('freezer',
+    list_select_related = ('strain', 'freezer__user', 'tester__user')
+    list_filter = (('freezer', UserProfileListFilter),
                    'started_test', 'completed_test', 'passed_test',
-                   'stored', 'tester')
+                   'stored', ('tester', UserProfileListFilter))
     search_fields = ('strain__wja',
                      'tester_comments', 'tester')
     actions = [mark_test_started, unmark_test_started,
@@ -210,8 +220,9 @@ class ThawRequestAdmin(SimpleHistoryAdmin):
 
     list_display = ('id', 'strain', 'date_created', 'requester',
                     'is_urgent', 'status', 'thawed_by', 'request_comments')
+    list_select_related = ('strain', 'requester__user', 'thawed_by__user')
     list_filter = ('date_created', 'date_completed',
-                   'status', 'requester', 'thawed_by')
+                   'status', ('requester', UserProfileListFilter), ('thawed_by', UserProfileListFilter))
     search_fields = ('date_completed', 'status', 'thawed_by', 'strain__wja',
                      )
     actions = [mark_completed, unmark_completed]
@@ -222,7 +233,8 @@ class ThawRequestAdmin(SimpleHistoryAdmin):
 class FreezeRequestAdmin(SimpleHistoryAdmin):
     list_display = ('id', 'strain', 'date_created', 'requester',
                     'number_of_tubes', 'cap_color', 'status')
-    list_filter = ('date_created', 'status', 'requester', 'cap_color')
+    list_select_related = ('strain', 'requester__user')
+    list_filter = ('date_created', 'status', ('requester', UserProfileListFilter), 'cap_color')
     search_fields = ('date_created', 'status', 'requester', 'strain__wja',
                      'cap_color', 'number_of_tubes')
     
@@ -244,12 +256,32 @@ class StrainAdmin(SimpleHistoryAdmin):
             readonly_fields += ('wja', 'formatted_wja',)
         return readonly_fields
 
+    @admin.display(ordering='active_tube_counter', description='Active Tubes')
     def active_tubes_count(self, obj):
         return obj.active_tubes_count()
 
-    active_tubes_count.short_description = 'Active Tubes'
-
+    @admin.display(description='Thawed Tubes')
     def inactive_tubes_count(self, obj):
         return obj.inactive_tubes_count()
 
-    inactive_tubes_count.short_description = 'Thawed Tubes'
+
+@admin.register(models.OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    @admin.action(description="Retry sending selected emails")
+    def retry_emails(self, request, queryset):
+        updated = queryset.exclude(status='S').update(status='P', attempts=0, next_attempt=timezone.now())
+        self.message_user(
+            request,
+            ngettext(
+                "%d email was queued to be retried.",
+                "%d emails were queued to be retried.",
+                updated,
+            )
+            % updated,
+            messages.SUCCESS,
+        )
+
+    list_display = ('id', 'subject', 'to', 'status', 'attempts', 'date_created', 'date_sent', 'last_error')
+    list_filter = ('status', 'date_created')
+    search_fields = ('subject', 'to', 'cc')
+    actions = [retry_emails]
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def reinstall_strain_search_index(sender, using, **kwargs):
+    # SQLite table rebuilds during later migrations drop the FTS triggers, so put them back every time.
+    from django.db import connections
+    from . import search as strain_search
+    strain_search.install_strain_search_index(connections[using])
 
 
 class ArriberenemastocksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ArribereNemaStocks'
+
+    def ready(self):
+        import ArribereNemaStocks.signals
+        post_migrate.connect(reinstall_strain_search_index, sender=self)
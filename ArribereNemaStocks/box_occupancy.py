@@ -0,0 +1,67 @@
+"""
+A snapshot of how full every box is, shared by all the forms on a page.
+
+The ongoing freezes page shows two box dropdowns (and the default box for each dewar) for every
+freeze request, which used to mean re-querying all the boxes (and checking each one for being a
+DefaultBox) once per form. BoxOccupancySnapshot loads the boxes and the default boxes once, and the
+forms build their choices from it. It can go stale during the request, so anything that actually
+puts tubes into a box has to reserve the space with reserve_box_slots() first.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import F
+
+from .models import Box, DefaultBox
+
+
+class BoxFullError(ValidationError):
+    pass
+
+
+def reserve_box_slots(tubes_by_box: Dict[int, int]):
+    """
+    Claims space for new tubes ({box pk: number of tubes}) before they're created, by bumping each
+    box's active tube counter, but only if the box still has room. The check and the bump are a single
+    UPDATE, so two people freezing into the same box at once can't both take its last slots. Call this
+    inside the transaction that creates the tubes (ideally an immediate_atomic() one), which then sets
+    the counters to the real counts anyway (see recount_tube_parents).
+    Raises BoxFullError (and reserves nothing, once the transaction rolls back) if a box doesn't have room.
+    """
+    for box_pk, number_of_tubes in sorted(tubes_by_box.items()):  # Same order every time, to avoid deadlocks
+        reserved = Box.objects.filter(
+            pk=box_pk, active_tube_counter__lte=F('capacity') - number_of_tubes,
+        ).update(active_tube_counter=F('active_tube_counter') + number_of_tubes,
+                 total_tube_counter=F('total_tube_counter') + number_of_tubes)
+        if not reserved:
+            box = Box.objects.get(pk=box_pk)
+            raise BoxFullError(f'{box.short_pos_repr()} only has room for '
+                               f'{box.free_slots_count()} more tubes, not {number_of_tubes}.')
+
+
+class BoxOccupancySnapshot:
+    def __init__(self):
+        self.boxes: List[Box] = list(Box.objects.order_by('pk'))
+        self.active_counts: Dict[int, int] = {box.pk: box.active_tube_counter for box in self.boxes}
+        self.default_boxes: Dict[int, DefaultBox] = {
+            default_box.box.dewar: default_box for default_box in DefaultBox.objects.select_related('box')
+        }
+        self.default_box_pks = {default_box.box_id for default_box in self.default_boxes.values()}
+
+    def default_box_for_dewar(self, dewar: int) -> Optional[DefaultBox]:
+        """
+        Same as DefaultBox.get_default_box_for_dewar, without the query.
+        """
+        return self.default_boxes.get(dewar)
+
+    def active_tubes_count(self, box: Box) -> int:
+        return self.active_counts.get(box.pk, box.active_tube_counter)
+
+    def box_choices(self, dewar: int, wiggle_room: int = 0) -> List[Tuple[int, str]]:
+        """
+        (pk, label) choices for the boxes in this dewar with more than wiggle_room free slots,
+        labelled the same way as str(box).
+        """
+        return [(box.pk, box.usage_repr(is_default=box.pk in self.default_box_pks))
+                for box in self.boxes
+                if box.dewar == dewar and self.active_counts[box.pk] < box.capacity - wiggle_room]
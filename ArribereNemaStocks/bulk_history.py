@@ -0,0 +1,184 @@
+"""
+Writing the simple_history and auditlog rows for changes that were made in bulk.
+
+bulk_create, bulk_update, QuerySet.update and raw deletes don't send the signals that simple_history
+and auditlog normally record changes with, so the helpers here write those rows themselves (one
+bulk_create per table) for whatever they change. That way creating, advancing or cancelling hundreds
+of things still only takes a handful of queries, and the history pages look the same as if each object
+had been saved one at a time.
+"""
+import copy
+from typing import Iterable, List, Optional
+
+from auditlog.cid import get_cid
+from auditlog.context import auditlog_disabled, auditlog_value
+from auditlog.diff import model_instance_diff
+from auditlog.models import LogEntry
+from auditlog.registry import auditlog
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models import Q, QuerySet, prefetch_related_objects
+from django.utils import timezone
+from django.utils.encoding import smart_str
+from simple_history.utils import bulk_create_with_history
+
+
+def _actor_or_none(actor):
+    return actor if isinstance(actor, get_user_model()) else None  # e.g. AnonymousUser
+
+
+def log_bulk_changes(objs: List, action: int, actor=None, old_objs: Optional[List] = None):
+    """
+    Writes the auditlog LogEntry rows that saving (or deleting) each of these objects one at a time
+    would have, using a single bulk_create. The actor has to be passed in (it's the request's user).
+    :param action: A LogEntry.Action
+    :param old_objs: For updates, copies of the objects from before the change (in the same order)
+    """
+    if not objs or auditlog_disabled.get() or not auditlog.contains(type(objs[0])):
+        return
+    content_type = ContentType.objects.get_for_model(objs[0])
+    try:
+        remote_addr = auditlog_value.get()['remote_addr']
+    except LookupError:
+        remote_addr = None
+    cid = get_cid()
+    actor = _actor_or_none(actor)
+    # The diffs look at reverse one-to-ones too (like a freeze request's freeze group), one query each otherwise:
+    reverse_one_to_ones = [field.get_accessor_name() for field in objs[0]._meta.get_fields()
+                           if field.one_to_one and field.auto_created and not field.concrete]
+    if reverse_one_to_ones:
+        prefetch_related_objects(objs, *reverse_one_to_ones)
+    if action == LogEntry.Action.CREATE:
+        diffs = [model_instance_diff(None, obj) for obj in objs]
+    elif action == LogEntry.Action.DELETE:
+        diffs = [model_instance_diff(obj, None) for obj in objs]
+    else:
+        diffs = [model_instance_diff(old_obj, obj) for old_obj, obj in zip(old_objs, objs)]
+    entries = [dict(content_type=content_type,
+                    object_pk=smart_str(obj.pk),
+                    object_id=obj.pk,
+                    object_repr=smart_str(obj),
+                    action=action,
+                    changes=changes,
+                    actor=actor,
+                    remote_addr=remote_addr,
+                    cid=cid)
+               for obj, changes in zip(objs, diffs)
+               if changes or action != LogEntry.Action.UPDATE]  # auditlog skips updates that didn't change anything
+    if auditlog.get_serialize_options(type(objs[0]))['serialize_data']:
+        # Only auditlog itself knows how to serialize the objects' data, so these go through its log_create:
+        objs_by_pk = {smart_str(obj.pk): obj for obj in objs}
+        for entry in entries:
+            LogEntry.objects.log_create(objs_by_pk[entry['object_pk']], force_log=True, **entry)
+        return
+    LogEntry.objects.bulk_create([LogEntry(**entry) for entry in entries])
+
+def log_bulk_create(objs: List, actor=None):
+    log_bulk_changes(objs, LogEntry.Action.CREATE, actor)
+
+
+def bulk_history_create(objs: List, history_type: str, actor=None):
+    """
+    Writes one simple_history row per object, like simple_history's own bulk_history_create() but
+    also for deletes ('-'), which that one can't do.
+    """
+    if not objs:
+        return
+    history_model = type(objs[0]).simp_history.model
+    history_date = timezone.now()
+    actor = _actor_or_none(actor)
+    history_model.objects.bulk_create([
+        history_model(history_date=history_date,
+                      history_user=actor,
+                      history_type=history_type,
+                      **{field.attname: getattr(obj, field.attname) for field in history_model.tracked_fields})
+        for obj in objs
+    ])
+
+
+def bulk_create_with_audit(objs: List, actor=None, batch_size=None) -> List:
+    """
+    Like simple_history's bulk_create_with_history, but also writes the auditlog entries.
+    """
+    if not objs:
+        return []
+    actor = _actor_or_none(actor)
+    objs = bulk_create_with_history(objs, type(objs[0]), batch_size=batch_size, default_user=actor)
+    log_bulk_create(objs, actor)
+    return objs
+
+
+def bulk_update_with_audit(queryset: QuerySet, actor=None, **changes) -> List:
+    """
+    queryset.update(**changes) (a single UPDATE), plus the history and auditlog rows for every object it
+    changed. Only takes plain values, not F() expressions, since the objects are updated in memory too.
+    :return: The updated objects
+    """
+    objs = list(queryset)
+    if not objs:
+        return []
+    old_objs = [copy.copy(obj) for obj in objs]
+    type(objs[0]).objects.filter(pk__in=[obj.pk for obj in objs]).update(**changes)
+    for obj in objs:
+        for field_name, value in changes.items():
+            setattr(obj, field_name, value)
+    bulk_history_create(objs, '~', actor)
+    log_bulk_changes(objs, LogEntry.Action.UPDATE, actor, old_objs=old_objs)
+    return objs
+
+
+def bulk_save_with_audit(objs: List, fields: Iterable[str], old_objs: List, actor=None, batch_size=500):
+    """
+    bulk_update() for objects that were each changed differently (one UPDATE per batch), plus their
+    history and auditlog rows. old_objs are copies of the objects from before they were changed.
+    """
+    if not objs:
+        return
+    type(objs[0]).objects.bulk_update(objs, list(fields), batch_size=batch_size)
+    bulk_history_create(objs, '~', actor)
+    log_bulk_changes(objs, LogEntry.Action.UPDATE, actor, old_objs=old_objs)
+
+
+def _pks_with_related_objects(model, pks: List) -> set:
+    """
+    The pks (out of these) of the rows that something else points at, e.g. a freeze request with
+    a freeze group. Relations that Django leaves alone on delete (like the history tables) don't count.
+    """
+    q_filter = Q()
+    for relation in model._meta.related_objects:
+        if relation.on_delete is not models.DO_NOTHING:
+            q_filter |= Q(**{f'{relation.name}__isnull': False})
+    if not q_filter:
+        return set()
+    return set(model.objects.filter(q_filter, pk__in=pks).values_list('pk', flat=True))
+
+
+def bulk_delete_with_audit(queryset: QuerySet, actor=None, **last_changes) -> List:
+    """
+    Deletes everything in the queryset with a single DELETE, plus the history and auditlog rows.
+    The raw DELETE skips Django's delete collector (and so the signals and on_delete handling), so any
+    rows that something else points at are deleted one at a time the normal way instead.
+    :param last_changes: Field values to record in the deletion's history rows (e.g. status='X')
+    :return: The deleted objects (they keep their pks, for messages etc.)
+    """
+    objs = list(queryset)
+    if not objs:
+        return []
+    model = type(objs[0])
+    for obj in objs:
+        for field_name, value in last_changes.items():
+            setattr(obj, field_name, value)
+    pks_with_related_objects = _pks_with_related_objects(model, [obj.pk for obj in objs])
+    raw_objs = [obj for obj in objs if obj.pk not in pks_with_related_objects]
+    for obj in objs:
+        if obj.pk in pks_with_related_objects:
+            pk = obj.pk
+            obj.delete()  # The signals write this one's history and auditlog rows
+            obj.pk = pk
+    if raw_objs:
+        bulk_history_create(raw_objs, '-', actor)
+        log_bulk_changes(raw_objs, LogEntry.Action.DELETE, actor)
+        deleting = model.objects.filter(pk__in=[obj.pk for obj in raw_objs])
+        deleting._raw_delete(deleting.db)
+    return objs
@@ -0,0 +1,9 @@
+from .site_settings import get_site_settings
+
+
+def site_settings(request):
+    """
+    Makes {{ site_settings.registration_is_open }}, {{ site_settings.edit_ability }} etc.
+    available to every template (normally without any queries, see site_settings.py).
+    """
+    return {'site_settings': get_site_settings()}
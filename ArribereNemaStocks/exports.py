@@ -0,0 +1,111 @@
+"""
+CSV/TSV exports of the strains, tubes, and freeze/thaw request history.
+
+The rows come straight out of values_list() querysets with .iterator(), a chunk at a time, and each
+row is written out as soon as it's read (see export_response), so exporting the whole database takes
+as little memory as exporting a handful of strains. Everything is limited to the strains passed in,
+which the view gets with the same search/filters as the strain list page.
+"""
+import csv
+from typing import Callable, Dict, Iterable, Iterator, Sequence, Tuple
+
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Box, FreezeRequest, ThawRequest, Tube
+from hardcoded import EXPORT_CHUNK_SIZE
+
+
+class _EchoBuffer:
+    """
+    A "file" for csv.writer that just hands back what is written to it, so each row can be streamed.
+    """
+    def write(self, value):
+        return value
+
+
+def csv_lines(header: Sequence[str], rows: Iterable[Sequence], delimiter: str = ',') -> Iterator[str]:
+    writer = csv.writer(_EchoBuffer(), delimiter=delimiter)
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _limit_to_strains(queryset: QuerySet, strains: QuerySet) -> QuerySet:
+    if not strains.query.has_filters():
+        return queryset  # Every strain, no need for the subquery
+    return queryset.filter(strain__in=strains.order_by().values('pk'))
+
+
+def strain_rows(strains: QuerySet) -> Iterator[Sequence]:
+    if not strains.ordered:
+        strains = strains.order_by('wja')
+    # The tube counters are kept up to date whenever tubes change, so these are the live counts:
+    return strains.values_list(
+        'formatted_wja', 'genotype', 'phenotype', 'description', 'source', 'date_created',
+        'active_tube_counter', 'total_tube_counter', 'additional_comments',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def tube_rows(strains: QuerySet) -> Iterator[Sequence]:
+    tubes = _limit_to_strains(Tube.objects.all(), strains).order_by('strain__wja', 'pk').values_list(
+        'pk', 'strain__formatted_wja', 'box__dewar', 'box__rack', 'box__box', 'position', 'box__capacity',
+        'cap_color', 'date_created', 'freeze_group_id', 'thawed', 'date_thawed', 'thaw_requester__initials',
+    )
+    for (pk, wja, dewar, rack, box, position, capacity,
+         cap_color, date_created, freeze_group_id, thawed, date_thawed, thaw_requester) in tubes.iterator(
+            chunk_size=EXPORT_CHUNK_SIZE):
+        location = f'JA{dewar:0>2}-R{rack:0>2}-B{box:0>2}' if dewar is not None else ''
+        grid_position = Box.grid_label(position, capacity) if position and capacity else ''
+        yield (pk, wja, location, grid_position, cap_color, date_created, freeze_group_id,
+               thawed, date_thawed, thaw_requester)
+
+
+def freeze_request_rows(strains: QuerySet) -> Iterator[Sequence]:
+    statuses = dict(FreezeRequest.STATUS_CHOICES)
+    freeze_requests = _limit_to_strains(FreezeRequest.objects.all(), strains).order_by('pk').values_list(
+        'pk', 'date_created', 'strain__formatted_wja', 'requester__initials', 'status', 'number_of_tubes',
+        'cap_color', 'date_advanced', 'freezer__initials', 'tester__initials', 'freeze_group__passed_test',
+        'request_comments', 'tester_comments',
+    )
+    for row in freeze_requests.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield row[:4] + (statuses.get(row[4], row[4]),) + row[5:]
+
+
+def thaw_request_rows(strains: QuerySet) -> Iterator[Sequence]:
+    statuses = dict(ThawRequest.STATUS_OPTIONS)
+    thaw_requests = _limit_to_strains(ThawRequest.objects.all(), strains).order_by('pk').values_list(
+        'pk', 'date_created', 'strain__formatted_wja', 'requester__initials', 'status', 'is_urgent',
+        'tube_id', 'date_completed', 'thawed_by__initials', 'request_comments',
+    )
+    for row in thaw_requests.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield row[:4] + (statuses.get(row[4], row[4]),) + row[5:]
+
+
+# {kind (as in the URL): (header, function giving the rows for a queryset of strains)}
+EXPORTS: Dict[str, Tuple[Sequence[str], Callable[[QuerySet], Iterable[Sequence]]]] = {
+    'strains': (('WJA', 'Genotype', 'Phenotype', 'Description', 'Source', 'Date Created',
+                 'Active Tubes', 'Total Tubes', 'Additional Comments'), strain_rows),
+    'tubes': (('Tube ID', 'WJA', 'Box', 'Position', 'Cap Color', 'Date Created', 'Freeze Group ID',
+               'Thawed', 'Date Thawed', 'Thaw Requester'), tube_rows),
+    'freeze_requests': (('Request ID', 'Date Created', 'WJA', 'Requester', 'Status', 'Number of Tubes',
+                         'Cap Color', 'Date Advanced', 'Freezer', 'Tester', 'Passed Test',
+                         'Request Comments', 'Tester Comments'), freeze_request_rows),
+    'thaw_requests': (('Request ID', 'Date Created', 'WJA', 'Requester', 'Status', 'Is Urgent',
+                       'Tube ID', 'Date Completed', 'Thawed By', 'Request Comments'), thaw_request_rows),
+}
+
+
+def export_response(kind: str, strains: QuerySet, file_format: str = 'csv') -> StreamingHttpResponse:
+    """
+    Streams one of the EXPORTS as a CSV (or TSV if file_format is 'tsv') download.
+    Raises KeyError for unknown kinds.
+    """
+    header, get_rows = EXPORTS[kind]
+    delimiter, content_type = ('\t', 'text/tab-separated-values') if file_format == 'tsv' else (',', 'text/csv')
+    response = StreamingHttpResponse(csv_lines(header, get_rows(strains), delimiter=delimiter),
+                                     content_type=content_type)
+    filename = f'nemastocks_{kind}_{timezone.now().date():%Y%m%d}.{"tsv" if file_format == "tsv" else "csv"}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -1,17 +1,25 @@
 import datetime
+from collections import Counter
+from typing import Iterable, List, Optional
 
 from django import forms
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import F, OuterRef, Subquery
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.contrib import messages
 
 import ArribereNemaStocks.models as nema_models
 import profiles.models as profile_models
-from hardcoded import CAP_COLOR_OPTIONS, TUBE_REMAINING_THRESHOLD, EMAIL_ALL_CZARS
+from profiles.range_index import get_strain_range_index
+from .outbox import queue_email
+from .box_occupancy import BoxOccupancySnapshot
+from .freeze_completion import create_freeze_group
+from .thaw_reservations import available_tubes, RESERVING_STATUSES
+from .transactions import immediate_atomic
+from hardcoded import CAP_COLOR_OPTIONS, TUBE_REMAINING_THRESHOLD, EMAIL_ALL_CZARS, TUBES_PER_BOX
 
-from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.conf import settings
 
@@ -42,7 +50,45 @@ class StrainForm(forms.ModelForm):
         return wja
 
 
+class StrainBatchValidator:
+    """
+    Checks the WJAs of a whole batch of new strains (like a bulk upload) together, instead of each
+    form looking its own up: one wja__in query for the ones that are taken, duplicates within the
+    batch itself, and whose strain range each one is in (from the in-memory StrainRangeIndex).
+    """
+    def __init__(self, wjas: Iterable[Optional[int]], uploader_profile=None):
+        wjas = [wja for wja in wjas if wja is not None]
+        self.taken_wjas = set(nema_models.Strain.objects.filter(wja__in=set(wjas)).values_list('wja', flat=True))
+        self.wja_counts = Counter(wjas)
+        self.uploader_profile = uploader_profile
+        self.range_index = get_strain_range_index()
+        self.owners = self.range_index.owners_of(wjas)
+
+    def wja_errors(self, wja: int) -> List[str]:
+        errors = []
+        if wja in self.taken_wjas:
+            errors.append('A strain with this WJA number already exists.')
+        if self.wja_counts[wja] > 1:
+            errors.append(f'WJA{wja:0>4} is in this batch {self.wja_counts[wja]} times.')
+        return errors
+
+    def wja_warnings(self, wja: Optional[int]) -> List[str]:
+        """
+        Strains outside of the uploader's own ranges are allowed (like on the new strain page), just warned about.
+        """
+        if wja is None or self.uploader_profile is None or self.range_index.is_owned_by(wja, self.uploader_profile):
+            return []
+        owner = self.owners[wja] if wja in self.owners else self.range_index.owner_of(wja)
+        if owner is None:
+            return [f'WJA{wja:0>4} isn\'t in anybody\'s strain range.']
+        return [f'WJA{wja:0>4} is in {owner.initials}\'s strain range, not yours.']
+
+
 class MiniStrainForm(forms.ModelForm):
+    """
+    Checks its WJA against the database itself, unless it's given the StrainBatchValidator of a batch of
+    these (see strain_staging.py), which checks them all at once.
+    """
     class Meta:
         model = nema_models.Strain
         fields = ['wja', 'genotype', 'phenotype', 'source', 'description', 'additional_comments']
@@ -57,14 +103,37 @@ class MiniStrainForm(forms.ModelForm):
                                    'in the "description" field, such as notebook pages.',
         }
 
+    def __init__(self, *args, batch_validator: Optional[StrainBatchValidator] = None, **kwargs):
+        self.batch_validator = batch_validator
+        super().__init__(*args, **kwargs)
+
     def clean_wja(self):
         wja = self.cleaned_data['wja']
         if not wja:
             self.add_error('wja', 'Please enter a WJA number.')
-        if nema_models.Strain.objects.filter(wja=wja).exists():
+        if self.batch_validator is not None:
+            for error in self.batch_validator.wja_errors(wja):
+                self.add_error('wja', error)
+        elif nema_models.Strain.objects.filter(wja=wja).exists():
             self.add_error('wja', 'A strain with this WJA number already exists.')
         return wja
 
+    def validate_unique(self):
+        # The WJA is the only unique field, and the batch validator has already checked it
+        if self.batch_validator is None:
+            super().validate_unique()
+
+
+class StagedStrainForm(forms.ModelForm):
+    """
+    For fixing up a line of a bulk upload on its review page (see strain_staging.py).
+    """
+    class Meta:
+        model = nema_models.StagedStrain
+        fields = ['wja', 'genotype', 'phenotype', 'source', 'description', 'additional_comments']
+        widgets = {field_name: forms.TextInput() for field_name in fields[1:]}  # One line per row in the table
+        help_texts = MiniStrainForm.Meta.help_texts
+
 
 class BulkStrainUploadForm(forms.Form):
     data = forms.CharField(widget=forms.Textarea, help_text='Paste your strain data here. '
@@ -151,17 +220,30 @@ class AdvancingThawRequestForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.instance and self.instance.pk:
-            self.fields['tube'].queryset = nema_models.Tube.objects.filter(strain=self.instance.strain,
-                                                                           thawed=False,)
+            # Tubes that other ongoing requests reserved aren't valid choices:
+            self.fields['tube'].queryset = available_tubes([self.instance.strain_id],
+                                                           exclude_thaw_requests=[self.instance])
             self.fields['tube'].label_from_instance = self.tube_label_from_instance_with_comments
-            
+
+    def use_shared_choices(self, tube_choices, thawed_by_choices):
+        """
+        Swaps in choice lists that were already built (see AdvancingThawRequestFormSet), so rendering
+        this form doesn't query the tubes and users again. The fields keep their querysets, which
+        are still what the submitted values get validated against.
+        """
+        for field_name, choices in (('tube', tube_choices), ('thawed_by', thawed_by_choices)):
+            field = self.fields[field_name]
+            empty_choice = [] if field.empty_label is None else [('', field.empty_label)]
+            field.choices = empty_choice + list(choices)
+
     @staticmethod
     def tube_label_from_instance_with_comments(tube):
         try:
             tester = tube.freeze_group.tester.initials
         except AttributeError:
             tester = "N/A?"
-        return (f"{tube.box.short_pos_repr()} [{tube.cap_color}] - {tester} "
+        return (f"{tube.box.short_pos_repr()}{' ' + tube.grid_position() if tube.position else ''} "
+                f"[{tube.cap_color}] - {tester} "
                 f"({tube.date_created}): {tube.freeze_group.tester_comments}")
     
     def save(self, commit=True):
@@ -240,15 +322,9 @@ class AdvancingThawRequestForm(forms.ModelForm):
         # The email:
         subject = f"Refreeze Needed for {strain.formatted_wja}"
         message = render_to_string('emails/refreeze_request.txt', context)
-        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list,
-                             cc=cc_list)
-        email_result = email.send()
-        if email_result == 0:
-            print(f"Email failed to send to {recipient_list} (cc: {cc_list}) "
-                  f"for refreeze of {strain.formatted_wja}.")
-        else:
-            print(f"Email sent to {recipient_list} (cc: {cc_list}) "
-                  f"for refreeze of {strain.formatted_wja}.")
+        queue_email(subject, message, recipient_list, cc=cc_list)
+        print(f"Email queued to {recipient_list} (cc: {cc_list}) "
+              f"for refreeze of {strain.formatted_wja}.")
 
     def send_successful_thaw_email(self, instance):
         context = self.prep_thaw_email(instance)
@@ -258,15 +334,42 @@ class AdvancingThawRequestForm(forms.ModelForm):
         
         subject = f"Thaw Completed for {strain.formatted_wja}"
         message = render_to_string('emails/successful_thaw.txt', context)
-        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list,
-                             cc=cc_list)
-        email_result = email.send()
-        if email_result == 0:
-            print(f"Email failed to send to {recipient_list} (cc: {cc_list}) "
-                  f"for thaw success of {strain.formatted_wja}.")
-        else:
-            print(f"Email sent to {recipient_list} (cc: {cc_list}) "
-                  f"for thaw success of {strain.formatted_wja}.")
+        queue_email(subject, message, recipient_list, cc=cc_list)
+        print(f"Email queued to {recipient_list} (cc: {cc_list}) "
+              f"for thaw success of {strain.formatted_wja}.")
+
+
+class AdvancingThawRequestFormSet(forms.BaseModelFormSet):
+    """
+    Loads the unthawed tubes for every thaw request on the page in one query (instead of one per form,
+    plus a few per tube for its label) and shares them, and the list of users, between the forms.
+    Each form only gets the tubes that aren't reserved by some other ongoing request.
+    """
+    @cached_property
+    def shared_choices(self):
+        strain_ids = {thaw_request.strain_id for thaw_request in self.get_queryset()}
+        tube_choices_by_strain = {}
+        reserved_by = nema_models.ThawRequest.objects.filter(
+            tube=OuterRef('pk'), status__in=RESERVING_STATUSES).values('pk')[:1]
+        candidate_tubes = nema_models.Tube.objects.filter(
+            strain_id__in=strain_ids, thawed=False,
+        ).annotate(reserved_by=Subquery(reserved_by)).select_related('box', 'freeze_group__tester').order_by('pk')
+        for tube in candidate_tubes:
+            tube_choices_by_strain.setdefault(tube.strain_id, []).append(
+                (tube.pk, AdvancingThawRequestForm.tube_label_from_instance_with_comments(tube), tube.reserved_by))
+        thawed_by_choices = [(user_profile.pk, str(user_profile))
+                             for user_profile in profile_models.UserProfile.objects.select_related('user')]
+        return tube_choices_by_strain, thawed_by_choices
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if form.instance.pk:
+            tube_choices_by_strain, thawed_by_choices = self.shared_choices
+            tube_choices = [(pk, label) for pk, label, reserved_by
+                            in tube_choices_by_strain.get(form.instance.strain_id, [])
+                            if reserved_by in (None, form.instance.pk)]
+            form.use_shared_choices(tube_choices, thawed_by_choices)
+        return form
 
 
 class FreezeRequestForm(forms.ModelForm):
@@ -347,12 +450,11 @@ class FreezeGroupForm(forms.ModelForm):
 
 class AdvancingFreezeRequestForm(forms.ModelForm):
     # Constants and field definitions
-    FULL_BOX_WIGGLE_ROOM = 4  # 81 spaces per box, but we won't show boxes that are within this many tubes of full
+    FULL_BOX_WIGGLE_ROOM = 4  # We won't show boxes that are within this many tubes of full (see Box.capacity)
 
     box1 = forms.ModelChoiceField(
-        queryset=nema_models.Box.objects.annotate(
-            active_tubes_count=Count('tube_set', filter=Q(tube_set__thawed=False))
-        ).filter(active_tubes_count__lt=81 - FULL_BOX_WIGGLE_ROOM).filter(dewar__exact=1),
+        queryset=nema_models.Box.objects.filter(
+            active_tube_counter__lt=F('capacity') - FULL_BOX_WIGGLE_ROOM).filter(dewar__exact=1),
         label='Box 1',
         help_text='Please select the box number for the first box.',
         required=False,
@@ -361,13 +463,12 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
         label='Tubes for Box 1',
         help_text='Please enter the number of tubes to be placed in the first box.',
         min_value=0,
-        max_value=81 - FULL_BOX_WIGGLE_ROOM,
+        max_value=TUBES_PER_BOX - FULL_BOX_WIGGLE_ROOM,
         required=False,
     )
     box2 = forms.ModelChoiceField(
-        queryset=nema_models.Box.objects.annotate(
-            active_tubes_count=Count('tube_set', filter=Q(tube_set__thawed=False))
-        ).filter(active_tubes_count__lt=81 - FULL_BOX_WIGGLE_ROOM).filter(dewar__exact=2),
+        queryset=nema_models.Box.objects.filter(
+            active_tube_counter__lt=F('capacity') - FULL_BOX_WIGGLE_ROOM).filter(dewar__exact=2),
         label='Box 2',
         help_text='Please select the box number for the second box.',
         required=False,
@@ -376,7 +477,7 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
         label='Tubes for Box 2',
         help_text='Please enter the number of tubes to be placed in the second box.',
         min_value=0,
-        max_value=81 - FULL_BOX_WIGGLE_ROOM,
+        max_value=TUBES_PER_BOX - FULL_BOX_WIGGLE_ROOM,
         required=False,
     )
 
@@ -403,11 +504,24 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
             'date_stored',
         ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, occupancy=None, user_choices=None, actor=None, **kwargs):
+        """
+        :param occupancy: A BoxOccupancySnapshot to build the box choices from, so a formset can share one
+        :param user_choices: Prebuilt (pk, label) choices for the freezer and tester fields
+        :param actor: The user making the changes, for the history/auditlog rows of the new tubes
+        """
         super().__init__(*args, **kwargs)
         self.warnings = []
-        default_box1 = nema_models.DefaultBox.get_default_box_for_dewar(1)
-        default_box2 = nema_models.DefaultBox.get_default_box_for_dewar(2)
+        self.actor = actor
+        self.occupancy = occupancy or BoxOccupancySnapshot()
+        # The querysets stay as they are, for validating what gets submitted:
+        for field_name, dewar in (('box1', 1), ('box2', 2)):
+            self.use_choices(field_name, self.occupancy.box_choices(dewar, self.FULL_BOX_WIGGLE_ROOM))
+        if user_choices is not None:
+            self.use_choices('freezer', user_choices)
+            self.use_choices('tester', user_choices)
+        default_box1 = self.occupancy.default_box_for_dewar(1)
+        default_box2 = self.occupancy.default_box_for_dewar(2)
         # print(self.fields['box1'].data, self.fields['box2'].data)
         if not self.is_bound:
             # Remove initial data setting for 'freezer' and 'tester'
@@ -436,6 +550,11 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
             self.fields['box2'].value = default_box2.box.pk
         print(self.data.get('box1'), self.data.get('box2'))
 
+    def use_choices(self, field_name, choices):
+        field = self.fields[field_name]
+        empty_choice = [] if field.empty_label is None else [('', field.empty_label)]
+        field.choices = empty_choice + list(choices)
+
     def clean(self):
         cleaned_data = super().clean()
         box1 = cleaned_data.get('box1', None)
@@ -472,9 +591,10 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
                 self.add_error('box1', 'Please select a "Box1".')
             if not box2 and tubes_for_box2 > 0:
                 self.add_error('box2', 'Please select a "Box2".')
-            if box1.get_active_tubes().count() + tubes_for_box1 > 81:
+            # These use the page's snapshot, save() reserves the space for real (see reserve_box_slots):
+            if box1 and self.occupancy.active_tubes_count(box1) + tubes_for_box1 > box1.capacity:
                 self.add_error('tubes_for_box1', 'The selected box would be overfull if you added to it.')
-            if box2.get_active_tubes().count() + tubes_for_box2 > 81:
+            if box2 and self.occupancy.active_tubes_count(box2) + tubes_for_box2 > box2.capacity:
                 self.add_error('tubes_for_box2', 'The selected box would be overfull if you added to it.')
         elif status in ['F', 'X']:
             if not tester_comments:
@@ -483,7 +603,7 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
         return cleaned_data
 
     def save(self, commit=True):
-        with transaction.atomic():
+        with immediate_atomic():
             cleaned_data = self.cleaned_data
             status = cleaned_data.get('status')
 
@@ -496,45 +616,16 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
 
             if status in ['C', 'F', 'X']:
                 if not instance.freeze_group:
-                    # Create FreezeGroup instance
-                    freeze_group = nema_models.FreezeGroup.objects.create(
-                        strain=instance.strain,
+                    create_freeze_group(
+                        instance, status,
                         freezer=cleaned_data.get('freezer'),
                         tester=cleaned_data.get('tester'),
-                        started_test=True if status in ['C', 'F'] else False,
-                        completed_test=True if status in ['C', 'F'] else False,
-                        passed_test=True if status == 'C' else False,
-                        stored=True if status == 'C' else False,
                         tester_comments=cleaned_data.get('tester_comments'),
-                        freeze_request=instance,
                         date_stored=cleaned_data.get('date_stored'),
-                        test_check_date=cleaned_data.get('date_stored'),
+                        tubes_per_box=[(cleaned_data.get('box1'), cleaned_data.get('tubes_for_box1')),
+                                       (cleaned_data.get('box2'), cleaned_data.get('tubes_for_box2'))],
+                        actor=self.actor,
                     )
-
-                    # Create Tube instances if status is 'C' (Completed)
-                    if status == 'C':
-                        for box, tubes in [
-                            (cleaned_data.get('box1'), cleaned_data.get('tubes_for_box1')),
-                            (cleaned_data.get('box2'), cleaned_data.get('tubes_for_box2'))
-                        ]:
-                            if box and tubes:
-                                for i in range(tubes):
-                                    nema_models.Tube.objects.create(
-                                        strain=instance.strain,
-                                        freeze_group=freeze_group,
-                                        date_created=cleaned_data.get('date_stored'),
-                                        box=box,
-                                        cap_color=instance.cap_color,
-                                        set_number=i + 1,
-                                    )
-                                # Update the default box for the dewar if we are freezing into non-default boxes!
-                                if not nema_models.DefaultBox.objects.filter(box=box).exists():
-                                    current_default = nema_models.DefaultBox.get_default_box_for_dewar(box.dewar)
-                                    if current_default:
-                                        current_default.delete()
-                                    nema_models.DefaultBox.objects.create(box=box)
-                    instance.freeze_group = freeze_group
-                    instance.date_advanced = timezone.now().date()
                 else:
                     raise ValueError("FreezeRequest already has an associated FreezeGroup! This shouldn't happen... ?")
             
@@ -597,15 +688,9 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
         
         subject = f"Freeze Completed for {strain.formatted_wja}"
         message = render_to_string('emails/successful_freeze.txt', context)
-        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list,
-                             cc=cc_list)
-        email_result = email.send()
-        if email_result == 0:
-            print(f"Email failed to send to {recipient_list} (cc: {cc_list}) "
-                  f"for freeze success of {strain.formatted_wja}.")
-        else:
-            print(f"Email sent to {recipient_list} (cc: {cc_list}) "
-                  f"for freeze success of {strain.formatted_wja}.")
+        queue_email(subject, message, recipient_list, cc=cc_list)
+        print(f"Email queued to {recipient_list} (cc: {cc_list}) "
+              f"for freeze success of {strain.formatted_wja}.")
     
     def send_failed_or_canceled_freeze_email(self, instance):
         context = self.prep_freeze_email(instance)
@@ -623,13 +708,26 @@ class AdvancingFreezeRequestForm(forms.ModelForm):
             raise ValueError(f"Invalid status for failed/canceled freeze email: {instance.status}")
         
         subject = f"Freeze {context['failed_or_cancelled']} for {strain.formatted_wja}"
-        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list,
-                             cc=cc_list)
-        email_result = email.send()
-        if email_result == 0:
-            print(f"Email failed to send to {recipient_list} (cc: {cc_list}) "
-                  f"for failed/canceled freeze of {strain.formatted_wja}.")
-        else:
-            print(f"Email sent to {recipient_list} (cc: {cc_list}) "
-                  f"for failed/canceled freeze of {strain.formatted_wja}.")
-        
+        queue_email(subject, message, recipient_list, cc=cc_list)
+        print(f"Email queued to {recipient_list} (cc: {cc_list}) "
+              f"for failed/canceled freeze of {strain.formatted_wja}.")
+
+
+class AdvancingFreezeRequestFormSet(forms.BaseModelFormSet):
+    """
+    Gives every AdvancingFreezeRequestForm the same BoxOccupancySnapshot and user choices, so the
+    boxes, default boxes and users are only loaded once per page instead of once per form.
+    """
+    @cached_property
+    def occupancy(self):
+        return BoxOccupancySnapshot()
+
+    @cached_property
+    def user_choices(self):
+        return [(user_profile.pk, str(user_profile))
+                for user_profile in profile_models.UserProfile.objects.select_related('user')]
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        kwargs.update(occupancy=self.occupancy, user_choices=self.user_choices)
+        return kwargs
@@ -0,0 +1,85 @@
+"""
+Recording the result of a freeze request (the FreezeGroup, and its tubes if it passed).
+
+Completing a freeze used to save every tube on its own, which meant a Tube row, a HistoricalTube
+row, an auditlog LogEntry and a few tube counter UPDATEs per tube, all while the user waited.
+create_freeze_group() inserts all the tubes with one bulk_create and writes their simple_history
+and auditlog rows in bulk too, so a 10-tube freeze only costs a handful of queries.
+"""
+from typing import Iterable, Optional, Tuple
+
+from django.utils import timezone
+
+from .box_occupancy import reserve_box_slots
+from .bulk_history import bulk_create_with_audit
+from .models import Box, DefaultBox, FreezeGroup, FreezeRequest, Tube
+from .slots import assign_missing_positions, assign_positions
+from .transactions import immediate_atomic
+
+
+def make_default_box(box: Box):
+    """
+    Makes this the box that its dewar freezes into by default (if it isn't already).
+    """
+    if DefaultBox.objects.filter(box=box).exists():
+        return
+    for old_default_box in DefaultBox.objects.filter(box__dewar=box.dewar):
+        old_default_box.delete()
+    DefaultBox.objects.create(box=box)
+
+
+@immediate_atomic()
+def create_freeze_group(freeze_request: FreezeRequest, status: str, freezer=None, tester=None,
+                        tester_comments: Optional[str] = None, date_stored=None,
+                        tubes_per_box: Iterable[Tuple[Box, int]] = (), actor=None) -> FreezeGroup:
+    """
+    Creates the FreezeGroup for a freeze request that just completed ('C'), failed ('F') or was
+    cancelled ('X'). For completed freezes, tubes_per_box says how many tubes went into which boxes:
+    they are all created at once, and each box used becomes its dewar's default box.
+    Raises BoxFullError if any of the boxes has filled up in the meantime.
+    Doesn't save the freeze request itself, only points it at the new freeze group.
+    """
+    tested = status in ['C', 'F']
+    freeze_group = FreezeGroup.objects.create(
+        strain=freeze_request.strain,
+        freezer=freezer,
+        tester=tester,
+        started_test=tested,
+        completed_test=tested,
+        passed_test=status == 'C',
+        stored=status == 'C',
+        tester_comments=tester_comments,
+        freeze_request=freeze_request,
+        date_stored=date_stored,
+        test_check_date=date_stored,
+    )
+    if status == 'C':
+        tubes = []
+        boxes_used = []
+        tubes_by_box = {}
+        for box, number_of_tubes in tubes_per_box:
+            if not (box and number_of_tubes):
+                continue
+            tubes_by_box[box.pk] = tubes_by_box.get(box.pk, 0) + number_of_tubes
+            tubes.extend(Tube(strain=freeze_request.strain,
+                              freeze_group=freeze_group,
+                              date_created=date_stored or timezone.now().date(),
+                              box=box,
+                              # Requests don't have to say, but tubes always have a cap color:
+                              cap_color=freeze_request.cap_color or Tube._meta.get_field('cap_color').default,
+                              set_number=i + 1)
+                         for i in range(number_of_tubes))
+            boxes_used.append(box)
+        reserve_box_slots(tubes_by_box)
+        # Tubes still without a position (e.g. put in by hand through the admin) are sitting in a slot
+        # somewhere, so they get theirs first rather than the new tubes being handed it:
+        assign_missing_positions(boxes_used)
+        assign_positions(tubes)  # Safe now that the space is reserved (and we hold the write lock)
+        # Tube.objects.bulk_create also updates the strain/freeze group/box tube counters:
+        bulk_create_with_audit(tubes, actor=actor)
+        # Update the default box for the dewar if we are freezing into non-default boxes!
+        for box in boxes_used:
+            make_default_box(box)
+    freeze_request.freeze_group = freeze_group
+    freeze_request.date_advanced = timezone.now().date()
+    return freeze_group
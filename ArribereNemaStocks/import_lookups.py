@@ -0,0 +1,55 @@
+"""
+Preloaded lookups for the legacy import scripts (betterJSON_DBBuild.py and uploadChloesRecords.py).
+
+Those scripts used to run Box.objects.get(...) and UserProfile.objects.get(initials=...) for every
+tube/freeze/row. There are only ~100 boxes and a few dozen users, so we just load them all once
+up front and answer the lookups from dictionaries instead.
+"""
+from typing import Dict, Tuple
+
+from .models import Box
+from profiles.models import UserInitials, UserProfile
+
+
+class ImportLookups:
+    def __init__(self):
+        self.boxes: Dict[Tuple[int, int, int], Box] = {
+            (box.dewar, box.rack, box.box): box for box in Box.objects.all()
+        }
+        # The scripts look users up two ways, and these keep both of them answering the way the queries did:
+        # by their primary UserProfile.initials, or by any UserInitials they have gone by.
+        self.user_profiles_by_initials: Dict[str, UserProfile] = {
+            profile.initials: profile for profile in UserProfile.objects.select_related('user')
+        }
+        profiles_by_pk = {profile.pk: profile for profile in self.user_profiles_by_initials.values()}
+        self.user_profiles_by_alias: Dict[str, UserProfile] = {
+            user_initials.initials: profiles_by_pk[user_initials.user_profile_id]
+            for user_initials in UserInitials.objects.exclude(user_profile=None)
+        }
+
+    def get_box(self, dewar, rack, box) -> Box:
+        """
+        Same as Box.objects.get(dewar=..., rack=..., box=...), the numbers can be ints or strings like '3'.
+        """
+        try:
+            return self.boxes[(int(dewar), int(rack), int(box))]
+        except KeyError:
+            raise Box.DoesNotExist(f"The box {dewar}-{rack}-{box} does not exist!")
+
+    def get_user_profile(self, initials: str) -> UserProfile:
+        """
+        Same as UserProfile.objects.get(initials=...), so only their primary initials.
+        """
+        try:
+            return self.user_profiles_by_initials[initials]
+        except KeyError:
+            raise UserProfile.DoesNotExist(f"No user found with the initials {initials}")
+
+    def get_user_profile_by_alias(self, initials: str) -> UserProfile:
+        """
+        Same as UserInitials.objects.get(initials=...).user_profile, so any initials they have gone by.
+        """
+        try:
+            return self.user_profiles_by_alias[initials]
+        except KeyError:
+            raise UserInitials.DoesNotExist(f"No user found with the initials {initials}")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ArribereNemaStocks.slots import assign_missing_positions
+from ArribereNemaStocks.transactions import immediate_atomic
+
+
+class Command(BaseCommand):
+    help = ('Gives every unthawed tube without a slot position (e.g. from the old databases) '
+            'the next free slot in its box.')
+
+    def handle(self, *args, **options):
+        with immediate_atomic():
+            assigned = assign_missing_positions()
+        self.stdout.write(self.style.SUCCESS(f'Done, {assigned} tubes were given a position.'))
@@ -0,0 +1,136 @@
+import multiprocessing
+import sqlite3
+import statistics
+import tempfile
+import time
+from importlib import import_module
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+
+from ArribereNemaStocks.models import Strain
+
+BENCHMARK_ALIAS = 'sqlite_profile_benchmark'
+# The plain backend (what settings.py uses by default), and the SQLITE_PRODUCTION_PROFILE one:
+PROFILES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'OPTIONS': {}},
+    'production': {'ENGINE': 'ArribereNemaStocks.sqlite_backend', 'OPTIONS': {'transaction_mode': 'IMMEDIATE'}},
+}
+# How long each write transaction spends between its read and its write (like a formset being validated),
+# and how long each writer waits before its next one (nobody submits forms back to back):
+WRITE_THINK_TIME = 0.002
+WRITE_PAUSE = 0.002
+
+
+def _connect(profile, db_path):
+    settings_dict = {**connections['default'].settings_dict, **PROFILES[profile], 'NAME': str(db_path)}
+    backend = import_module(f"{settings_dict['ENGINE']}.base")
+    connections[BENCHMARK_ALIAS] = backend.DatabaseWrapper(settings_dict, alias=BENCHMARK_ALIAS)
+
+
+def _read_worker(profile, db_path, deadline, results):
+    """
+    Keeps loading a page of the strain list (plus its count), like someone browsing the strains.
+    """
+    _connect(profile, db_path)
+    strains = Strain.objects.using(BENCHMARK_ALIAS).order_by('formatted_wja')
+    latencies, errors, offset = [], 0, 0
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            list(strains.values_list('pk', 'formatted_wja', 'genotype')[offset:offset + 15])
+            strains.count()
+        except OperationalError:
+            errors += 1
+        else:
+            latencies.append(time.monotonic() - started)
+        offset = (offset + 15) % 1500
+    results.put(('read', len(latencies), errors, latencies))
+
+
+def _write_worker(profile, db_path, deadline, worker_number, results):
+    """
+    Keeps running small transactions that read, then write, like the ongoing freezes/thaws formsets do.
+    """
+    _connect(profile, db_path)
+    latencies, errors = [], 0
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            with transaction.atomic(using=BENCHMARK_ALIAS):
+                with connections[BENCHMARK_ALIAS].cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) FROM benchmark_writes WHERE worker = %s', [worker_number])
+                    written = cursor.fetchone()[0]
+                    time.sleep(WRITE_THINK_TIME)
+                    cursor.execute('INSERT INTO benchmark_writes (worker, written) VALUES (%s, %s)',
+                                   [worker_number, written + 1])
+        except OperationalError:  # "database is locked"
+            errors += 1
+        else:
+            latencies.append(time.monotonic() - started)
+        time.sleep(WRITE_PAUSE)
+    results.put(('write', len(latencies), errors, latencies))
+
+
+class Command(BaseCommand):
+    help = ('Compares read/write throughput of the default SQLite settings and the production profile '
+            '(SQLITE_PRODUCTION_PROFILE) with several processes hitting a copy of the database at once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=10, help='How long to run each profile for.')
+        parser.add_argument('--readers', type=int, default=4, help='Reading processes.')
+        parser.add_argument('--writers', type=int, default=2, help='Writing processes.')
+
+    def handle(self, *args, **options):
+        source_path = connections['default'].settings_dict['NAME']
+        self.stdout.write(f"Copying {source_path}, then running {options['readers']} readers and "
+                          f"{options['writers']} writers for {options['seconds']}s per profile...")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for profile in PROFILES:
+                db_path = Path(temp_dir) / f'{profile}.sqlite3'
+                self.copy_database(source_path, db_path)
+                self.report(profile, self.run_profile(profile, db_path, options))
+
+    @staticmethod
+    def copy_database(source_path, db_path):
+        with sqlite3.connect(str(source_path)) as source, sqlite3.connect(str(db_path)) as copy:
+            source.backup(copy)
+            copy.execute('PRAGMA journal_mode = DELETE')  # Start from SQLite's default, the profile sets its own
+            copy.execute('CREATE TABLE benchmark_writes (id INTEGER PRIMARY KEY, worker INTEGER, written INTEGER)')
+        source.close()  # (The with block only commits)
+        copy.close()
+
+    @staticmethod
+    def run_profile(profile, db_path, options):
+        # Connect once first, so the production profile has switched the file to WAL before the workers start
+        # (that only ever happens once on a real database):
+        _connect(profile, db_path)
+        connections[BENCHMARK_ALIAS].ensure_connection()
+        connections.close_all()  # The workers are forked, they mustn't share our connections
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        deadline = time.monotonic() + 1 + options['seconds']  # +1 for the workers to start up
+        workers = [context.Process(target=_read_worker, args=(profile, db_path, deadline, results))
+                   for _ in range(options['readers'])]
+        workers += [context.Process(target=_write_worker, args=(profile, db_path, deadline, i, results))
+                    for i in range(options['writers'])]
+        for worker in workers:
+            worker.start()
+        totals = {'read': [0, 0, []], 'write': [0, 0, []]}
+        for _ in workers:
+            kind, done, errors, latencies = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += errors
+            totals[kind][2] += latencies
+        for worker in workers:
+            worker.join()
+        return {kind: (done / options['seconds'], errors, latencies)
+                for kind, (done, errors, latencies) in totals.items()}
+
+    def report(self, profile, totals):
+        self.stdout.write(f'\n{profile}:')
+        for kind, (per_second, errors, latencies) in totals.items():
+            p95 = statistics.quantiles(latencies, n=20)[-1] * 1000 if len(latencies) >= 2 else float('nan')
+            self.stdout.write(f'  {kind}s: {per_second:8.1f}/s   p95 {p95:7.1f}ms   '
+                              f'"database is locked" errors: {errors}')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ArribereNemaStocks import search as strain_search
+from ArribereNemaStocks.models import Strain
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text (FTS5) search index used by the strain search pages.'
+
+    def handle(self, *args, **options):
+        if not strain_search.search_index_available():
+            raise CommandError('The strain search index is only available when using SQLite.')
+        strain_search.install_strain_search_index(rebuild=True)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the strain search index ({Strain.objects.count()} strains).'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ArribereNemaStocks.models import Strain, FreezeGroup, Box
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the stored active/total tube counters on strains, freeze groups and boxes '
+            'from the Tube table, fixing any that have drifted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows have drifted, without fixing them.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for model in (Strain, FreezeGroup, Box):
+                drifted_count = model.drifted_tube_counters().count()
+                if not options['dry_run']:
+                    model.recount_tubes()
+                self.stdout.write(f'{model._meta.verbose_name_plural.title()}: '
+                                  f'{drifted_count} with drifted tube counters'
+                                  f'{"" if options["dry_run"] else " (fixed)"}.')
+        self.stdout.write(self.style.SUCCESS('Done.'))
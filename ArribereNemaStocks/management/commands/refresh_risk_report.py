@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from ArribereNemaStocks.models import StrainRiskReport
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the "scary stuff" report (strains with no freezes, a failed latest freeze '
+            'or too few active tubes) from scratch.')
+
+    def handle(self, *args, **options):
+        at_risk = StrainRiskReport.refresh()
+        self.stdout.write(self.style.SUCCESS(f'Done, {at_risk} strains are at risk.'))
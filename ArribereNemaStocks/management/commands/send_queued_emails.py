@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from ArribereNemaStocks.outbox import deliver_queued_emails
+from hardcoded import EMAIL_MAX_SEND_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails waiting in the outbox (see ArribereNemaStocks/outbox.py).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking the outbox every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=10,
+                            help='Seconds to wait between outbox checks when using --loop (default: 10).')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Maximum number of emails to send per batch (default: 50).')
+        parser.add_argument('--max-attempts', type=int, default=EMAIL_MAX_SEND_ATTEMPTS,
+                            help=f'Failures before an email is marked dead (default: {EMAIL_MAX_SEND_ATTEMPTS}).')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                sent, failed = deliver_queued_emails(batch_size=options['batch_size'],
+                                                     max_attempts=options['max_attempts'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                # Something went wrong outside of sending any one email (e.g. the database is locked),
+                # the worker has to keep running, so log it and try again after the usual wait:
+                logger.exception('Delivering the queued emails failed, trying again later.')
+                sent = failed = 0
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} email(s), {failed} failed.')
+            if not options['loop']:
+                break
+            # If the batch was full there are probably more waiting, so don't sleep:
+            if sent + failed < options['batch_size']:
+                time.sleep(options['interval'])
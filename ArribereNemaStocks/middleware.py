@@ -0,0 +1,94 @@
+"""
+Per-request performance instrumentation.
+
+QueryBudgetMiddleware counts the SQL queries each request makes (and how long they take) and
+logs them to the "ArribereNemaStocks.performance" logger. While debugging (DEBUG or
+QUERY_BUDGET_STRICT on) it also adds a Server-Timing header, so the numbers show up in the
+browser dev tools (Network tab -> Timing).
+
+Views can be given a maximum number of queries in hardcoded.QUERY_BUDGETS. Going over the
+budget logs a warning, or raises QueryBudgetExceeded when settings.QUERY_BUDGET_STRICT is on
+(which it is when DEBUG is on, unless the .env file says otherwise), so new N+1 queries get
+caught early.
+
+The count is only known once the view has run, when anything it saved has already been committed.
+So only safe requests (GET, HEAD, ...) raise; a POST that goes over its budget just logs a warning,
+rather than showing an error page for changes that were made.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from hardcoded import QUERY_BUDGETS
+
+logger = logging.getLogger('ArribereNemaStocks.performance')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')  # Requests that shouldn't have changed anything
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised after the view has run, for safe (read-only) requests only, see the module docstring.
+    """
+
+
+class QueryStats:
+    """
+    Used as a connection.execute_wrapper, this counts and times every query run through the connection.
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start_time
+            self.count += 1
+
+
+def get_query_budget(view_name: str):
+    """
+    Returns the max number of queries allowed for this view name (e.g. 'strain_details'
+    or 'admin:ArribereNemaStocks_strain_changelist'), or None if it doesn't have a budget.
+    """
+    return QUERY_BUDGETS.get(view_name)
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_stats = QueryStats()
+        start_time = time.perf_counter()
+        with connection.execute_wrapper(query_stats):
+            response = self.get_response(request)
+        total_duration = time.perf_counter() - start_time
+
+        sql_ms = query_stats.duration * 1000
+        total_ms = total_duration * 1000
+        if settings.DEBUG or settings.QUERY_BUDGET_STRICT:
+            # "app" is everything that isn't SQL: the view code, template rendering, etc.
+            response['Server-Timing'] = (f'db;dur={sql_ms:.1f};desc="{query_stats.count} queries", '
+                                         f'app;dur={total_ms - sql_ms:.1f}, '
+                                         f'total;dur={total_ms:.1f}')
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return response  # 404s and the like
+        view_name = resolver_match.view_name
+        logger.info('%s %s (%s): %d queries, %.1fms SQL, %.1fms total',
+                    request.method, request.path, view_name, query_stats.count, sql_ms, total_ms)
+
+        budget = get_query_budget(view_name)
+        if budget is not None and query_stats.count > budget:
+            message = f'{view_name} made {query_stats.count} queries, its budget is {budget}'
+            if settings.QUERY_BUDGET_STRICT and request.method in SAFE_METHODS:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
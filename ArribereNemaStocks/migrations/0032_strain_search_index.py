@@ -0,0 +1,24 @@
+# Creates the SQLite FTS5 index used by StrainManager.search() and deep_search()
+
+from django.db import migrations
+
+from ArribereNemaStocks import search as strain_search
+
+
+def create_search_index(apps, schema_editor):
+    strain_search.install_strain_search_index(schema_editor.connection, rebuild=True)
+
+
+def drop_search_index(apps, schema_editor):
+    strain_search.remove_strain_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0031_alter_freezegroup_freeze_request'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
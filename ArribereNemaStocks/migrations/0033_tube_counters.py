@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing_tubes(apps, schema_editor):
+    Tube = apps.get_model('ArribereNemaStocks', 'Tube')
+    for model_name, tube_fk_name in (('Strain', 'strain'), ('FreezeGroup', 'freeze_group'), ('Box', 'box')):
+        model = apps.get_model('ArribereNemaStocks', model_name)
+        tubes = Tube.objects.filter(**{tube_fk_name: OuterRef('pk')}).order_by().values(tube_fk_name)
+        active_count = tubes.filter(thawed=False).annotate(tube_count=Count('pk')).values('tube_count')
+        total_count = tubes.annotate(tube_count=Count('pk')).values('tube_count')
+        model.objects.update(active_tube_counter=Coalesce(Subquery(active_count), 0),
+                             total_tube_counter=Coalesce(Subquery(total_count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0032_strain_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='box',
+            name='active_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='box',
+            name='total_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='freezegroup',
+            name='active_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='freezegroup',
+            name='total_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='strain',
+            name='active_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='strain',
+            name='total_tube_counter',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_existing_tubes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:02
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Q, Subquery
+import django.db.models.deletion
+
+# hardcoded.TUBE_REMAINING_THRESHOLD when this was written, copied so replaying the migration always
+# gives the same report (refresh_risk_report uses whatever the setting is now):
+TUBE_REMAINING_THRESHOLD = 2
+
+
+def build_risk_report(apps, schema_editor):
+    Strain = apps.get_model('ArribereNemaStocks', 'Strain')
+    FreezeGroup = apps.get_model('ArribereNemaStocks', 'FreezeGroup')
+    StrainRiskReport = apps.get_model('ArribereNemaStocks', 'StrainRiskReport')
+    latest_freezes = FreezeGroup.objects.filter(strain=OuterRef('pk')).order_by('-date_created', '-pk')
+    at_risk_strains = Strain.objects.annotate(
+        latest_freeze_passed=Subquery(latest_freezes.values('passed_test')[:1]),
+        latest_freeze_tested=Subquery(latest_freezes.values('completed_test')[:1]),
+    ).filter(
+        Q(latest_freeze_passed__isnull=True) | Q(latest_freeze_tested=True, latest_freeze_passed=False)
+        | Q(active_tube_counter__lte=TUBE_REMAINING_THRESHOLD)
+    ).values_list('pk', 'latest_freeze_passed', 'latest_freeze_tested', 'active_tube_counter')
+    StrainRiskReport.objects.bulk_create([
+        StrainRiskReport(strain_id=pk,
+                         no_freezes=latest_freeze_passed is None,
+                         latest_freeze_failed=bool(latest_freeze_tested) and latest_freeze_passed is False,
+                         low_tubes=active_tubes <= TUBE_REMAINING_THRESHOLD,
+                         active_tubes=active_tubes)
+        for pk, latest_freeze_passed, latest_freeze_tested, active_tubes in at_risk_strains
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0034_outboxemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StrainRiskReport',
+            fields=[
+                ('strain', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='risk_report', serialize=False, to='ArribereNemaStocks.strain')),
+                ('no_freezes', models.BooleanField(default=False)),
+                ('latest_freeze_failed', models.BooleanField(default=False)),
+                ('low_tubes', models.BooleanField(default=False)),
+                ('active_tubes', models.IntegerField(default=0)),
+                ('date_refreshed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(build_risk_report, migrations.RunPython.noop),
+    ]
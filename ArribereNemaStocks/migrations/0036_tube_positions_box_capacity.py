@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+def assign_existing_tube_positions(apps, schema_editor):
+    # Same as slots.assign_missing_positions: without this every existing box would look empty to
+    # the slot allocator, and new tubes would be given slots that older tubes already sit in.
+    Box = apps.get_model('ArribereNemaStocks', 'Box')
+    Tube = apps.get_model('ArribereNemaStocks', 'Tube')
+    capacities = dict(Box.objects.values_list('pk', 'capacity'))
+    next_positions = {}
+    tubes = []
+    for tube in Tube.objects.filter(box__isnull=False, thawed=False).order_by('pk').only('pk', 'box_id'):
+        position = next_positions.get(tube.box_id, 1)
+        if position > capacities[tube.box_id]:
+            continue
+        tube.position = position
+        next_positions[tube.box_id] = position + 1
+        tubes.append(tube)
+    Tube.objects.bulk_update(tubes, ['position'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0035_strainriskreport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='box',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=81),
+        ),
+        migrations.AddField(
+            model_name='historicalbox',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=81),
+        ),
+        migrations.AddField(
+            model_name='historicaltube',
+            name='position',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tube',
+            name='position',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(assign_existing_tube_positions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='tube',
+            constraint=models.UniqueConstraint(condition=models.Q(('position__isnull', False), ('thawed', False)), fields=('box', 'position'), name='unique_active_tube_position'),
+        ),
+    ]
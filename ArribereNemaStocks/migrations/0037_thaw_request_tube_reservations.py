@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:19
+
+from django.db import migrations, models
+
+
+def release_double_reservations(apps, schema_editor):
+    # Before this, two ongoing requests could have picked the same tube. The oldest one keeps it.
+    ThawRequest = apps.get_model('ArribereNemaStocks', 'ThawRequest')
+    seen_tube_ids = set()
+    for thaw_request in ThawRequest.objects.filter(status='O', tube__isnull=False).order_by('pk'):
+        if thaw_request.tube_id in seen_tube_ids:
+            ThawRequest.objects.filter(pk=thaw_request.pk).update(tube=None)
+        seen_tube_ids.add(thaw_request.tube_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0036_tube_positions_box_capacity'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_double_reservations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='thawrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'O')), fields=('tube',), name='unique_ongoing_thaw_tube'),
+        ),
+    ]
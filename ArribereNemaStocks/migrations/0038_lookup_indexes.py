@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0037_thaw_request_tube_reservations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='freezegroup',
+            index=models.Index(condition=models.Q(('passed_test', True)), fields=['strain', 'date_created'], name='freezegroup_passed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='freezegroup',
+            index=models.Index(condition=models.Q(('passed_test', False)), fields=['strain', 'date_created'], name='freezegroup_failed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='freezerequest',
+            index=models.Index(fields=['status'], name='freezerequest_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='strain',
+            index=models.Index(fields=['formatted_wja'], name='strain_formatted_wja_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thawrequest',
+            index=models.Index(fields=['status'], name='thawrequest_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tube',
+            index=models.Index(condition=models.Q(('thawed', False)), fields=['strain'], name='tube_unthawed_strain_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tube',
+            index=models.Index(condition=models.Q(('thawed', False)), fields=['box'], name='tube_unthawed_box_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tube',
+            index=models.Index(condition=models.Q(('thawed', False)), fields=['freeze_group'], name='tube_unthawed_freeze_group_idx'),
+        ),
+    ]
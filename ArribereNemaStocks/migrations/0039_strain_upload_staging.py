@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ArribereNemaStocks', '0038_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StrainUploadBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('uploaded_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='strain_upload_batches', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedStrain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_number', models.IntegerField()),
+                ('wja', models.IntegerField(blank=True, null=True)),
+                ('genotype', models.TextField(blank=True, default='')),
+                ('phenotype', models.TextField(blank=True, default='')),
+                ('source', models.TextField(blank=True, default='')),
+                ('description', models.TextField(blank=True, default='')),
+                ('additional_comments', models.TextField(blank=True, default='')),
+                ('is_valid', models.BooleanField(default=False)),
+                ('errors', models.JSONField(blank=True, default=dict)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rows', to='ArribereNemaStocks.strainuploadbatch')),
+            ],
+            options={
+                'ordering': ['line_number'],
+                'indexes': [models.Index(fields=['batch', 'is_valid'], name='stagedstrain_batch_valid_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stagedstrain',
+            constraint=models.UniqueConstraint(fields=('batch', 'line_number'), name='unique_staged_strain_line'),
+        ),
+    ]
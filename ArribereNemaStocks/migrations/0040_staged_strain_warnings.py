@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ArribereNemaStocks', '0039_strain_upload_staging'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stagedstrain',
+            name='warnings',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
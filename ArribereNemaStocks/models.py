@@ -1,12 +1,17 @@
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, F, Count, OuterRef, Subquery, Case, When, Value
+from django.db.models.functions import Coalesce
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 
 from simple_history.models import HistoricalRecords
 from auditlog.models import AuditlogHistoryField
 
-from hardcoded import CAP_COLOR_OPTIONS
+import math
+
+from hardcoded import CAP_COLOR_OPTIONS, TUBE_REMAINING_THRESHOLD, TUBES_PER_BOX
+from . import search as strain_search
 
 
 class StrainManager(models.Manager):
@@ -14,23 +19,155 @@ class StrainManager(models.Manager):
         return self.get(wja=wja)
 
     def search(self, query):
-        return self.filter(
-            Q(formatted_wja__icontains=query) |
-            Q(phenotype__icontains=query) |
-            Q(genotype__icontains=query)
-            # Add other fields as needed
-        )
+        return self._full_text_search(query, strain_search.SEARCH_FIELDS)
     
     def deep_search(self, query):
+        return self._full_text_search(query, strain_search.DEEP_SEARCH_FIELDS)
+
+    def in_wja_ranges(self, wja_ranges):
+        """
+        Returns the strains that fall inside any of the given (start, end) WJA ranges (inclusive).
+        Each range becomes a single BETWEEN clause, so big ranges don't turn into giant IN lists.
+        """
+        q_filter = Q()
+        for start, end in wja_ranges:
+            q_filter |= Q(wja__range=(start, end))
+        if not q_filter:
+            return self.none()
+        return self.filter(q_filter)
+
+    def _full_text_search(self, query, fields):
+        """
+        Searches the FTS5 index (see search.py) and orders the results by relevance.
+        Falls back to the old icontains filters for very short queries (which the trigram
+        index can't match) or if we aren't running on SQLite.
+        """
+        query = query.strip()
+        if len(query) < strain_search.MIN_FTS_QUERY_LENGTH or not strain_search.search_index_available():
+            q_filter = Q()
+            for field in fields:
+                q_filter |= Q(**{f'{field}__icontains': query})
+            return self.filter(q_filter)
+        matching_ids_sql, params = strain_search.fts_search_sql(query, fields)
         return self.filter(
-            Q(formatted_wja__icontains=query) |
-            Q(description__icontains=query) |
-            Q(phenotype__icontains=query) |
-            Q(genotype__icontains=query) |
-            Q(source__icontains=query) |
-            Q(additional_comments__icontains=query)
-            # Add other fields as needed
-        )
+            pk__in=RawSQL(matching_ids_sql, params)
+        ).annotate(
+            search_rank=strain_search.SearchRank(params[0])
+        ).order_by('search_rank', 'wja')
+
+
+class TubeCounterModel(models.Model):
+    """
+    Stores how many tubes point at this object, so list pages don't have to run a
+    COUNT query per row. Tube.save(), the Tube post_delete signal and TubeQuerySet
+    (update/bulk_create) keep these in sync; `python manage.py recount_tubes` repairs any drift.
+    """
+    active_tube_counter = models.IntegerField(default=0, editable=False)
+    total_tube_counter = models.IntegerField(default=0, editable=False)
+
+    TUBE_COUNTER_FIELDS = ('active_tube_counter', 'total_tube_counter')
+    tube_fk_name = None  # The name of the ForeignKey on Tube that points at this model
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # The counters are only ever changed with F() updates, so don't let a (possibly stale)
+        # in-memory copy overwrite them when the rest of the object is saved.
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.TUBE_COUNTER_FIELDS]
+        super().save(*args, **kwargs)
+
+    def active_tubes_count(self):
+        return self.active_tube_counter
+
+    def inactive_tubes_count(self):
+        return self.total_tube_counter - self.active_tube_counter
+
+    def total_tubes_count(self):
+        return self.total_tube_counter
+
+    @classmethod
+    def tube_count_subqueries(cls):
+        tubes = Tube.objects.filter(**{cls.tube_fk_name: OuterRef('pk')}).order_by().values(cls.tube_fk_name)
+        active_count = tubes.filter(thawed=False).annotate(tube_count=Count('pk')).values('tube_count')
+        total_count = tubes.annotate(tube_count=Count('pk')).values('tube_count')
+        return (Coalesce(Subquery(active_count), 0),
+                Coalesce(Subquery(total_count), 0))
+
+    @classmethod
+    def recount_tubes(cls, pks=None, chunk_size=500) -> int:
+        """
+        Recomputes the counters from the Tube table, for every row or just the given primary keys.
+        """
+        active_count, total_count = cls.tube_count_subqueries()
+        if pks is None:
+            return cls.objects.update(active_tube_counter=active_count, total_tube_counter=total_count)
+        pks = [pk for pk in set(pks) if pk is not None]
+        updated = 0
+        for start in range(0, len(pks), chunk_size):
+            updated += cls.objects.filter(pk__in=pks[start:start + chunk_size]).update(
+                active_tube_counter=active_count, total_tube_counter=total_count)
+        return updated
+
+    @classmethod
+    def drifted_tube_counters(cls):
+        """
+        Returns the rows whose stored counters don't match the Tube table.
+        """
+        active_count, total_count = cls.tube_count_subqueries()
+        return cls.objects.annotate(
+            actual_active_tubes=active_count, actual_total_tubes=total_count,
+        ).exclude(active_tube_counter=F('actual_active_tubes'), total_tube_counter=F('actual_total_tubes'))
+
+
+class TubeQuerySet(models.QuerySet):
+    # Tube fields that change which counters (see TubeCounterModel) a tube is counted in:
+    COUNTED_FIELDS = {'thawed', 'strain', 'strain_id', 'freeze_group', 'freeze_group_id', 'box', 'box_id'}
+
+    def update(self, **kwargs):
+        if not self.COUNTED_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            if 'thawed' in kwargs and 'position' not in kwargs:
+                # Thawing a tube frees up its slot (see Tube.save), and unthawing one can't give the old slot
+                # back since another tube may have it by now (use slots.assign_missing_positions for a new one):
+                if kwargs['thawed']:
+                    kwargs['position'] = None
+                else:
+                    self.filter(thawed=True).update(position=None)
+            previous_parents = list(self.values_list('strain_id', 'freeze_group_id', 'box_id'))
+            updated = super().update(**kwargs)
+            new_parents = [(_fk_value(kwargs, 'strain'), _fk_value(kwargs, 'freeze_group'), _fk_value(kwargs, 'box'))]
+            recount_tube_parents(previous_parents + new_parents)
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            recount_tube_parents((tube.strain_id, tube.freeze_group_id, tube.box_id) for tube in objs)
+        return objs
+
+
+def _fk_value(update_kwargs, field_name):
+    value = update_kwargs.get(field_name, update_kwargs.get(f'{field_name}_id'))
+    return getattr(value, 'pk', value)
+
+
+def recount_tube_parents(parent_ids):
+    """
+    Takes an iterable of (strain_id, freeze_group_id, box_id) tuples and recounts each of those objects.
+    """
+    strain_ids, freeze_group_ids, box_ids = set(), set(), set()
+    for strain_id, freeze_group_id, box_id in parent_ids:
+        strain_ids.add(strain_id)
+        freeze_group_ids.add(freeze_group_id)
+        box_ids.add(box_id)
+    Strain.recount_tubes(strain_ids)
+    FreezeGroup.recount_tubes(freeze_group_ids)
+    Box.recount_tubes(box_ids)
+    StrainRiskReport.refresh_on_commit(strain_ids)  # The strains' active tube counts may have changed
 
 
 class OpenStrainEditing(models.Model):
@@ -53,7 +190,7 @@ class OpenStrainEditing(models.Model):
         return self.__repr__()
 
 
-class Strain(models.Model):
+class Strain(TubeCounterModel):
     wja = models.IntegerField(unique=True)
     genotype = models.CharField(max_length=255, null=True, blank=True, editable=True)
     date_created = models.DateField(default=timezone.now, editable=True)
@@ -63,10 +200,15 @@ class Strain(models.Model):
     source = models.CharField(max_length=255, null=True, blank=True, editable=True)
     additional_comments = models.TextField(null=True, blank=True, editable=True)
     
-    simp_history = HistoricalRecords()
+    simp_history = HistoricalRecords(excluded_fields=TubeCounterModel.TUBE_COUNTER_FIELDS)
     audit_history = AuditlogHistoryField()
     
     objects = StrainManager()
+    tube_fk_name = 'strain'
+
+    class Meta:
+        # The request forms (to_field_name) and a few views look strains up by their formatted WJA:
+        indexes = [models.Index(fields=['formatted_wja'], name='strain_formatted_wja_idx')]
 
     def get_absolute_url(self):
         return f'/strain_details/{self.wja:0>4}'
@@ -92,21 +234,12 @@ class Strain(models.Model):
     def active_tubes(self):
         return self.tube_set.filter(thawed=False)
 
-    def active_tubes_count(self):
-        return self.active_tubes().count()
-
     def inactive_tubes(self):
         return self.tube_set.filter(thawed=True)
 
-    def inactive_tubes_count(self):
-        return self.inactive_tubes().count()
-
     def total_tubes(self):
         return self.tube_set.all()
 
-    def total_tubes_count(self):
-        return self.total_tubes().count()
-
     def formatted_WJA(self):
         return f'WJA{self.wja:0>4}'
 
@@ -125,11 +258,8 @@ class Strain(models.Model):
         This method returns the owner of the strain based on the ranges of strains that they own.
         :return: The owner of the strain.
         """
-        from profiles.models import StrainRange
-        for strain_range in StrainRange.objects.all():
-            if strain_range.check_if_strain_in_range(self):
-                return strain_range.user_profile
-        return None
+        from profiles.range_index import get_strain_range_index
+        return get_strain_range_index().owner_of(self.wja)
 
     def latest_freeze_group(self):
         return self.freeze_groups.latest('date_created')
@@ -146,6 +276,9 @@ class Tube(models.Model):
     freeze_group = models.ForeignKey('FreezeGroup', on_delete=models.CASCADE, null=True,
                                      related_name='tube_set')
     set_number = models.IntegerField(default=-1)
+    # Which slot of the box (1 to box.capacity, left to right then top to bottom) the tube is in.
+    # Tubes from before we tracked this don't have one (see `python manage.py assign_tube_positions`).
+    position = models.PositiveSmallIntegerField(null=True, blank=True)
     
     thawed = models.BooleanField(default=False)
     date_thawed = models.DateField(null=True, blank=True, editable=True)
@@ -155,8 +288,82 @@ class Tube(models.Model):
     simp_history = HistoricalRecords()
     audit_history = AuditlogHistoryField()
     
+    objects = TubeQuerySet.as_manager()
+    
     class Meta:
         unique_together = ('strain', 'freeze_group', 'box', 'set_number')
+        constraints = [
+            # Thawed tubes give up their position (see save() and TubeQuerySet.update), this is just in case:
+            models.UniqueConstraint(fields=['box', 'position'], condition=Q(thawed=False, position__isnull=False),
+                                    name='unique_active_tube_position'),
+        ]
+        # Almost every tube lookup is "the unthawed tubes of this strain/box/freeze group". Django writes
+        # thawed=False as `NOT thawed` on SQLite, which can't use a (strain, thawed) index past the strain,
+        # so these are partial indexes over just the unthawed tubes instead (SQLite matches the condition):
+        indexes = [
+            models.Index(fields=['strain'], condition=Q(thawed=False), name='tube_unthawed_strain_idx'),
+            models.Index(fields=['box'], condition=Q(thawed=False), name='tube_unthawed_box_idx'),
+            models.Index(fields=['freeze_group'], condition=Q(thawed=False), name='tube_unthawed_freeze_group_idx'),
+        ]
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._counted_state = instance.counter_state()
+        return instance
+    
+    def counter_state(self):
+        """
+        The (strain, freeze_group, box, thawed) values that decide which tube counters this tube is in.
+        Returns None if any of them weren't loaded from the database.
+        """
+        deferred_fields = self.get_deferred_fields()
+        if deferred_fields.intersection({'strain_id', 'freeze_group_id', 'box_id', 'thawed'}):
+            return None
+        return self.strain_id, self.freeze_group_id, self.box_id, self.thawed
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            adding = self._state.adding
+            previous_state = None if adding else getattr(self, '_counted_state', None)
+            if previous_state is not None and previous_state[2] != self.box_id:
+                self.position = None  # Its old slot doesn't mean anything in the new box
+            if self.thawed or (previous_state is not None and previous_state[3]):
+                # Thawed tubes free up their slot for new ones, so an unthawed tube can't have its old one back
+                # either (it may have been handed out since). slots.assign_missing_positions gives it a new one.
+                self.position = None
+            super().save(*args, **kwargs)
+            new_state = self.counter_state()
+            if new_state is None or (previous_state is None and not adding):
+                # We don't know what this tube looked like before, so just recount what it points at now:
+                recount_tube_parents([(self.strain_id, self.freeze_group_id, self.box_id)])
+            elif previous_state != new_state:
+                if previous_state is not None:
+                    self.apply_to_counters(previous_state, -1)
+                self.apply_to_counters(new_state, +1)
+                StrainRiskReport.refresh_on_commit({previous_state[0] if previous_state else None, new_state[0]})
+            self._counted_state = new_state
+    
+    def apply_to_counters(self, state, sign):
+        """
+        Adds (sign=+1) or removes (sign=-1) this tube from the counters of its strain, freeze group and box.
+        Also updates any of those objects that are already cached on this tube, so they don't go stale.
+        """
+        strain_id, freeze_group_id, box_id, thawed = state
+        active_change = 0 if thawed else sign
+        for field_name, model, pk in (('strain', Strain, strain_id),
+                                      ('freeze_group', FreezeGroup, freeze_group_id),
+                                      ('box', Box, box_id)):
+            if pk is None:
+                continue
+            model.objects.filter(pk=pk).update(active_tube_counter=F('active_tube_counter') + active_change,
+                                               total_tube_counter=F('total_tube_counter') + sign)
+            related_field = self._meta.get_field(field_name)
+            if related_field.is_cached(self):
+                related_object = related_field.get_cached_value(self)
+                if related_object is not None and related_object.pk == pk:
+                    related_object.active_tube_counter += active_change
+                    related_object.total_tube_counter += sign
     
     def thawed_state(self):
         return 'Thawed' if self.thawed else 'Frozen'
@@ -185,6 +392,14 @@ class Tube(models.Model):
     def __str__(self):
         return self.__repr__()
 
+    def grid_position(self) -> str:
+        """
+        Where the tube sits in its box, e.g. 'R2C5' (row 2, column 5), or '' if we don't know.
+        """
+        if not (self.box_id and self.position):
+            return ''
+        return Box.grid_label(self.position, self.box.capacity)
+
     def short_repr(self):
         if self.box:
             location_string = f'JA{self.box.dewar:0>2}-Rack{self.box.rack:0>2}-Box{self.box.box:0>4}'
@@ -200,12 +415,15 @@ class Tube(models.Model):
                    f'{location_string}; {cap_color_string})'
 
 
-class Box(models.Model):
+class Box(TubeCounterModel):
     dewar = models.IntegerField()
     rack = models.IntegerField()
     box = models.IntegerField()
-    simp_history = HistoricalRecords()
+    capacity = models.PositiveSmallIntegerField(default=TUBES_PER_BOX)  # Number of tube slots
+    simp_history = HistoricalRecords(excluded_fields=TubeCounterModel.TUBE_COUNTER_FIELDS)
     audit_history = AuditlogHistoryField()
+    
+    tube_fk_name = 'box'
 
     class Meta:
         unique_together = ('dewar', 'rack', 'box')
@@ -218,8 +436,10 @@ class Box(models.Model):
         return f'JA{self.dewar:0>2}-R{self.rack:0>2}-B{self.box:0>2}'
     
     def __repr__(self):
-        is_default = 'Active' if self.is_default_box() else ''
-        return f'{is_default}Box({self.short_pos_repr()}; {self.get_usage_str()})'
+        return self.usage_repr(is_default=self.is_default_box())
+
+    def usage_repr(self, is_default: bool):
+        return f'{"Active" if is_default else ""}Box({self.short_pos_repr()}; {self.get_usage_str()})'
 
     def repr(self):
         return self.__repr__()
@@ -230,11 +450,32 @@ class Box(models.Model):
     def get_active_tubes(self):
         return self.tube_set.filter(thawed=False)
     
-    def get_usage_str(self, max_tubes_per_box=81):
-        return f'{self.get_active_tubes().count():0>2}/{max_tubes_per_box}'
+    def get_usage_str(self, max_tubes_per_box=None):
+        return f'{self.active_tubes_count():0>2}/{max_tubes_per_box or self.capacity}'
     
-    def is_full(self, max_tubes_per_box=81) -> bool:
-        return self.get_active_tubes().count() >= max_tubes_per_box
+    def is_full(self, max_tubes_per_box=None) -> bool:
+        return self.active_tubes_count() >= (max_tubes_per_box or self.capacity)
+
+    def free_slots_count(self) -> int:
+        return max(self.capacity - self.active_tubes_count(), 0)
+
+    @property
+    def grid_columns(self) -> int:
+        return self.columns_for_capacity(self.capacity)
+
+    @staticmethod
+    def columns_for_capacity(capacity: int) -> int:
+        # Boxes are square grids (9x9 for 81 tubes), anything else is treated as rows of 9
+        columns = math.isqrt(capacity)
+        return columns if columns * columns == capacity else 9
+
+    @classmethod
+    def grid_label(cls, position: int, capacity: int) -> str:
+        """
+        'R2C5' style label for a slot position, without needing the Box itself (e.g. for exports).
+        """
+        row, column = divmod(position - 1, cls.columns_for_capacity(capacity))
+        return f'R{row + 1}C{column + 1}'
 
 
 class DefaultBox(models.Model):
@@ -270,7 +511,7 @@ class DefaultBox(models.Model):
         return self.__repr__()
 
 
-class FreezeGroup(models.Model):
+class FreezeGroup(TubeCounterModel):
     date_created = models.DateField(default=timezone.now, editable=True)
     date_stored = models.DateField(null=True)
     strain = models.ForeignKey('Strain', on_delete=models.CASCADE,
@@ -291,11 +532,21 @@ class FreezeGroup(models.Model):
     
     freeze_request = models.OneToOneField('FreezeRequest', on_delete=models.CASCADE, null=True, blank=True)
     
-    simp_history = HistoricalRecords()
+    simp_history = HistoricalRecords(excluded_fields=TubeCounterModel.TUBE_COUNTER_FIELDS)
     audit_history = AuditlogHistoryField()
+    
+    tube_fk_name = 'freeze_group'
 
-    # class Meta:
-    #     unique_together = ('strain', 'date_stored')
+    class Meta:
+        # unique_together = ('strain', 'date_stored')
+        # For "the latest passed/failed freeze of each strain" (FreezeRequestQuerySet.with_refreeze_flag),
+        # partial for the same reason as Tube's, and by date so the ORDER BY ... LIMIT 1 is just a seek:
+        indexes = [
+            models.Index(fields=['strain', 'date_created'], condition=Q(passed_test=True),
+                         name='freezegroup_passed_idx'),
+            models.Index(fields=['strain', 'date_created'], condition=Q(passed_test=False),
+                         name='freezegroup_failed_idx'),
+        ]
 
     def __repr__(self):
         return f"FreezeGroup(ID-{self.id if self.id else 'xxxx':0>6}, Strain-{self.strain.formatted_wja}, " \
@@ -310,20 +561,11 @@ class FreezeGroup(models.Model):
     def active_tubes(self):
         return self.tube_set.filter(thawed=False)
 
-    def active_tubes_count(self):
-        return self.active_tubes().count()
-
     def inactive_tubes(self):
         return self.tube_set.filter(thawed=True)
 
-    def inactive_tubes_count(self):
-        return self.inactive_tubes().count()
-
     def total_tubes(self):
         return self.tube_set.all()
-
-    def total_tubes_count(self):
-        return self.total_tubes().count()
     
     # Turns out we don't need this!
     # def create_tubes_from_request(self):
@@ -375,6 +617,14 @@ class ThawRequest(models.Model):
     
     objects = ThawRequestManager()
 
+    class Meta:
+        constraints = [
+            # An ongoing request's tube is reserved for it (see thaw_reservations.py):
+            models.UniqueConstraint(fields=['tube'], condition=Q(status='O'),
+                                    name='unique_ongoing_thaw_tube'),
+        ]
+        indexes = [models.Index(fields=['status'], name='thawrequest_status_idx')]
+
     def __repr__(self):
         return f'ThawRequest(ID-{self.id:0>6}, Strain-{self.strain.formatted_WJA()}, ' \
                f'Tube-{self.tube.strain.wja if self.tube else "NotYetAssigned"}, ' \
@@ -389,7 +639,33 @@ class ThawRequest(models.Model):
         return self.__repr__()
 
 
-class FreezeRequestManager(models.Manager):
+class FreezeRequestQuerySet(models.QuerySet):
+    def with_refreeze_flag(self, days=365):
+        """
+        Annotates each request with `is_refreeze`: True if its strain has had a failed freeze in the
+        last `days` days that wasn't followed by a successful one. This is done with two correlated
+        subqueries (latest failure vs. latest success), so it costs nothing extra per row.
+        """
+        since = timezone.now().date() - timezone.timedelta(days=days)
+        recent_freeze_groups = FreezeGroup.objects.filter(
+            strain=OuterRef('strain'),
+            date_created__gte=since,
+        ).order_by('-date_created').values('date_created')
+        return self.annotate(
+            latest_failed_freeze=Subquery(recent_freeze_groups.filter(passed_test=False)[:1]),
+            latest_successful_freeze=Subquery(recent_freeze_groups.filter(passed_test=True)[:1]),
+        ).annotate(
+            is_refreeze=Case(
+                When(latest_failed_freeze__isnull=True, then=Value(False)),
+                When(latest_successful_freeze__isnull=True, then=Value(True)),
+                When(latest_failed_freeze__gt=F('latest_successful_freeze'), then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            )
+        )
+
+
+class FreezeRequestManager(models.Manager.from_queryset(FreezeRequestQuerySet)):
     def get_by_natural_key(self, wja):
         return self.get(wja=wja)
 
@@ -443,6 +719,9 @@ class FreezeRequest(models.Model):
     
     objects = FreezeRequestManager()
 
+    class Meta:
+        indexes = [models.Index(fields=['status'], name='freezerequest_status_idx')]
+
     def advance_to_testing(self):
         self.status = 'A'
         self.date_advanced = timezone.now()
@@ -461,42 +740,186 @@ class FreezeRequest(models.Model):
         return self.__repr__()
     
     def strain_recently_failed_freeze(self, days=365):
-        failed_freezes = FreezeGroup.objects.filter(
-            strain=self.strain,
-            passed_test=False,
-            date_created__gte=timezone.now() - timezone.timedelta(days=days),
-        )
-        successful_freezes = FreezeGroup.objects.filter(
-            strain=self.strain,
-            passed_test=True,
-            date_created__gte=timezone.now() - timezone.timedelta(days=days),
-        )
-        # Now we need to return True if:
-        #  1. There was >=1 fail and no successes
-        #  2. The most recent fail was more recent than the most recent success
-        if failed_freezes.count() > 0 and successful_freezes.count() == 0:
-            print(f'The strain targeted by FreezeRequest({self.id}) [{self.strain.formatted_wja}] '
-                  f'has recently failed a freeze request.')
-            return True
-        elif failed_freezes.count() > 0 and successful_freezes.count() > 0:
-            latest_fail = failed_freezes.latest('date_created')
-            latest_success = successful_freezes.latest('date_created')
-            if latest_fail.date_created > latest_success.date_created:
-                print(f'The strain targeted by FreezeRequest({self.id}) [{self.strain.formatted_wja}] '
-                      f'was recently attempted to be frozen but it failed. '
-                      f'There is a successful freeze request but that was '
-                      f'before the failed attempt.')
-                return True
-            else:
-                print(f'The strain targeted by FreezeRequest({self.id}) [{self.strain.formatted_wja}] '
-                      f'was recently attempted to be frozen but it failed. '
-                      f'There is a successful freeze request and that was '
-                      f'more recent than the failed attempt.')
-                return False
-        else:
-            print(f"The strain targeted by FreezeRequest({self.id}) [{self.strain.formatted_wja}] "
-                  f"has not been the target of any recent freeze requests that have failed.")
-            return False
+        """
+        True if the strain targeted by this request has failed a freeze in the last `days` days, with no
+        successful freeze since. For whole tables use FreezeRequest.objects.with_refreeze_flag() instead.
+        """
+        return FreezeRequest.objects.with_refreeze_flag(days).values_list('is_refreeze', flat=True).get(pk=self.pk)
     
     def is_a_refreeze(self):
+        if hasattr(self, 'is_refreeze'):  # Already annotated by with_refreeze_flag()
+            return self.is_refreeze
         return self.strain_recently_failed_freeze()
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be sent. Views and forms queue these (inside their own transaction)
+    instead of talking to the SMTP server during the request, and the send_queued_emails
+    management command delivers them. See outbox.py.
+    """
+    STATUS_CHOICES = (
+        ('P', 'Pending'),
+        ('S', 'Sent'),
+        ('D', 'Dead'),  # Gave up after EMAIL_MAX_SEND_ATTEMPTS failures
+    )
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='P')
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    def __repr__(self):
+        return f'OutboxEmail(ID-{self.id if self.id else "xxxx":0>6}, {self.get_status_display()}, ' \
+               f'Subject-"{self.subject}", To-{", ".join(self.to) if self.to else "Nobody"})'
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class StrainRiskReport(models.Model):
+    """
+    The precomputed "scary stuff" report: one row for each strain we are at risk of losing, because
+    it has no freezes at all, its most recent freeze failed its test (untested ones don't count yet), or it is
+    down to TUBE_REMAINING_THRESHOLD active tubes or fewer. Strains that are fine don't get a row.
+
+    Rows are refreshed for just the affected strains whenever a Strain is created or a FreezeGroup/Tube
+    changes (see signals.py, Tube.save() and recount_tube_parents). Those only queue the strains up with
+    refresh_on_commit(), so however many tubes a transaction saves, its strains are refreshed once, when
+    it commits. Bulk changes that skip all of that can be fixed with `python manage.py refresh_risk_report`.
+    """
+    strain = models.OneToOneField('Strain', on_delete=models.CASCADE, primary_key=True,
+                                  related_name='risk_report')
+    no_freezes = models.BooleanField(default=False)
+    latest_freeze_failed = models.BooleanField(default=False)
+    low_tubes = models.BooleanField(default=False)
+    active_tubes = models.IntegerField(default=0)
+    date_refreshed = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def at_risk_strains(strains=None):
+        """
+        Finds the at-risk strains (out of the given Strain queryset, or all of them) in a single query.
+        latest_freeze_passed/latest_freeze_tested are the passed_test/completed_test of each strain's most
+        recent FreezeGroup, or None if it has none.
+        """
+        latest_freezes = FreezeGroup.objects.filter(strain=OuterRef('pk')).order_by('-date_created', '-pk')
+        strains = Strain.objects.all() if strains is None else strains
+        return strains.annotate(
+            latest_freeze_passed=Subquery(latest_freezes.values('passed_test')[:1]),
+            latest_freeze_tested=Subquery(latest_freezes.values('completed_test')[:1]),
+        ).filter(
+            Q(latest_freeze_passed__isnull=True) | Q(latest_freeze_tested=True, latest_freeze_passed=False)
+            | Q(active_tube_counter__lte=TUBE_REMAINING_THRESHOLD)
+        )
+
+    @classmethod
+    def build_reports(cls, strains=None):
+        return [cls(strain_id=pk,
+                    no_freezes=latest_freeze_passed is None,
+                    latest_freeze_failed=bool(latest_freeze_tested) and latest_freeze_passed is False,
+                    low_tubes=active_tubes <= TUBE_REMAINING_THRESHOLD,
+                    active_tubes=active_tubes)
+                for pk, latest_freeze_passed, latest_freeze_tested, active_tubes in
+                cls.at_risk_strains(strains).values_list(
+                    'pk', 'latest_freeze_passed', 'latest_freeze_tested', 'active_tube_counter')]
+
+    @classmethod
+    def refresh(cls, strain_ids=None, chunk_size=500) -> int:
+        """
+        Rebuilds the report for every strain, or just the given strain primary keys.
+        :return: How many of those strains are at risk.
+        """
+        with transaction.atomic():
+            if strain_ids is None:
+                cls.objects.all().delete()
+                return len(cls.objects.bulk_create(cls.build_reports(), batch_size=chunk_size))
+            strain_ids = [pk for pk in set(strain_ids) if pk is not None]
+            at_risk = 0
+            for start in range(0, len(strain_ids), chunk_size):
+                chunk = strain_ids[start:start + chunk_size]
+                cls.objects.filter(strain_id__in=chunk).delete()
+                at_risk += len(cls.objects.bulk_create(cls.build_reports(Strain.objects.filter(pk__in=chunk))))
+            return at_risk
+
+    @classmethod
+    def refresh_on_commit(cls, strain_ids, using=None):
+        """
+        Queues these strain primary keys up to be refreshed (with a single refresh() for all of them)
+        once the current transaction commits, or straight away if we aren't in one.
+        """
+        connection = transaction.get_connection(using)
+        pending_refresh = getattr(connection, 'pending_risk_report_refresh', None)
+        # (If the transaction or savepoint it was queued in was rolled back, it isn't coming, so start a new one)
+        if pending_refresh is not None and any(hook[1] is pending_refresh for hook in connection.run_on_commit):
+            pending_refresh.strain_ids.update(strain_ids)
+            return
+
+        def pending_refresh():
+            connection.pending_risk_report_refresh = None
+            cls.refresh(pending_refresh.strain_ids)
+        pending_refresh.strain_ids = set(strain_ids)
+        connection.pending_risk_report_refresh = pending_refresh
+        transaction.on_commit(pending_refresh, using=using)
+
+    def __repr__(self):
+        return f'StrainRiskReport(Strain-{self.strain_id}, NoFreezes-{self.no_freezes}, ' \
+               f'LatestFreezeFailed-{self.latest_freeze_failed}, ActiveTubes-{self.active_tubes})'
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class StrainUploadBatch(models.Model):
+    """
+    A pasted bulk strain upload that is waiting to be reviewed and saved, one StagedStrain per line
+    (see strain_staging.py). These used to live in the session, which got read and written back on every
+    request while someone reviewed a few thousand lines. A batch is deleted once it's saved or discarded.
+    """
+    uploaded_by = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='strain_upload_batches')
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __repr__(self):
+        return f'StrainUploadBatch(ID-{self.id if self.id else "xxxx":0>6}, UploadedBy-{self.uploaded_by}, ' \
+               f'DateCreated-{self.date_created.strftime("%m/%d/%Y") if self.date_created else "N/A"})'
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class StagedStrain(models.Model):
+    """
+    One line of a StrainUploadBatch: the strain it will become, and what was wrong with it (or just
+    worth a second look) the last time it was validated. The text is kept as pasted (no length limits), the validation catches that.
+    """
+    batch = models.ForeignKey('StrainUploadBatch', on_delete=models.CASCADE, related_name='rows')
+    line_number = models.IntegerField()
+    wja = models.IntegerField(null=True, blank=True)
+    genotype = models.TextField(blank=True, default='')
+    phenotype = models.TextField(blank=True, default='')
+    source = models.TextField(blank=True, default='')
+    description = models.TextField(blank=True, default='')
+    additional_comments = models.TextField(blank=True, default='')
+    is_valid = models.BooleanField(default=False)
+    errors = models.JSONField(default=dict, blank=True)  # {field name: [messages]}
+    warnings = models.JSONField(default=list, blank=True)  # [messages], these don't stop it from being saved
+
+    class Meta:
+        ordering = ['line_number']
+        constraints = [models.UniqueConstraint(fields=['batch', 'line_number'], name='unique_staged_strain_line')]
+        indexes = [models.Index(fields=['batch', 'is_valid'], name='stagedstrain_batch_valid_idx')]
+
+    def __repr__(self):
+        return f'StagedStrain(Batch-{self.batch_id}, Line-{self.line_number}, WJA-{self.wja}, Valid-{self.is_valid})'
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,97 @@
+"""
+Outbox for the freeze/thaw notification emails.
+
+Sending email during a request means a slow SMTP handshake holds up the whole formset POST
+(and, since most of our saves happen in transaction.atomic(), the SQLite write lock too).
+Instead we write an OutboxEmail row in the same transaction as the change it's about, and the
+worker (python manage.py send_queued_emails) sends them over a single reused SMTP connection,
+retrying with exponential backoff and eventually giving up ("dead").
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from hardcoded import EMAIL_MAX_SEND_ATTEMPTS, EMAIL_RETRY_BASE_DELAY
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+
+def queue_email(subject, body, to, cc=None, from_email=None) -> OutboxEmail:
+    """
+    Queues an email to be sent by the worker. Call this inside the transaction that
+    makes the change the email is about, so the email only exists if that change commits.
+    """
+    outbox_email = OutboxEmail.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(to),
+        cc=list(cc or []),
+    )
+    logger.info(f'Queued email #{outbox_email.id} "{subject}" to {list(to)} (cc: {list(cc or [])}).')
+    return outbox_email
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=EMAIL_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+
+
+def _record_failure(outbox_email: OutboxEmail, error: Exception, max_attempts: int):
+    outbox_email.last_error = f'{type(error).__name__}: {error}'
+    if outbox_email.attempts >= max_attempts:
+        outbox_email.status = 'D'
+        logger.error(f'Giving up on email #{outbox_email.id} after '
+                     f'{outbox_email.attempts} attempts: {outbox_email.last_error}')
+    else:
+        outbox_email.next_attempt = timezone.now() + retry_delay(outbox_email.attempts)
+        logger.warning(f'Email #{outbox_email.id} failed (attempt {outbox_email.attempts}), '
+                       f'retrying at {outbox_email.next_attempt}: {outbox_email.last_error}')
+
+
+def deliver_queued_emails(batch_size=50, max_attempts=EMAIL_MAX_SEND_ATTEMPTS, connection=None):
+    """
+    Sends every pending email that is due, using one connection for the whole batch. If the
+    connection can't even be opened (SMTP server down, bad login...), that counts as a failed
+    attempt for every email in the batch, so they back off like any other failure.
+    Returns a (sent, failed) tuple of counts.
+    """
+    due_emails = list(OutboxEmail.objects.filter(
+        status='P', next_attempt__lte=timezone.now(),
+    ).order_by('next_attempt', 'id')[:batch_size])
+    if not due_emails:
+        return 0, 0
+
+    update_fields = ['attempts', 'status', 'last_error', 'next_attempt', 'date_sent']
+    sent = failed = 0
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        for outbox_email in due_emails:
+            outbox_email.attempts += 1
+            _record_failure(outbox_email, error, max_attempts)
+        OutboxEmail.objects.bulk_update(due_emails, update_fields)
+        return 0, len(due_emails)
+    try:
+        for outbox_email in due_emails:
+            message = EmailMessage(outbox_email.subject, outbox_email.body, outbox_email.from_email,
+                                   outbox_email.to, cc=outbox_email.cc, connection=connection)
+            outbox_email.attempts += 1
+            try:
+                message.send()
+            except Exception as error:
+                failed += 1
+                _record_failure(outbox_email, error, max_attempts)
+            else:
+                sent += 1
+                outbox_email.status = 'S'
+                outbox_email.date_sent = timezone.now()
+                outbox_email.last_error = None
+            outbox_email.save(update_fields=update_fields)
+    finally:
+        connection.close()
+    return sent, failed
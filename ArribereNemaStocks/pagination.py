@@ -0,0 +1,164 @@
+"""
+Pagination helpers for the strain datatable.
+
+The default django-tables2 paginator uses OFFSET/LIMIT and a COUNT(*) on every page load, so
+deep pages get slower as the catalog grows. The KeysetPaginator here instead "seeks" to the
+row after (or before) the last one shown, which only touches the rows on the page no matter
+how deep you go. Total counts are cached per query so they don't get recomputed on every page.
+"""
+import hashlib
+from datetime import date
+from typing import List, Optional, Tuple
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+STRAIN_COUNT_CACHE_TIMEOUT = 5 * 60  # seconds
+STRAIN_COUNT_VERSION_KEY = 'strain_count_version'
+
+# Maps the StrainTable "sort" parameter to the model fields we can seek on. Every key ends
+# with wja, which is unique, so there are never ties between pages.
+STRAIN_KEYSET_SORTS = {
+    'formatted_wja': ('wja',),
+    'date_created': ('date_created', 'wja'),
+}
+
+
+def bump_strain_count_version():
+    """
+    Invalidates every cached strain count (called from signals when strains are added or removed).
+    """
+    try:
+        cache.incr(STRAIN_COUNT_VERSION_KEY)
+    except ValueError:
+        cache.set(STRAIN_COUNT_VERSION_KEY, 1, timeout=None)
+
+
+def cached_count(queryset) -> int:
+    """
+    Returns queryset.count(), reusing the result for identical queries until the strain table changes
+    (or STRAIN_COUNT_CACHE_TIMEOUT passes, which covers bulk paths that skip signals).
+    There's no CACHES setting, so this is Django's default per-process memory cache: a strain added or
+    deleted through one gunicorn worker only bumps that worker's version, and the others can keep
+    showing the old count for up to STRAIN_COUNT_CACHE_TIMEOUT. Fine for a page count, but don't rely
+    on it for anything that has to be exact.
+    """
+    version = cache.get_or_set(STRAIN_COUNT_VERSION_KEY, 0, timeout=None)
+    query_hash = hashlib.md5(str(queryset.query).encode()).hexdigest()
+    cache_key = f'strain_count:{version}:{query_hash}'
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, timeout=STRAIN_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A regular page-number paginator that can be handed a pre-computed (cached) count.
+    django-tables2 passes extra paginate={...} options through, e.g. paginate={'count': 42}.
+    """
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self._known_count = count
+
+    @property
+    def count(self):
+        if self._known_count is None:
+            self._known_count = super().count
+        return self._known_count
+
+
+class KeysetPage:
+    def __init__(self, object_list: List, next_cursor: Optional[str], previous_cursor: Optional[str]):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Seek (keyset) pagination over a queryset, ordered by one of STRAIN_KEYSET_SORTS.
+
+    Cursors are the sort key values of the first/last row on a page joined with '~',
+    for example '0153' for a wja sort or '2024-01-05~153' for a date_created sort.
+    """
+    CURSOR_SEPARATOR = '~'
+
+    def __init__(self, queryset, sort: str, per_page: int):
+        self.descending = sort.startswith('-')
+        self.sort = sort.lstrip('-')
+        self.fields = STRAIN_KEYSET_SORTS[self.sort]
+        self.queryset = queryset
+        self.per_page = per_page
+
+    @classmethod
+    def supports(cls, sort: str) -> bool:
+        return sort.lstrip('-') in STRAIN_KEYSET_SORTS
+
+    def _order_by(self, reverse: bool) -> List[str]:
+        descending = self.descending != reverse
+        return [f'-{field}' if descending else field for field in self.fields]
+
+    def _encode_cursor(self, obj) -> str:
+        values = []
+        for field in self.fields:
+            value = getattr(obj, field)
+            values.append(value.isoformat() if isinstance(value, date) else str(value))
+        return self.CURSOR_SEPARATOR.join(values)
+
+    def _decode_cursor(self, cursor: str) -> Optional[Tuple]:
+        parts = cursor.split(self.CURSOR_SEPARATOR)
+        if len(parts) != len(self.fields):
+            return None
+        try:
+            return tuple(date.fromisoformat(part) if field == 'date_created' else int(part)
+                         for field, part in zip(self.fields, parts))
+        except ValueError:
+            return None
+
+    def _seek_filter(self, values: Tuple, forwards: bool) -> Q:
+        """
+        Builds the row-value comparison (a, b) > (x, y) as: a > x OR (a = x AND b > y).
+        """
+        greater = forwards != self.descending
+        lookup = 'gt' if greater else 'lt'
+        seek_filter = Q()
+        for index, field in enumerate(self.fields):
+            equal_prefix = {prefix_field: values[i] for i, prefix_field in enumerate(self.fields[:index])}
+            seek_filter |= Q(**equal_prefix, **{f'{field}__{lookup}': values[index]})
+        return seek_filter
+
+    def page(self, after: Optional[str] = None, before: Optional[str] = None) -> KeysetPage:
+        after_values = self._decode_cursor(after) if after else None
+        before_values = self._decode_cursor(before) if before else None
+
+        if before_values is not None:
+            # Walk backwards from the cursor, then flip the rows back into display order:
+            rows = list(self.queryset.filter(self._seek_filter(before_values, forwards=False))
+                        .order_by(*self._order_by(reverse=True))[:self.per_page + 1])
+            has_more_before = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            previous_cursor = self._encode_cursor(rows[0]) if rows and has_more_before else None
+            next_cursor = self._encode_cursor(rows[-1]) if rows else None
+            return KeysetPage(rows, next_cursor, previous_cursor)
+
+        queryset = self.queryset
+        if after_values is not None:
+            queryset = queryset.filter(self._seek_filter(after_values, forwards=True))
+        rows = list(queryset.order_by(*self._order_by(reverse=False))[:self.per_page + 1])
+        has_more_after = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        next_cursor = self._encode_cursor(rows[-1]) if rows and has_more_after else None
+        previous_cursor = self._encode_cursor(rows[0]) if rows and after_values is not None else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,128 @@
+"""
+Full-text search over strains, backed by an SQLite FTS5 virtual table.
+
+The index is an "external content" FTS5 table that points at the Strain table, so it
+only stores the search structures (not a second copy of the strain text). It is kept in
+sync by triggers on the Strain table, which means bulk_create and queryset.update() keep it
+current too. We use the trigram tokenizer so that matching behaves like the old icontains
+filters did (substring, case-insensitive), just without scanning every row.
+
+If the index is ever suspected to be out of sync it can be rebuilt with:
+    python manage.py rebuild_strain_search_index
+"""
+from django.db import connection as default_connection
+from django.db.models import F, FloatField, Func
+
+STRAIN_TABLE = 'ArribereNemaStocks_strain'
+STRAIN_FTS_TABLE = 'ArribereNemaStocks_strain_fts'
+
+# Fields used by StrainManager.search() and StrainManager.deep_search() respectively:
+SEARCH_FIELDS = ('formatted_wja', 'phenotype', 'genotype')
+DEEP_SEARCH_FIELDS = ('formatted_wja', 'description', 'phenotype', 'genotype', 'source', 'additional_comments')
+
+# The trigram tokenizer can't match anything shorter than this, so shorter queries fall back to icontains:
+MIN_FTS_QUERY_LENGTH = 3
+
+_FTS_COLUMNS = ', '.join(DEEP_SEARCH_FIELDS)
+_NEW_VALUES = ', '.join(f'new.{field}' for field in DEEP_SEARCH_FIELDS)
+_OLD_VALUES = ', '.join(f'old.{field}' for field in DEEP_SEARCH_FIELDS)
+
+CREATE_FTS_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {STRAIN_FTS_TABLE} USING fts5("
+    f"{_FTS_COLUMNS}, content='{STRAIN_TABLE}', content_rowid='id', tokenize='trigram')"
+)
+CREATE_TRIGGERS_SQL = (
+    f"CREATE TRIGGER IF NOT EXISTS {STRAIN_FTS_TABLE}_ai AFTER INSERT ON {STRAIN_TABLE} BEGIN "
+    f"INSERT INTO {STRAIN_FTS_TABLE}(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_NEW_VALUES}); "
+    f"END",
+    f"CREATE TRIGGER IF NOT EXISTS {STRAIN_FTS_TABLE}_ad AFTER DELETE ON {STRAIN_TABLE} BEGIN "
+    f"INSERT INTO {STRAIN_FTS_TABLE}({STRAIN_FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_OLD_VALUES}); "
+    f"END",
+    f"CREATE TRIGGER IF NOT EXISTS {STRAIN_FTS_TABLE}_au AFTER UPDATE ON {STRAIN_TABLE} BEGIN "
+    f"INSERT INTO {STRAIN_FTS_TABLE}({STRAIN_FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_OLD_VALUES}); "
+    f"INSERT INTO {STRAIN_FTS_TABLE}(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_NEW_VALUES}); "
+    f"END",
+)
+DROP_SQL = (
+    f"DROP TRIGGER IF EXISTS {STRAIN_FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {STRAIN_FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {STRAIN_FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {STRAIN_FTS_TABLE}",
+)
+
+
+def search_index_available(connection=default_connection) -> bool:
+    return connection.vendor == 'sqlite'
+
+
+def install_strain_search_index(connection=default_connection, rebuild=False):
+    """
+    Creates the FTS5 table and its triggers if they don't already exist. This is safe to call
+    repeatedly, and it is re-run after every migrate because SQLite table rebuilds (which Django
+    does for a lot of schema changes) drop any triggers that were attached to the old table.
+    """
+    if not search_index_available(connection):
+        return
+    with connection.cursor() as cursor:
+        already_existed = STRAIN_FTS_TABLE in connection.introspection.table_names(cursor)
+        cursor.execute(CREATE_FTS_TABLE_SQL)
+        for trigger_sql in CREATE_TRIGGERS_SQL:
+            cursor.execute(trigger_sql)
+    if rebuild or not already_existed:
+        rebuild_strain_search_index(connection)
+
+
+def remove_strain_search_index(connection=default_connection):
+    if not search_index_available(connection):
+        return
+    with connection.cursor() as cursor:
+        for drop_sql in DROP_SQL:
+            cursor.execute(drop_sql)
+
+
+def rebuild_strain_search_index(connection=default_connection):
+    """
+    Throws away the FTS5 index contents and re-reads everything from the Strain table.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {STRAIN_FTS_TABLE}({STRAIN_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def fts_match_expression(query: str, fields=SEARCH_FIELDS) -> str:
+    """
+    Turns a user's search string into an FTS5 MATCH expression limited to the given columns.
+    The whole query is treated as one quoted phrase, which (with the trigram tokenizer) gives
+    us the same "is this a substring" behavior that icontains had.
+    """
+    escaped_query = query.strip().replace('"', '""')
+    return f'{{{" ".join(fields)}}} : "{escaped_query}"'
+
+
+def fts_search_sql(query: str, fields=SEARCH_FIELDS):
+    """
+    Returns (matching_ids_sql, params) for use with RawSQL in the StrainManager, and the MATCH
+    expression to rank the results with (see SearchRank).
+    """
+    match_expression = fts_match_expression(query, fields)
+    matching_ids_sql = f'SELECT rowid FROM {STRAIN_FTS_TABLE} WHERE {STRAIN_FTS_TABLE} MATCH %s'
+    return matching_ids_sql, (match_expression,)
+
+
+class SearchRank(Func):
+    """
+    How well each strain matches an FTS5 MATCH expression, as a correlated subquery on the index.
+    bm25() gives lower (more negative) numbers to better matches, so sort ascending. The strain's id
+    is compiled like any other column, so this still works when the strain table gets an alias
+    (e.g. when the search is used as a subquery).
+    """
+    output_field = FloatField()
+
+    def __init__(self, match_expression: str):
+        super().__init__(F('pk'))
+        self.match_expression = match_expression
+
+    def as_sql(self, compiler, connection, **extra_context):
+        pk_sql, pk_params = compiler.compile(self.source_expressions[0])
+        sql = (f'(SELECT bm25({STRAIN_FTS_TABLE}) FROM {STRAIN_FTS_TABLE} '
+               f'WHERE {STRAIN_FTS_TABLE}.rowid = {pk_sql} AND {STRAIN_FTS_TABLE} MATCH %s)')
+        return sql, (*pk_params, self.match_expression)
@@ -0,0 +1,43 @@
+"""
+Remembering which freeze/thaw requests were picked on the outstanding requests pages.
+
+The confirmation pages used to get the picked requests' IDs in the URL (requests=00001&00002&...),
+which gets long fast with "advance all" and runs into URL length limits with a few hundred requests.
+Now the IDs are kept in the user's session, and the URL only carries a short random token for them.
+"""
+import secrets
+from typing import Iterable, List, Optional
+
+from hardcoded import MAX_SAVED_SELECTIONS
+
+SESSION_KEY = 'request_selections'
+
+
+def save_selection(session, kind: str, pks: Iterable[int]) -> str:
+    """
+    Stores these pks in the session and returns the token to get them back with.
+    :param kind: What the pks are of (like 'thaw_request'), so a token can't be used on the wrong page
+    """
+    token = secrets.token_urlsafe(8)
+    selections = session.get(SESSION_KEY, {})
+    selections[token] = {'kind': kind, 'pks': [int(pk) for pk in pks]}
+    while len(selections) > MAX_SAVED_SELECTIONS:
+        selections.pop(next(iter(selections)))  # Oldest first, dicts keep their order
+    session[SESSION_KEY] = selections
+    return token
+
+
+def load_selection(session, kind: str, token: str) -> Optional[List[int]]:
+    """
+    The pks saved with this token, or None if it's unknown (e.g. from another session) or expired.
+    """
+    selection = session.get(SESSION_KEY, {}).get(token)
+    if not selection or selection['kind'] != kind:
+        return None
+    return selection['pks']
+
+
+def discard_selection(session, token: str):
+    selections = session.get(SESSION_KEY, {})
+    if selections.pop(token, None) is not None:
+        session[SESSION_KEY] = selections
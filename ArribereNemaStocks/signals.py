@@ -0,0 +1,41 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Strain, Tube, FreezeGroup, OpenStrainEditing, StrainRiskReport
+from .pagination import bump_strain_count_version
+from .site_settings import invalidate_site_settings
+from profiles.models import OpenRegistration
+
+
+@receiver(post_save, sender=Strain)
+@receiver(post_delete, sender=Strain)
+def invalidate_strain_counts(sender, **kwargs):
+    bump_strain_count_version()
+
+
+@receiver(post_save, sender=Strain)
+def add_new_strain_to_risk_report(sender, instance, created, **kwargs):
+    if created:
+        StrainRiskReport.refresh_on_commit([instance.pk])  # It won't have any freezes yet
+
+
+@receiver(post_save, sender=FreezeGroup)
+@receiver(post_delete, sender=FreezeGroup)
+def refresh_freeze_group_strain_risk(sender, instance, **kwargs):
+    StrainRiskReport.refresh_on_commit([instance.strain_id])
+
+
+@receiver(post_save, sender=OpenRegistration)
+@receiver(post_delete, sender=OpenRegistration)
+@receiver(post_save, sender=OpenStrainEditing)
+@receiver(post_delete, sender=OpenStrainEditing)
+def site_settings_changed(sender, **kwargs):
+    invalidate_site_settings()
+
+
+@receiver(post_delete, sender=Tube)
+def remove_deleted_tube_from_counters(sender, instance, **kwargs):
+    counted_state = getattr(instance, '_counted_state', None) or instance.counter_state()
+    if counted_state is not None:
+        instance.apply_to_counters(counted_state, -1)
+    StrainRiskReport.refresh_on_commit([instance.strain_id])
@@ -0,0 +1,60 @@
+"""
+Cached access to the site-wide settings rows (OpenRegistration and OpenStrainEditing).
+
+These are single-row tables that get read on lots of requests but only ever changed from the admin,
+so we keep them in memory. The cache is cleared by signals (see signals.py) whenever either is saved
+or deleted, and also expires after SITE_SETTINGS_MAX_AGE seconds so that other gunicorn workers
+pick up changes too. Templates can use {{ site_settings }} (see context_processors.py).
+"""
+import time
+
+SITE_SETTINGS_MAX_AGE = 60  # seconds
+
+_cached_settings = None
+_cached_settings_time = 0.0
+
+
+class SiteSettings:
+    EDIT_ABILITY_STRINGS = {
+        'N': 'closed',
+        'O': 'open for owned strains',
+        'A': 'open for all strains',
+    }
+
+    def __init__(self, registration_is_open: bool, edit_ability: str):
+        self.registration_is_open = registration_is_open
+        self.edit_ability = edit_ability  # One of OpenStrainEditing.editing_levels ('A', 'O' or 'N')
+
+    @property
+    def registration_string(self) -> str:
+        return 'open' if self.registration_is_open else 'closed'
+
+    @property
+    def edit_permissions_string(self) -> str:
+        return self.EDIT_ABILITY_STRINGS.get(self.edit_ability, 'closed')
+
+
+def load_site_settings() -> SiteSettings:
+    """
+    Reads the settings from the database. If either table is empty we fall back to
+    the safe defaults: registration closed and no strain editing.
+    """
+    from profiles.models import OpenRegistration
+    from .models import OpenStrainEditing
+    open_registration = OpenRegistration.objects.first()
+    open_strain_editing = OpenStrainEditing.objects.first()
+    return SiteSettings(registration_is_open=bool(open_registration and open_registration.is_open),
+                        edit_ability=open_strain_editing.edit_ability if open_strain_editing else 'N')
+
+
+def get_site_settings() -> SiteSettings:
+    global _cached_settings, _cached_settings_time
+    if _cached_settings is None or time.monotonic() - _cached_settings_time > SITE_SETTINGS_MAX_AGE:
+        _cached_settings = load_site_settings()
+        _cached_settings_time = time.monotonic()
+    return _cached_settings
+
+
+def invalidate_site_settings():
+    global _cached_settings
+    _cached_settings = None
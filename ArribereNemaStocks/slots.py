@@ -0,0 +1,89 @@
+"""
+Handing out tube slot positions (1 to box.capacity) inside freezer boxes.
+
+Each box's taken slots are kept as a bitmap in a plain int (bit 0 = position 1), built from the
+positions of its unthawed tubes with one query for all the boxes involved. Finding the lowest free
+slot is then a couple of integer operations no matter how full the box is, so giving out N positions
+is O(N). Call these inside the same (immediate_atomic) transaction that creates the tubes, after
+reserve_box_slots(), so nobody else can take the same slots in between.
+"""
+from typing import Dict, Iterable, List, Optional
+
+from .models import Box, Tube
+
+
+class BoxSlotBitmap:
+    def __init__(self, capacity: int, taken_positions: Iterable[int] = ()):
+        self.capacity = capacity
+        self.all_slots = (1 << capacity) - 1
+        self.taken = 0
+        for position in taken_positions:
+            if 1 <= position <= capacity:
+                self.taken |= 1 << (position - 1)
+
+    def next_free(self) -> Optional[int]:
+        free = ~self.taken & self.all_slots
+        if not free:
+            return None
+        return (free & -free).bit_length()  # free & -free keeps just the lowest set bit
+
+    def take(self, number_of_slots: int) -> List[int]:
+        """
+        Marks the lowest free slots as taken and returns their positions.
+        Raises ValueError if there aren't that many free slots.
+        """
+        positions = []
+        for _ in range(number_of_slots):
+            position = self.next_free()
+            if position is None:
+                raise ValueError(f'Only {len(positions)} free slots left, {number_of_slots} were needed.')
+            self.taken |= 1 << (position - 1)
+            positions.append(position)
+        return positions
+
+    def release(self, position: int):
+        self.taken &= ~(1 << (position - 1))
+
+    def free_count(self) -> int:
+        return bin(~self.taken & self.all_slots).count('1')
+
+
+def load_slot_bitmaps(boxes: Iterable[Box]) -> Dict[int, BoxSlotBitmap]:
+    """
+    {box pk: BoxSlotBitmap} for these boxes, using a single query.
+    """
+    boxes = list(boxes)
+    taken_positions = {box.pk: [] for box in boxes}
+    for box_id, position in Tube.objects.filter(
+            box__in=boxes, thawed=False, position__isnull=False).values_list('box_id', 'position'):
+        taken_positions[box_id].append(position)
+    return {box.pk: BoxSlotBitmap(box.capacity, taken_positions[box.pk]) for box in boxes}
+
+
+def assign_positions(tubes: List[Tube], bitmaps: Optional[Dict[int, BoxSlotBitmap]] = None) -> List[Tube]:
+    """
+    Gives each of these (unsaved or position-less) tubes the lowest free slot in its box.
+    Tubes that aren't in a box, or whose box is already out of slots, are left without a position.
+    """
+    if bitmaps is None:
+        bitmaps = load_slot_bitmaps({tube.box for tube in tubes if tube.box_id})
+    for tube in tubes:
+        bitmap = bitmaps.get(tube.box_id)
+        if bitmap is not None and tube.position is None and bitmap.next_free() is not None:
+            tube.position = bitmap.take(1)[0]
+    return tubes
+
+
+def assign_missing_positions(boxes: Optional[Iterable[Box]] = None) -> int:
+    """
+    Gives every unthawed tube that doesn't have a position yet (e.g. the ones from the old
+    databases) one of its box's free slots, in the order the tubes were created.
+    :return: How many tubes got a position.
+    """
+    boxes = list(Box.objects.all() if boxes is None else boxes)
+    tubes = list(Tube.objects.filter(box__in=boxes, thawed=False, position__isnull=True).order_by('pk'))
+    assign_positions(tubes, load_slot_bitmaps(boxes))
+    tubes = [tube for tube in tubes if tube.position is not None]
+    # Plain bulk_update (no history rows), this is bookkeeping rather than a real change to the tubes:
+    Tube.objects.bulk_update(tubes, ['position'], batch_size=500)
+    return len(tubes)
@@ -0,0 +1 @@
+"""The production SQLite profile (SQLITE_PRODUCTION_PROFILE in settings), see base.py."""
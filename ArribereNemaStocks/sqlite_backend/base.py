@@ -0,0 +1,54 @@
+"""
+Django's SQLite backend, tuned for several gunicorn workers sharing one database file.
+
+With the default rollback journal, a write locks readers out of the whole file until it commits, and
+transactions that read before they write ("deferred") fail straight away with "database is locked" if
+another worker wrote in the meantime. This backend:
+  * Switches the database to WAL mode, so readers keep going while someone writes.
+  * Sets the PRAGMAs in OPTIONS['pragmas'] (busy_timeout, synchronous, mmap_size, etc.) on every new connection.
+  * Starts transaction.atomic() blocks with BEGIN IMMEDIATE (OPTIONS['transaction_mode']), so write
+    transactions wait their turn for the write lock instead of failing halfway through.
+
+Use it with ENGINE = 'ArribereNemaStocks.sqlite_backend' (settings.py does when SQLITE_PRODUCTION_PROFILE is on).
+`python manage.py benchmark_sqlite_profiles` compares it with the plain backend.
+"""
+from django.db.backends.sqlite3 import base as sqlite3_base
+
+# Used for anything not given in OPTIONS['pragmas']:
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 5000,  # ms to wait for a lock before giving up. First, so switching to WAL waits too
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # Safe with WAL, only the last commits can be lost if the machine loses power
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # Negative means KiB, so 64MB
+    'temp_store': 'MEMORY',
+}
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(sqlite3_base.DatabaseWrapper):
+    def __init__(self, settings_dict, *args, **kwargs):
+        super().__init__(settings_dict, *args, **kwargs)
+        options = self.settings_dict['OPTIONS']
+        self.pragmas = {**DEFAULT_PRAGMAS, **options.get('pragmas', {})}
+        self.transaction_mode = options.get('transaction_mode', 'IMMEDIATE').upper()
+        if self.transaction_mode not in TRANSACTION_MODES:
+            raise ValueError(f'transaction_mode must be one of {TRANSACTION_MODES}, not {self.transaction_mode!r}')
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        # Ours, not sqlite3.connect()'s:
+        params.pop('pragmas', None)
+        params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            if pragma == 'journal_mode' and self.is_in_memory_db():
+                continue  # In-memory databases (e.g. the test database) can't use WAL
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
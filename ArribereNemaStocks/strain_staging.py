@@ -0,0 +1,99 @@
+"""
+Bulk strain uploads, staged in the database until they're reviewed.
+
+The pasted lines are parsed (utils.parse_strain_data) into one StagedStrain row each, under a
+StrainUploadBatch for the person who pasted them. The review page shows them a page at a time, so
+fixing a few lines of a several thousand line paste only posts back one page of forms, and nothing
+big has to ride along in the session. Each row remembers whether it passed validation (and why not),
+and once every row does, commit_strain_upload() turns the whole batch into strains with one bulk_create.
+The rows are always validated as a whole batch (forms.StrainBatchValidator), so checking their WJAs
+takes one query however many lines there are.
+"""
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.template.defaultfilters import pluralize
+
+from .bulk_history import bulk_create_with_audit
+from .forms import MiniStrainForm, StrainBatchValidator
+from .models import StagedStrain, Strain, StrainRiskReport, StrainUploadBatch
+from .pagination import bump_strain_count_version
+from .transactions import immediate_atomic
+import profiles.models as profile_models
+
+STRAIN_FIELDS = ('wja', 'genotype', 'phenotype', 'source', 'description', 'additional_comments')
+
+
+@transaction.atomic
+def stage_strain_upload(parsed_strains: Sequence[Dict], user) -> StrainUploadBatch:
+    """
+    Saves the parse_strain_data() output as a new batch for this user (and validates it). Each user
+    only has one upload going at a time, so any batch they abandoned earlier is thrown away.
+    """
+    StrainUploadBatch.objects.filter(uploaded_by=user).delete()
+    batch = StrainUploadBatch.objects.create(uploaded_by=user)
+    StagedStrain.objects.bulk_create([
+        StagedStrain(batch=batch, line_number=line_number,
+                     **{field_name: parsed_strain.get(field_name) or ('' if field_name != 'wja' else None)
+                        for field_name in STRAIN_FIELDS})
+        for line_number, parsed_strain in enumerate(parsed_strains, start=1)
+    ])
+    validate_strain_upload(batch)
+    return batch
+
+
+def validate_staged_strains(rows: Iterable[StagedStrain], uploader_profile=None) -> int:
+    """
+    Runs each row through the same form the strains used to be confirmed with, all sharing one
+    StrainBatchValidator, so however many lines there are their WJAs take a single query. Pass every
+    row of the batch, so lines that repeat each other's WJAs are caught. Saves whether each row passed
+    (with the errors if it didn't, and any warnings about strain ranges) on the rows.
+    :param uploader_profile: Whose strain ranges the WJAs should be in
+    :return: How many of the rows have problems
+    """
+    rows = list(rows)
+    batch_validator = StrainBatchValidator([row.wja for row in rows], uploader_profile)
+    for row in rows:
+        form = MiniStrainForm(data={field_name: getattr(row, field_name) for field_name in STRAIN_FIELDS},
+                              batch_validator=batch_validator)
+        row.is_valid = form.is_valid()
+        row.errors = {field_name: list(messages) for field_name, messages in form.errors.items()}
+        row.warnings = batch_validator.wja_warnings(row.wja)
+    StagedStrain.objects.bulk_update(rows, ['is_valid', 'errors', 'warnings'], batch_size=500)
+    return sum(not row.is_valid for row in rows)
+
+
+def validate_strain_upload(batch: StrainUploadBatch) -> Tuple[List[StagedStrain], int]:
+    """
+    Validates every row of the batch (see validate_staged_strains).
+    :return: The rows, and how many of them have problems
+    """
+    rows = list(batch.rows.all())
+    uploader_profile = profile_models.UserProfile.objects.filter(user_id=batch.uploaded_by_id).first()
+    return rows, validate_staged_strains(rows, uploader_profile)
+
+
+def strain_from_staged(row: StagedStrain) -> Strain:
+    return Strain(wja=row.wja, formatted_wja=f'WJA{row.wja:0>4}',  # bulk_create skips Strain.save()
+                  **{field_name: getattr(row, field_name) or None for field_name in STRAIN_FIELDS[1:]})
+
+
+@immediate_atomic()
+def commit_strain_upload(batch: StrainUploadBatch, actor=None) -> List[Strain]:
+    """
+    Creates a strain for every row of the batch (one bulk_create, plus the history/auditlog rows for
+    actor), then deletes the batch. The rows are validated again first, in case someone else took one
+    of the WJAs since they were staged, and nothing is created unless all of them pass.
+    Raises ValidationError if any of them don't.
+    """
+    rows, invalid_rows = validate_strain_upload(batch)
+    if invalid_rows:
+        raise ValidationError(f'{invalid_rows} line{pluralize(invalid_rows)} still '
+                              f'need{pluralize(invalid_rows, "s,")} fixing before the strains can be saved.')
+    strains = bulk_create_with_audit([strain_from_staged(row) for row in rows], actor=actor)
+    # What the Strain post_save signals would have done for each of them:
+    StrainRiskReport.refresh([strain.pk for strain in strains])
+    bump_strain_count_version()
+    batch.delete()
+    return strains
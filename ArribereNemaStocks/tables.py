@@ -73,7 +73,8 @@ class FreezeRequestTable(tables.Table):
     number_of_tubes = tables.Column()
     cap_color = tables.Column()
     status = tables.Column()
-    is_a_refreeze = tables.Column(accessor='is_a_refreeze', verbose_name='Is Refreeze?')
+    # Needs a queryset from FreezeRequest.objects.with_refreeze_flag()
+    is_a_refreeze = tables.Column(accessor='is_refreeze', verbose_name='Is Refreeze?')
     
     class Meta:
         model = FreezeRequest
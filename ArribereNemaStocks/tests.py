@@ -1,8 +1,40 @@
+import csv
+import tempfile
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
+
 import pytest
-from django.test import TestCase
+from auditlog.models import LogEntry
+from auditlog.registry import auditlog
+from django.core import mail
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import IntegrityError, connection, connections, transaction
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.forms import modelformset_factory
 import ArribereNemaStocks.views as nema_views
+import ArribereNemaStocks.forms as nema_forms
+import ArribereNemaStocks.middleware as nema_middleware
+import ArribereNemaStocks.models as nema_models
+import profiles.models as profile_models
+from ArribereNemaStocks.utils import parse_wja_ranges
+from ArribereNemaStocks.pagination import KeysetPaginator
+from ArribereNemaStocks.outbox import queue_email, deliver_queued_emails
+from ArribereNemaStocks.import_lookups import ImportLookups
+from ArribereNemaStocks.site_settings import get_site_settings, invalidate_site_settings
+from ArribereNemaStocks.box_occupancy import BoxFullError, reserve_box_slots
+from ArribereNemaStocks.transactions import immediate_atomic
+from ArribereNemaStocks.slots import BoxSlotBitmap, assign_missing_positions
+from ArribereNemaStocks.freeze_completion import create_freeze_group
+from ArribereNemaStocks.bulk_history import bulk_delete_with_audit, bulk_update_with_audit
+from ArribereNemaStocks.thaw_reservations import reserve_tubes_for_thaws
+from ArribereNemaStocks.sqlite_backend.base import DatabaseWrapper as TunedSQLiteWrapper
 
 class TestYourViewMixin:
     def __init__(self, *args, **kwargs):
@@ -43,6 +75,67 @@ class TestOngoingFreezes(TestYourViewMixin, TestCase):
         self.url = '/ongoing_freezes/'
         self.template_name = 'freezes_and_thaws/ongoing_freezes.html'
 
+    def make_ongoing_freezes(self, number_of_freezes):
+        user_profile = profile_models.UserProfile.objects.get_or_create(user=self.user, initials='TU')[0]
+        for dewar in (1, 2):
+            box = nema_models.Box.objects.get_or_create(dewar=dewar, rack=1, box=1)[0]
+            nema_models.DefaultBox.objects.get_or_create(box=box)
+        for _ in range(number_of_freezes):
+            strain = nema_models.Strain.objects.create(wja=nema_models.Strain.objects.count() + 1)
+            nema_models.FreezeRequest.objects.create(strain=strain, requester=user_profile, number_of_tubes=4, cap_color='red',
+                                                     status='A')
+
+    def test_boxes_are_loaded_once(self):
+        self.client.login(username='testuser', password='12345')
+        self.make_ongoing_freezes(1)
+        self.client.get(self.url)  # Warms up the per-process caches (site settings, etc.)
+        with CaptureQueriesContext(connection) as queries_for_one:
+            self.client.get(self.url)
+        self.make_ongoing_freezes(4)
+        with CaptureQueriesContext(connection) as queries_for_five:
+            response = self.client.get(self.url)
+        self.assertEqual(len(queries_for_one), len(queries_for_five))
+        self.assertIn('ActiveBox(JA01-R01-B01; 00/81)', response.content.decode())
+
+    def test_completing_a_freeze_in_bulk(self):
+        self.make_ongoing_freezes(1)
+        nema_models.FreezeRequest.objects.update(number_of_tubes=11)
+        freeze_request = nema_models.FreezeRequest.objects.get()
+        box1, box2 = nema_models.Box.objects.order_by('dewar')
+        form = nema_forms.AdvancingFreezeRequestForm(
+            {'id': freeze_request.pk, 'status': 'C', 'box1': box1.pk, 'tubes_for_box1': 6,
+             'box2': box2.pk, 'tubes_for_box2': 4, 'tester_comments': 'Looks good',
+             'date_stored': date.today().isoformat()},
+            instance=freeze_request, actor=self.user)
+        self.assertTrue(form.is_valid(), form.errors)
+        with CaptureQueriesContext(connection) as queries:
+            form.save()
+        # One INSERT each for the tubes, their history and their auditlog entries, not one per tube:
+        inserts = [query['sql'].split('"')[1] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(inserts.count('ArribereNemaStocks_tube'), 1)
+        self.assertEqual(inserts.count('ArribereNemaStocks_historicaltube'), 1)
+        freeze_group = nema_models.FreezeGroup.objects.get()
+        self.assertEqual(freeze_group.active_tubes_count(), 10)
+        self.assertEqual(sorted(box1.tube_set.values_list('position', flat=True)), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(nema_models.Tube.simp_history.filter(history_user=self.user).count(), 10)
+        self.assertEqual(LogEntry.objects.get_for_objects(nema_models.Tube.objects.all()).filter(
+            actor=self.user, action=LogEntry.Action.CREATE).count(), 10)
+
+    def test_save_rechecks_box_capacity(self):
+        self.make_ongoing_freezes(1)
+        freeze_request = nema_models.FreezeRequest.objects.get()
+        box = nema_models.Box.objects.get(dewar=1)
+        form = nema_forms.AdvancingFreezeRequestForm(
+            {'id': freeze_request.pk, 'status': 'C', 'box1': box.pk, 'tubes_for_box1': 3, 'tubes_for_box2': 0,
+             'tester_comments': 'Looks good', 'date_stored': date.today().isoformat()},
+            instance=freeze_request)
+        self.assertTrue(form.is_valid(), form.errors)
+        # Somebody else fills the box up after the form was checked:
+        nema_models.Box.objects.filter(pk=box.pk).update(active_tube_counter=80)
+        with self.assertRaises(ValidationError):
+            form.save()
+        self.assertFalse(nema_models.Tube.objects.exists())
+
 
 class TestOngoingThaws(TestYourViewMixin, TestCase):
     def __init__(self, *args, **kwargs):
@@ -52,6 +145,391 @@ class TestOngoingThaws(TestYourViewMixin, TestCase):
         self.url = '/ongoing_thaws/'
         self.template_name = 'freezes_and_thaws/ongoing_thaws.html'
 
+    def make_ongoing_thaws(self, number_of_thaws):
+        user_profile = profile_models.UserProfile.objects.get_or_create(user=self.user, initials='TU')[0]
+        box = nema_models.Box.objects.get_or_create(dewar=1, rack=1, box=1)[0]
+        for _ in range(number_of_thaws):
+            strain = nema_models.Strain.objects.create(wja=nema_models.Strain.objects.count() + 1)
+            freeze_group = nema_models.FreezeGroup.objects.create(strain=strain, tester=user_profile)
+            for set_number in range(3):
+                nema_models.Tube.objects.create(strain=strain, freeze_group=freeze_group, box=box,
+                                                set_number=set_number)
+            nema_models.ThawRequest.objects.create(strain=strain, requester=user_profile, status='O')
+
+    def count_page_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_tube_choices_are_loaded_once(self):
+        self.client.login(username='testuser', password='12345')
+        self.make_ongoing_thaws(1)
+        self.count_page_queries()  # Warms up the per-process caches (site settings, etc.)
+        queries_for_one, _ = self.count_page_queries()
+        self.make_ongoing_thaws(4)
+        queries_for_five, response = self.count_page_queries()
+        self.assertEqual(queries_for_one, queries_for_five)
+        thaw_request = nema_models.ThawRequest.objects.order_by('pk').first()
+        form = response.context['formset'].forms[0]
+        self.assertEqual([choice[0] for choice in form.fields['tube'].choices][1:],
+                         list(thaw_request.strain.tube_set.values_list('pk', flat=True)))
+
+    def test_tubes_from_other_strains_are_rejected(self):
+        self.make_ongoing_thaws(2)
+        first_request, second_request = nema_models.ThawRequest.objects.order_by('pk')
+        AdvThawFormSet = modelformset_factory(nema_models.ThawRequest, form=nema_forms.AdvancingThawRequestForm,
+                                              formset=nema_forms.AdvancingThawRequestFormSet, extra=0)
+        data = {'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1', 'form-0-id': first_request.pk,
+                'form-0-tube': second_request.strain.tube_set.first().pk, 'form-0-status': 'O',
+                'form-0-date_completed': date.today().isoformat()}
+        formset = AdvThawFormSet(data, queryset=nema_models.ThawRequest.objects.filter(pk=first_request.pk))
+        self.assertFalse(formset.is_valid())
+        self.assertIn('tube', formset.errors[0])
+
+
+class TestThawReservations(TestCase):
+    def setUp(self):
+        self.user_profile = profile_models.UserProfile.objects.create(
+            user=User.objects.create_user(username='czar', password='12345'), initials='CZ')
+        self.strain = nema_models.Strain.objects.create(wja=1)
+        box1 = nema_models.Box.objects.create(dewar=1, rack=1, box=1)
+        box2 = nema_models.Box.objects.create(dewar=2, rack=1, box=1)
+        old_freeze = nema_models.FreezeGroup.objects.create(strain=self.strain)
+        new_freeze = nema_models.FreezeGroup.objects.create(strain=self.strain)
+        # Dewar 1 has three tubes (two of them from the new freeze), dewar 2 only has one:
+        self.tubes = [nema_models.Tube.objects.create(strain=self.strain, freeze_group=freeze_group, box=box,
+                                                      set_number=i, date_created=date(2020 + i, 1, 1))
+                      for i, (freeze_group, box) in enumerate([(old_freeze, box1), (new_freeze, box1),
+                                                               (new_freeze, box1), (old_freeze, box2)])]
+
+    def make_thaw_requests(self, number_of_requests):
+        return [nema_models.ThawRequest.objects.create(strain=self.strain, requester=self.user_profile)
+                for _ in range(number_of_requests)]
+
+    def test_advancing_reserves_different_tubes(self):
+        thaw_requests = self.make_thaw_requests(3)
+        self.assertEqual(reserve_tubes_for_thaws(thaw_requests), [])
+        # Fullest dewar first, then the freeze group with the most tubes there, then the oldest tube:
+        self.assertEqual([thaw_request.tube for thaw_request in thaw_requests],
+                         [self.tubes[1], self.tubes[0], self.tubes[2]])
+        self.assertEqual(nema_models.ThawRequest.objects.filter(status='O').count(), 3)
+        # Only the tube in dewar 2 is left for the next one:
+        later_requests = self.make_thaw_requests(2)
+        self.assertEqual(reserve_tubes_for_thaws(later_requests), [later_requests[1]])
+        self.assertEqual(later_requests[0].tube, self.tubes[3])
+        self.assertIsNone(later_requests[1].tube)
+
+    def test_a_tube_can_only_be_reserved_once(self):
+        first_request, second_request = self.make_thaw_requests(2)
+        reserve_tubes_for_thaws([first_request])
+        second_request.status = 'O'
+        second_request.tube = first_request.tube
+        with self.assertRaises(IntegrityError):
+            second_request.save()
+
+    def test_form_hides_and_rejects_other_requests_tubes(self):
+        first_request, second_request = self.make_thaw_requests(2)
+        reserve_tubes_for_thaws([first_request, second_request])
+        AdvThawFormSet = modelformset_factory(nema_models.ThawRequest, form=nema_forms.AdvancingThawRequestForm,
+                                              formset=nema_forms.AdvancingThawRequestFormSet, extra=0)
+        formset = AdvThawFormSet(queryset=nema_models.ThawRequest.objects.filter(pk=second_request.pk))
+        tube_choices = [choice[0] for choice in formset.forms[0].fields['tube'].choices][1:]
+        self.assertIn(second_request.tube_id, tube_choices)
+        self.assertNotIn(first_request.tube_id, tube_choices)
+        data = {'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1', 'form-0-id': second_request.pk,
+                'form-0-tube': first_request.tube_id, 'form-0-status': 'O',
+                'form-0-date_completed': date.today().isoformat()}
+        formset = AdvThawFormSet(data, queryset=nema_models.ThawRequest.objects.filter(pk=second_request.pk))
+        self.assertFalse(formset.is_valid())
+        self.assertIn('tube', formset.errors[0])
+
+
+class TestRequestBulkActions(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='czar', password='12345', is_staff=True)
+        cls.user_profile = profile_models.UserProfile.objects.create(user=cls.user, initials='CZ')
+
+    def setUp(self):
+        self.client.login(username='czar', password='12345')
+
+    def make_requests(self, model, number_of_requests):
+        for _ in range(number_of_requests):
+            strain = nema_models.Strain.objects.create(wja=nema_models.Strain.objects.count() + 1)
+            if model is nema_models.ThawRequest:
+                nema_models.Tube.objects.create(strain=strain, set_number=1)
+                model.objects.create(strain=strain, requester=self.user_profile)
+            else:
+                model.objects.create(strain=strain, requester=self.user_profile, number_of_tubes=3)
+
+    def confirm_action(self, list_url, action):
+        """
+        Picks "<action> all" on the outstanding requests page, then confirms it.
+        :return: The confirmation page's URL, and how many queries confirming took
+        """
+        response = self.client.post(list_url, {f'action-{action}-all': ''})
+        confirmation_url = response['Location']
+        self.assertIn('/selection=', confirmation_url)
+        self.assertEqual(self.client.get(confirmation_url).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(confirmation_url)
+        self.assertEqual(response.status_code, 302)
+        return confirmation_url, len(queries)
+
+    def test_advancing_thaws_takes_the_same_queries_for_any_number(self):
+        self.make_requests(nema_models.ThawRequest, 2)
+        _, queries_for_two = self.confirm_action('/outstanding_thaw_requests/', 'advance')
+        nema_models.ThawRequest.objects.update(status='C')
+        self.make_requests(nema_models.ThawRequest, 40)
+        _, queries_for_forty = self.confirm_action('/outstanding_thaw_requests/', 'advance')
+        self.assertEqual(queries_for_two, queries_for_forty)
+        ongoing = nema_models.ThawRequest.objects.filter(status='O')
+        self.assertEqual(ongoing.count(), 40)
+        self.assertFalse(ongoing.filter(tube__isnull=True).exists())
+        self.assertEqual(nema_models.ThawRequest.simp_history.filter(history_type='~', history_user=self.user,
+                                                                     status='O').count(), 42)
+        self.assertEqual(LogEntry.objects.filter(action=LogEntry.Action.UPDATE, actor=self.user).count(), 42)
+
+    def test_cancelling_freezes_deletes_them_in_bulk(self):
+        self.make_requests(nema_models.FreezeRequest, 25)
+        confirmation_url, _ = self.confirm_action('/outstanding_freeze_requests/', 'cancel')
+        self.assertFalse(nema_models.FreezeRequest.objects.exists())
+        self.assertEqual(nema_models.FreezeRequest.simp_history.filter(history_type='-', status='X').count(), 25)
+        self.assertEqual(LogEntry.objects.filter(action=LogEntry.Action.DELETE, actor=self.user).count(), 25)
+        # The selection is used up, so the confirmation page can't be submitted twice:
+        self.assertRedirects(self.client.post(confirmation_url), '/outstanding_freeze_requests/',
+                             fetch_redirect_response=False)
+
+    def test_bulk_deletes_fall_back_for_referenced_rows(self):
+        self.make_requests(nema_models.FreezeRequest, 3)
+        freeze_request = nema_models.FreezeRequest.objects.first()
+        nema_models.FreezeGroup.objects.create(strain=freeze_request.strain, freeze_request=freeze_request)
+        cancelled = bulk_delete_with_audit(nema_models.FreezeRequest.objects.all(), actor=self.user, status='X')
+        self.assertEqual(sorted(request.pk for request in cancelled),
+                         sorted(nema_models.FreezeRequest.simp_history.order_by().values_list('id', flat=True).distinct()))
+        self.assertFalse(nema_models.FreezeRequest.objects.exists())
+        self.assertFalse(nema_models.FreezeGroup.objects.exists())  # Cascaded, like a normal delete
+        self.assertEqual(nema_models.FreezeRequest.simp_history.filter(history_type='-', status='X').count(), 3)
+
+    def test_bulk_changes_keep_auditlogs_serialized_data(self):
+        self.make_requests(nema_models.FreezeRequest, 2)
+        serialize_options = {'serialize_data': True, 'serialize_kwargs': {}, 'serialize_auditlog_fields_only': False}
+        with mock.patch.object(auditlog, 'get_serialize_options', return_value=serialize_options):
+            bulk_update_with_audit(nema_models.FreezeRequest.objects.all(), actor=self.user, status='A')
+        entries = LogEntry.objects.filter(action=LogEntry.Action.UPDATE, actor=self.user)
+        self.assertEqual(entries.count(), 2)
+        self.assertEqual({entry.serialized_data['fields']['status'] for entry in entries}, {'A'})
+
+    def test_unknown_selections_are_rejected(self):
+        self.make_requests(nema_models.FreezeRequest, 1)
+        response = self.client.post(reverse('freeze_request_change_confirmation',
+                                            kwargs={'action': 'cancel', 'selection_token': 'made-up'}))
+        self.assertRedirects(response, '/outstanding_freeze_requests/', fetch_redirect_response=False)
+        self.assertTrue(nema_models.FreezeRequest.objects.exists())
+
+
+class TestBulkStrainUpload(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='uploader', password='12345')
+        nema_models.Strain.objects.create(wja=5, genotype='already here')
+
+    def setUp(self):
+        self.client.login(username='uploader', password='12345')
+
+    def upload(self, number_of_lines):
+        # Line 5 is WJA0005, which already exists, and the last line has no WJA at all:
+        lines = [f'WJA{line:0>4}\tunc-{line}(ar{line})\tuncoordinated\tArribere Lab'
+                 for line in range(1, number_of_lines)]
+        lines.append('\tno wja')
+        response = self.client.post(reverse('bulk_upload_strains'), {'data': '\n'.join(lines)})
+        batch = nema_models.StrainUploadBatch.objects.get(uploaded_by=self.user)
+        self.assertRedirects(response, reverse('bulk_confirm_strains', kwargs={'batch_id': batch.pk}),
+                             fetch_redirect_response=False)
+        return batch, response['Location']
+
+    @staticmethod
+    def page_data(response, action):
+        """
+        The POST data for submitting the review page as it was shown.
+        """
+        formset = response.context['formset']
+        data = {f'{formset.prefix}-{key}': value for key, value in formset.management_form.initial.items()}
+        for form in formset:
+            data.update({form.add_prefix(name): '' if form[name].value() is None else form[name].value()
+                         for name in form.fields})
+        data['action'] = action
+        return data
+
+    @mock.patch.object(nema_views, 'STAGED_STRAINS_PER_PAGE', 5)
+    def test_uploads_are_staged_in_the_database_and_reviewed_a_page_at_a_time(self):
+        batch, confirm_url = self.upload(12)
+        self.assertNotIn('parsed_strains', self.client.session)
+        self.assertEqual(batch.rows.count(), 12)
+        self.assertEqual(set(batch.rows.filter(is_valid=False).values_list('line_number', flat=True)), {5, 12})
+        self.assertIn('wja', batch.rows.get(line_number=5).errors)
+
+        response = self.client.get(confirm_url)
+        self.assertEqual([form.instance.line_number for form in response.context['formset']], [1, 2, 3, 4, 5])
+        self.assertEqual(response.context['invalid_rows'], 2)
+        response = self.client.get(confirm_url + '?page=3')
+        self.assertEqual([form.instance.line_number for form in response.context['formset']], [11, 12])
+        response = self.client.get(confirm_url + '?problems=1')
+        self.assertEqual([form.instance.line_number for form in response.context['formset']], [5, 12])
+
+        # Uploading again replaces the old batch:
+        self.upload(3)
+        self.assertFalse(nema_models.StrainUploadBatch.objects.filter(pk=batch.pk).exists())
+
+    def test_fixing_the_problems_then_confirming(self):
+        batch, confirm_url = self.upload(20)
+        response = self.client.get(confirm_url + '?problems=1')
+        # Can't confirm yet:
+        self.client.post(confirm_url + '?problems=1', self.page_data(response, 'confirm'))
+        self.assertEqual(nema_models.Strain.objects.count(), 1)
+
+        data = self.page_data(response, 'confirm')
+        for form in response.context['formset']:
+            data[form.add_prefix('wja')] = {5: 500, 20: 20}[form.instance.line_number]
+        response = self.client.post(confirm_url + '?problems=1', data)
+        self.assertRedirects(response, reverse('strain_list_datatable'), fetch_redirect_response=False)
+
+        self.assertEqual(nema_models.Strain.objects.count(), 21)
+        new_strain = nema_models.Strain.objects.get(wja=500)
+        self.assertEqual((new_strain.formatted_wja, new_strain.genotype, new_strain.description),
+                         ('WJA0500', 'unc-5(ar5)', None))
+        self.assertTrue(nema_models.StrainRiskReport.objects.filter(strain=new_strain, no_freezes=True).exists())
+        self.assertEqual(LogEntry.objects.filter(action=LogEntry.Action.CREATE, actor=self.user,
+                                                 content_type__model='strain').count(), 20)
+        self.assertEqual(nema_models.Strain.simp_history.filter(history_type='+', history_user=self.user).count(), 20)
+        self.assertFalse(nema_models.StrainUploadBatch.objects.exists())
+        self.assertFalse(nema_models.StagedStrain.objects.exists())
+
+    def test_other_peoples_uploads_are_hidden(self):
+        _, confirm_url = self.upload(3)
+        User.objects.create_user(username='someone_else', password='12345')
+        self.client.login(username='someone_else', password='12345')
+        self.assertEqual(self.client.get(confirm_url).status_code, 404)
+
+    def test_big_uploads_check_their_wjas_with_one_query(self):
+        user_profile = profile_models.UserProfile.objects.create(user=self.user, initials='UP')
+        profile_models.StrainRange.objects.create(user_profile=user_profile, strain_numbers_start=1,
+                                                  strain_numbers_end=400)
+        with CaptureQueriesContext(connection) as queries:
+            batch, confirm_url = self.upload(500)
+        strain_lookups = [query for query in queries if query['sql'].startswith('SELECT "ArribereNemaStocks_strain"')]
+        self.assertEqual(len(strain_lookups), 1)
+        self.assertEqual(batch.rows.filter(is_valid=False).count(), 2)
+        self.assertEqual(batch.rows.get(line_number=450).warnings, ["WJA0450 isn't in anybody's strain range."])
+        self.assertEqual(batch.rows.get(line_number=40).warnings, [])
+
+        # Fixing the last line with WJA0010 makes it and line 10 duplicates of each other:
+        response = self.client.get(confirm_url + '?problems=1')
+        data = self.page_data(response, 'save')
+        for form in response.context['formset']:
+            data[form.add_prefix('wja')] = {5: 505, 500: 10}[form.instance.line_number]
+        self.client.post(confirm_url + '?problems=1', data)
+        self.assertEqual(set(batch.rows.filter(is_valid=False).values_list('line_number', flat=True)), {10, 500})
+        self.assertIn('WJA0010 is in this batch 2 times.', batch.rows.get(line_number=10).errors['wja'])
+
+        nema_models.StagedStrain.objects.filter(batch=batch, line_number=500).update(wja=600)
+        response = self.client.post(confirm_url, {'action': 'confirm', 'rows-TOTAL_FORMS': 0,
+                                                  'rows-INITIAL_FORMS': 0})
+        self.assertRedirects(response, reverse('strain_list_datatable'), fetch_redirect_response=False)
+        self.assertEqual(nema_models.Strain.objects.count(), 501)
+
+    def test_uploads_of_thousands_of_lines(self):
+        # Through the whole middleware stack (the query budgets are strict in the tests):
+        batch, confirm_url = self.upload(3000)
+        # Fix the two bad lines (WJA0005 is taken, and the last line has no WJA):
+        nema_models.StagedStrain.objects.filter(batch=batch, line_number=5).update(wja=3005)
+        nema_models.StagedStrain.objects.filter(batch=batch, line_number=3000).update(wja=3000)
+        response = self.client.post(confirm_url, {'action': 'confirm', 'rows-TOTAL_FORMS': 0,
+                                                  'rows-INITIAL_FORMS': 0})
+        self.assertRedirects(response, reverse('strain_list_datatable'), fetch_redirect_response=False)
+        self.assertEqual(nema_models.Strain.objects.count(), 3001)
+
+    def test_mini_strain_forms_share_a_batch_validator(self):
+        batch_validator = nema_forms.StrainBatchValidator([5, 6, 6, None])
+        with CaptureQueriesContext(connection) as queries:
+            forms = [nema_forms.MiniStrainForm({'wja': wja}, batch_validator=batch_validator) for wja in (5, 6, 7)]
+            self.assertEqual([form.is_valid() for form in forms], [False, False, True])
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(forms[0].errors['wja'], ['A strain with this WJA number already exists.'])
+        self.assertEqual(forms[1].errors['wja'], ['WJA0006 is in this batch 2 times.'])
+
+
+class TestExports(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user_profile = profile_models.UserProfile.objects.create(
+            user=User.objects.create_user(username='exporter', password='12345'), initials='EX')
+        box = nema_models.Box.objects.create(dewar=2, rack=3, box=4)
+        for wja in range(1, 6):
+            strain = nema_models.Strain.objects.create(wja=wja, genotype=f'unc-{wja}, tab\there')
+            nema_models.Tube.objects.create(strain=strain, box=box, set_number=1, position=wja + 9)
+            nema_models.ThawRequest.objects.create(strain=strain, requester=user_profile, status='C')
+
+    def get_rows(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        delimiter = '\t' if response['Content-Type'] == 'text/tab-separated-values' else ','
+        return list(csv.reader(StringIO(content), delimiter=delimiter))
+
+    def test_exports_use_the_strain_list_filters(self):
+        rows = self.get_rows('/export/strains/?q=WJA0002-WJA0003&format=tsv')
+        self.assertEqual(rows[0][:2], ['WJA', 'Genotype'])
+        self.assertEqual([(row[0], row[1], row[6]) for row in rows[1:]],
+                         [('WJA0002', 'unc-2, tab\there', '1'), ('WJA0003', 'unc-3, tab\there', '1')])
+        tube_rows = self.get_rows('/export/tubes/?q=WJA0002-WJA0003')
+        self.assertEqual([row[1:4] for row in tube_rows[1:]],
+                         [['WJA0002', 'JA02-R03-B04', 'R2C2'], ['WJA0003', 'JA02-R03-B04', 'R2C3']])
+        thaw_rows = self.get_rows('/export/thaw_requests/')
+        self.assertEqual(len(thaw_rows), 6)
+        self.assertEqual(thaw_rows[1][2:5], ['WJA0001', 'EX', 'Completed'])
+
+    def test_unknown_exports_are_404s(self):
+        self.assertEqual(self.client.get('/export/passwords/').status_code, 404)
+
+
+class TestSQLiteProductionProfile(TestCase):
+    def make_connection(self, name, **options):
+        settings_dict = {**connection.settings_dict, 'ENGINE': 'ArribereNemaStocks.sqlite_backend',
+                         'NAME': name, 'OPTIONS': options}
+        tuned_connection = TunedSQLiteWrapper(settings_dict, alias='tuned')
+        connections['tuned'] = tuned_connection  # For transaction.atomic(using='tuned')
+        self.addCleanup(connections.__delitem__, 'tuned')
+        self.addCleanup(tuned_connection.close)
+        return tuned_connection
+
+    def test_pragmas_are_set_on_connect(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tuned_connection = self.make_connection(f'{temp_dir}/tuned.sqlite3', pragmas={'busy_timeout': 1234})
+            with tuned_connection.cursor() as cursor:
+                pragmas = {}
+                for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store', 'cache_size'):
+                    cursor.execute(f'PRAGMA {pragma}')
+                    pragmas[pragma] = cursor.fetchone()[0]
+            tuned_connection.close()
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 1234,
+                                   'temp_store': 2, 'cache_size': -64000})
+
+    def test_transactions_begin_immediate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tuned_connection = self.make_connection(f'{temp_dir}/tuned.sqlite3')
+            with CaptureQueriesContext(tuned_connection) as queries:
+                with transaction.atomic(using=tuned_connection.alias):
+                    pass
+            tuned_connection.close()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_bad_transaction_modes_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.make_connection(':memory:', transaction_mode='EVENTUALLY')
+
 
 class TestOutstandingFreezeRequests(TestYourViewMixin, TestCase):
     def __init__(self, *args, **kwargs):
@@ -78,3 +556,748 @@ class TestStrainAssignments(TestYourViewMixin, TestCase):
         self.target_view_name = 'strain_assignments'
         self.url = '/strain_assignments/'
         self.template_name = 'strains/strain_assignments.html'
+
+
+class TestStrainSearch(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.unc = nema_models.Strain.objects.create(wja=1, genotype='unc-54(e190)I', phenotype='uncoordinated')
+        cls.smg = nema_models.Strain.objects.create(wja=2, genotype='smg-1(r861)I', phenotype='slow growth',
+                                                    description='Made by crossing WJA0001 with the unc strain')
+        cls.other = nema_models.Strain.objects.create(wja=3, genotype='N2', source='CGC')
+
+    def test_search_matches_substrings(self):
+        self.assertEqual(list(nema_models.Strain.objects.search('e19')), [self.unc])
+        self.assertEqual(list(nema_models.Strain.objects.search('GROWTH')), [self.smg])
+        self.assertEqual(list(nema_models.Strain.objects.search('WJA0003')), [self.other])
+
+    def test_deep_search_includes_extra_fields(self):
+        self.assertEqual(list(nema_models.Strain.objects.search('crossing')), [])
+        self.assertEqual(list(nema_models.Strain.objects.deep_search('crossing')), [self.smg])
+        self.assertEqual(list(nema_models.Strain.objects.deep_search('cgc')), [self.other])
+
+    def test_search_ranks_better_matches_first(self):
+        results = list(nema_models.Strain.objects.deep_search('unc'))
+        self.assertEqual(set(results), {self.unc, self.smg})
+        self.assertEqual(results[0], self.unc)
+
+    def test_search_as_a_subquery(self):
+        # The subquery gives the strain table an alias, which the relevance ranking has to follow:
+        best_matches = nema_models.Strain.objects.deep_search('unc').values('pk')[:1]
+        self.assertEqual(list(nema_models.Strain.objects.filter(pk__in=best_matches)), [self.unc])
+
+    def test_short_queries_fall_back_to_icontains(self):
+        self.assertEqual(list(nema_models.Strain.objects.search('N2')), [self.other])
+
+    def test_stale_single_result_counts_show_the_list(self):
+        url = reverse('strain_list_datatable') + '?q=N2'
+        self.assertRedirects(self.client.get(url), reverse('strain_details', args=[self.other.wja]),
+                             fetch_redirect_response=False)
+        # The strain is deleted through another worker, whose count cache bump we never see:
+        with mock.patch('ArribereNemaStocks.signals.bump_strain_count_version'):
+            self.other.delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results_count'], 1)  # Stale, but it doesn't break the page
+
+    def test_index_follows_updates_and_deletes(self):
+        self.other.phenotype = 'dumpy'
+        self.other.save()
+        self.assertEqual(list(nema_models.Strain.objects.search('dumpy')), [self.other])
+        nema_models.Strain.objects.filter(pk=self.other.pk).update(phenotype='roller')
+        self.assertEqual(list(nema_models.Strain.objects.search('dumpy')), [])
+        self.assertEqual(list(nema_models.Strain.objects.search('roller')), [self.other])
+        self.other.delete()
+        self.assertEqual(list(nema_models.Strain.objects.search('roller')), [])
+
+    def test_rebuild_command(self):
+        call_command('rebuild_strain_search_index', stdout=StringIO())
+        self.assertEqual(list(nema_models.Strain.objects.search('e19')), [self.unc])
+
+    def test_strain_list_datatable_search(self):
+        response = self.client.get(reverse('strain_list_datatable'), {'q': 'unc', 'search_type': 'deep_search'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results_count'], 2)
+
+
+class TestWJARangeSearch(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for wja in (99, 100, 150, 250, 251, 300):
+            nema_models.Strain.objects.create(wja=wja)
+
+    def test_parse_wja_ranges(self):
+        self.assertEqual(parse_wja_ranges('WJA0100-WJA0250'), [(100, 250)])
+        self.assertEqual(parse_wja_ranges('wja:100..250'), [(100, 250)])
+        self.assertEqual(parse_wja_ranges('250-100'), [(100, 250)])
+        self.assertEqual(parse_wja_ranges('WJA0100-WJA0150, wja:300..310'), [(100, 150), (300, 310)])
+        self.assertIsNone(parse_wja_ranges('unc-54'))
+        self.assertIsNone(parse_wja_ranges('WJA0100'))
+
+    def test_in_wja_ranges(self):
+        strains = nema_models.Strain.objects.in_wja_ranges([(100, 250), (300, 300)])
+        self.assertEqual(sorted(strains.values_list('wja', flat=True)), [100, 150, 250, 300])
+        self.assertFalse(nema_models.Strain.objects.in_wja_ranges([]).exists())
+
+    def test_strain_list_datatable_range_search(self):
+        response = self.client.get(reverse('strain_list_datatable'), {'q': 'WJA0100-WJA0250'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results_count'], 3)
+
+
+class TestStrainKeysetPagination(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for wja in range(1, 41):
+            nema_models.Strain.objects.create(wja=wja, date_created=date(2024, 1, 1 + wja % 3))
+
+    def test_pages_cover_every_strain_once(self):
+        paginator = KeysetPaginator(nema_models.Strain.objects.all(), 'date_created', per_page=15)
+        page = paginator.page()
+        self.assertFalse(page.has_previous())
+        seen = [strain.wja for strain in page.object_list]
+        while page.has_next():
+            page = paginator.page(after=page.next_cursor)
+            seen += [strain.wja for strain in page.object_list]
+        self.assertEqual(sorted(seen), list(range(1, 41)))
+        self.assertEqual(len(seen), 40)
+        back_page = paginator.page(before=page.previous_cursor)
+        self.assertEqual(len(back_page), 15)
+        self.assertTrue(back_page.has_next())
+
+    def test_descending_wja_pages(self):
+        paginator = KeysetPaginator(nema_models.Strain.objects.all(), '-formatted_wja', per_page=15)
+        page = paginator.page(after='0026')
+        self.assertEqual([strain.wja for strain in page.object_list], list(range(25, 10, -1)))
+
+    def test_strain_list_datatable_uses_keyset_pages(self):
+        response = self.client.get(reverse('strain_list_datatable'))
+        self.assertEqual(response.context['results_count'], 40)
+        self.assertEqual(response.context['next_page_query'], 'after=15')
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('strain_list_datatable'), {'after': '0030'})
+        self.assertEqual([row.record.wja for row in response.context['table'].rows], list(range(31, 41)))
+        self.assertIsNone(response.context['next_page_query'])
+
+
+class TestTubeCounters(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.strain = nema_models.Strain.objects.create(wja=1)
+        cls.freeze_group = nema_models.FreezeGroup.objects.create(strain=cls.strain)
+        cls.box = nema_models.Box.objects.create(dewar=1, rack=1, box=1)
+        cls.other_box = nema_models.Box.objects.create(dewar=2, rack=1, box=1)
+
+    def make_tubes(self, number_of_tubes, box=None):
+        return [nema_models.Tube.objects.create(strain=self.strain, freeze_group=self.freeze_group,
+                                                box=box or self.box, set_number=i)
+                for i in range(number_of_tubes)]
+
+    def assertCounters(self, obj, active, total):
+        obj.refresh_from_db()
+        self.assertEqual((obj.active_tubes_count(), obj.total_tubes_count()), (active, total))
+
+    def test_create_thaw_and_delete(self):
+        tubes = self.make_tubes(3)
+        self.assertCounters(self.strain, 3, 3)
+        self.assertCounters(self.freeze_group, 3, 3)
+        self.assertCounters(self.box, 3, 3)
+        tubes[0].thawed = True
+        tubes[0].save()
+        self.assertCounters(self.strain, 2, 3)
+        self.assertEqual(self.strain.inactive_tubes_count(), 1)
+        tubes[1].delete()
+        self.assertCounters(self.strain, 1, 2)
+        self.assertCounters(self.box, 1, 2)
+
+    def test_moving_a_tube_between_boxes(self):
+        tube = nema_models.Tube.objects.get(pk=self.make_tubes(1)[0].pk)
+        tube.box = self.other_box
+        tube.save()
+        self.assertCounters(self.box, 0, 0)
+        self.assertCounters(self.other_box, 1, 1)
+        self.assertCounters(self.strain, 1, 1)
+
+    def test_queryset_update_and_bulk_create(self):
+        self.make_tubes(2)
+        nema_models.Tube.objects.bulk_create([
+            nema_models.Tube(strain=self.strain, freeze_group=self.freeze_group, box=self.other_box, set_number=i)
+            for i in range(4)
+        ])
+        self.assertCounters(self.strain, 6, 6)
+        self.assertCounters(self.other_box, 4, 4)
+        nema_models.Tube.objects.filter(box=self.other_box).update(thawed=True)
+        self.assertCounters(self.strain, 2, 6)
+        self.assertCounters(self.other_box, 0, 4)
+        self.assertCounters(self.box, 2, 2)
+
+    def test_saving_a_stale_strain_keeps_counters(self):
+        stale_strain = nema_models.Strain.objects.get(pk=self.strain.pk)
+        self.make_tubes(2)
+        stale_strain.phenotype = 'dumpy'
+        stale_strain.save()
+        self.assertCounters(self.strain, 2, 2)
+
+    def test_recount_tubes_command(self):
+        self.make_tubes(2)
+        nema_models.Strain.objects.filter(pk=self.strain.pk).update(active_tube_counter=10)
+        self.assertEqual(nema_models.Strain.drifted_tube_counters().count(), 1)
+        call_command('recount_tubes', stdout=StringIO())
+        self.assertCounters(self.strain, 2, 2)
+        self.assertFalse(nema_models.Strain.drifted_tube_counters().exists())
+
+
+class TestStrainRiskReport(TestCase):
+    # The report is refreshed when the changes commit (see StrainRiskReport.refresh_on_commit), which
+    # TestCase never does, so the tests run the on_commit callbacks themselves.
+
+    @classmethod
+    def setUpTestData(cls):
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls.strain = nema_models.Strain.objects.create(wja=1)
+        cls.box = nema_models.Box.objects.create(dewar=1, rack=1, box=1)
+
+    def get_report(self):
+        return nema_models.StrainRiskReport.objects.filter(strain=self.strain).first()
+
+    def freeze(self, number_of_tubes, passed_test, days_ago, completed_test=True):
+        with self.captureOnCommitCallbacks(execute=True):
+            freeze_group = nema_models.FreezeGroup.objects.create(
+                strain=self.strain, passed_test=passed_test, completed_test=completed_test,
+                date_created=timezone.now().date() - timedelta(days=days_ago))
+            return [nema_models.Tube.objects.create(strain=self.strain, freeze_group=freeze_group,
+                                                    box=self.box, set_number=i)
+                    for i in range(number_of_tubes)]
+
+    def test_report_follows_freezes_and_tubes(self):
+        self.assertTrue(self.get_report().no_freezes)
+        tubes = self.freeze(3, passed_test=True, days_ago=10)
+        self.assertIsNone(self.get_report())
+        self.freeze(0, passed_test=False, days_ago=1, completed_test=False)
+        self.assertIsNone(self.get_report())  # Still waiting on its test
+        self.freeze(0, passed_test=False, days_ago=0)
+        self.assertTrue(self.get_report().latest_freeze_failed)
+        with self.captureOnCommitCallbacks(execute=True):
+            nema_models.FreezeGroup.objects.filter(passed_test=False, completed_test=True).get().delete()
+        self.assertIsNone(self.get_report())
+        with self.captureOnCommitCallbacks(execute=True):
+            tubes[0].thawed = True
+            tubes[0].save()
+        report = self.get_report()
+        self.assertEqual((report.low_tubes, report.latest_freeze_failed, report.active_tubes), (True, False, 2))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.strain.delete()
+        self.assertFalse(nema_models.StrainRiskReport.objects.exists())
+
+    def test_one_refresh_per_transaction(self):
+        tubes = self.freeze(6, passed_test=True, days_ago=10)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                for tube in tubes:
+                    tube.thawed = True
+                    tube.save()
+            self.assertIsNone(self.get_report())  # Not until it commits
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(self.get_report().active_tubes, 0)
+
+    def test_rolled_back_refreshes_are_forgotten(self):
+        tubes = self.freeze(6, passed_test=True, days_ago=10)
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    tubes[0].thawed = True
+                    tubes[0].save()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            tubes[1].thawed = True
+            tubes[1].save()
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertIsNone(self.get_report())  # 5 tubes left is above TUBE_REMAINING_THRESHOLD
+
+    def test_scary_stuff_page_and_refresh_command(self):
+        other_strain = nema_models.Strain.objects.create(wja=2)
+        self.freeze(4, passed_test=True, days_ago=10)
+        self.freeze(1, passed_test=False, days_ago=0)
+        nema_models.StrainRiskReport.objects.all().delete()
+        call_command('refresh_risk_report', stdout=StringIO())
+        get_site_settings()  # Warms up the per-process caches
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('scary_stuff'))
+        self.assertEqual(response.context['strains_without_freezes'], [other_strain])
+        self.assertEqual(response.context['strains_with_fails'], [self.strain])
+        self.assertEqual(response.context['low_tube_reports'], [])
+
+
+class TestBoxReservations(TransactionTestCase):
+    def setUp(self):
+        self.box = nema_models.Box.objects.create(dewar=1, rack=1, box=1)
+        nema_models.Box.objects.filter(pk=self.box.pk).update(active_tube_counter=75)
+
+    def test_immediate_atomic_takes_the_write_lock_first(self):
+        with CaptureQueriesContext(connection) as queries:
+            with immediate_atomic():
+                reserve_box_slots({self.box.pk: 6})
+        # The plain "BEGIN" is just Django logging that autocommit was turned off, nothing is sent for it:
+        self.assertEqual([query['sql'] for query in queries[:2]], ['BEGIN', 'BEGIN IMMEDIATE'])
+        self.box.refresh_from_db()
+        self.assertEqual(self.box.active_tubes_count(), 81)
+
+    def test_on_commit_hooks_only_run_after_commits(self):
+        committed = []
+        with immediate_atomic():
+            transaction.on_commit(lambda: committed.append('first'))
+            self.assertEqual(committed, [])
+        with self.assertRaises(BoxFullError):
+            with immediate_atomic():
+                transaction.on_commit(lambda: committed.append('second'))
+                reserve_box_slots({self.box.pk: 7})
+        self.assertEqual(committed, ['first'])
+        self.assertTrue(connection.get_autocommit())
+
+    def test_full_boxes_cannot_be_reserved(self):
+        with self.assertRaisesMessage(BoxFullError, 'only has room for 6 more tubes, not 7'):
+            with immediate_atomic():
+                reserve_box_slots({self.box.pk: 7})
+        self.box.refresh_from_db()
+        self.assertEqual(self.box.active_tubes_count(), 75)
+
+
+class TestTubeSlots(TestCase):
+    def test_bitmap_hands_out_the_lowest_free_slots(self):
+        bitmap = BoxSlotBitmap(9, taken_positions=[1, 2, 4])
+        self.assertEqual(bitmap.take(3), [3, 5, 6])
+        bitmap.release(2)
+        self.assertEqual((bitmap.next_free(), bitmap.free_count()), (2, 4))
+        with self.assertRaises(ValueError):
+            bitmap.take(5)
+
+    def test_assign_missing_positions(self):
+        strain = nema_models.Strain.objects.create(wja=1)
+        box = nema_models.Box.objects.create(dewar=1, rack=1, box=1, capacity=4)
+        tubes = [nema_models.Tube.objects.create(strain=strain, box=box, set_number=i, position=position)
+                 for i, position in enumerate([2, None, None, None])]
+        tubes[3].thawed = True
+        tubes[3].save()
+        self.assertEqual(assign_missing_positions(), 2)
+        self.assertEqual([tube.position for tube in nema_models.Tube.objects.order_by('pk')], [2, 1, 3, None])
+        self.assertEqual(nema_models.Tube.objects.get(position=3).grid_position(), 'R2C1')
+        # Moving a tube to another box frees up its old slot:
+        tubes[0].box = nema_models.Box.objects.create(dewar=1, rack=1, box=2)
+        tubes[0].save()
+        self.assertIsNone(tubes[0].position)
+
+    def test_freezes_skip_slots_of_tubes_without_positions(self):
+        strain = nema_models.Strain.objects.create(wja=1)
+        box = nema_models.Box.objects.create(dewar=1, rack=1, box=1)
+        for i in range(3):
+            nema_models.Tube.objects.create(strain=strain, box=box, set_number=i)
+        user = User.objects.create_user(username='testuser', password='12345')
+        user_profile = profile_models.UserProfile.objects.get_or_create(user=user, initials='TU')[0]
+        freeze_request = nema_models.FreezeRequest.objects.create(strain=strain, requester=user_profile,
+                                                                  number_of_tubes=2, status='A')
+        freeze_group = create_freeze_group(freeze_request, 'C', tubes_per_box=[(box, 2)])
+        self.assertEqual(sorted(freeze_group.tube_set.values_list('position', flat=True)), [4, 5])
+        self.assertEqual(sorted(box.tube_set.values_list('position', flat=True)), [1, 2, 3, 4, 5])
+
+    def test_thawed_slots_can_be_reused_and_the_tubes_unthawed(self):
+        strain = nema_models.Strain.objects.create(wja=1)
+        box = nema_models.Box.objects.create(dewar=1, rack=1, box=1, capacity=4)
+        first, second = [nema_models.Tube.objects.create(strain=strain, box=box, set_number=i, position=i + 1)
+                         for i in range(2)]
+        first.thawed = True
+        first.save()
+        nema_models.Tube.objects.filter(pk=second.pk).update(thawed=True)
+        self.assertEqual(list(nema_models.Tube.objects.values_list('position', flat=True)), [None, None])
+        # Their slots go to new tubes:
+        nema_models.Tube.objects.create(strain=strain, box=box, set_number=2)
+        nema_models.Tube.objects.create(strain=strain, box=box, set_number=3)
+        self.assertEqual(assign_missing_positions(), 2)
+        # Unthawing them (one at a time, and in bulk like the admin action) doesn't bring back the old slots:
+        first.thawed = False
+        first.save()
+        nema_models.Tube.objects.filter(pk=second.pk).update(thawed=False)
+        self.assertEqual(assign_missing_positions(), 2)
+        self.assertEqual(sorted(nema_models.Tube.objects.values_list('position', flat=True)), [1, 2, 3, 4])
+
+    def test_admin_unthaw_action(self):
+        strain = nema_models.Strain.objects.create(wja=1)
+        box = nema_models.Box.objects.create(dewar=1, rack=1, box=1, capacity=4)
+        tube = nema_models.Tube.objects.create(strain=strain, box=box, set_number=0, position=1, thawed=True)
+        nema_models.Tube.objects.create(strain=strain, box=box, set_number=1, position=1)
+        admin_user = User.objects.create_superuser(username='admin', password='12345')
+        self.client.force_login(admin_user)
+        response = self.client.post(reverse('admin:ArribereNemaStocks_tube_changelist'),
+                                    {'action': 'unthaw_tubes', '_selected_action': [tube.pk]})
+        self.assertEqual(response.status_code, 302)
+        tube.refresh_from_db()
+        self.assertEqual((tube.thawed, tube.position), (False, 2))
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server is down')
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+    def open(self):
+        raise ConnectionRefusedError('Connection refused')
+
+    def send_messages(self, email_messages):
+        raise AssertionError("Shouldn't get this far")
+
+
+class TestEmailOutbox(TestCase):
+    def test_queued_emails_are_sent_by_the_worker(self):
+        queue_email('Freeze Completed for WJA0001', 'Hello!', ['requester@example.com'], cc=['czar@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+        call_command('send_queued_emails', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].cc, ['czar@example.com'])
+        outbox_email = nema_models.OutboxEmail.objects.get()
+        self.assertEqual((outbox_email.status, outbox_email.attempts), ('S', 1))
+        # Sent emails don't get sent again:
+        call_command('send_queued_emails', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_BACKEND='ArribereNemaStocks.tests.FailingEmailBackend')
+    def test_failed_emails_back_off_then_die(self):
+        outbox_email = queue_email('Thaw Completed for WJA0001', 'Hello!', ['requester@example.com'])
+        self.assertEqual(deliver_queued_emails(max_attempts=2), (0, 1))
+        outbox_email.refresh_from_db()
+        self.assertEqual((outbox_email.status, outbox_email.attempts), ('P', 1))
+        self.assertIn('SMTP server is down', outbox_email.last_error)
+        self.assertGreater(outbox_email.next_attempt, timezone.now())
+        # Not due yet, so nothing happens:
+        self.assertEqual(deliver_queued_emails(max_attempts=2), (0, 0))
+        nema_models.OutboxEmail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(deliver_queued_emails(max_attempts=2), (0, 1))
+        outbox_email.refresh_from_db()
+        self.assertEqual(outbox_email.status, 'D')
+
+    @override_settings(EMAIL_BACKEND='ArribereNemaStocks.tests.UnreachableEmailBackend')
+    def test_connection_failures_count_as_failed_attempts(self):
+        queue_email('Thaw Completed for WJA0001', 'Hello!', ['requester@example.com'])
+        queue_email('Thaw Completed for WJA0002', 'Hello!', ['requester@example.com'])
+        self.assertEqual(deliver_queued_emails(), (0, 2))
+        for outbox_email in nema_models.OutboxEmail.objects.all():
+            self.assertEqual((outbox_email.status, outbox_email.attempts), ('P', 1))
+            self.assertIn('Connection refused', outbox_email.last_error)
+            self.assertGreater(outbox_email.next_attempt, timezone.now())
+
+    def test_the_worker_loop_survives_errors(self):
+        # The first round blows up, the second stops the loop (KeyboardInterrupt isn't an Exception):
+        with mock.patch('ArribereNemaStocks.management.commands.send_queued_emails.deliver_queued_emails',
+                        side_effect=[RuntimeError('database is locked'), KeyboardInterrupt]) as deliver, \
+                mock.patch('time.sleep') as sleep, self.assertLogs(level='ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('send_queued_emails', '--loop', stdout=StringIO())
+        self.assertEqual(deliver.call_count, 2)
+        sleep.assert_called_once_with(10)
+
+
+class TestRefreezeDetection(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='requester', password='12345')
+        cls.requester = profile_models.UserProfile.objects.create(user=user, initials='RQ')
+        today = timezone.now().date()
+        cls.never_failed, cls.failed, cls.failed_then_passed, cls.passed_then_failed, cls.old_fail = [
+            nema_models.Strain.objects.create(wja=wja) for wja in range(1, 6)
+        ]
+        freeze_groups = (
+            (cls.failed, today - timedelta(days=10), False),
+            (cls.failed_then_passed, today - timedelta(days=20), False),
+            (cls.failed_then_passed, today - timedelta(days=5), True),
+            (cls.passed_then_failed, today - timedelta(days=20), True),
+            (cls.passed_then_failed, today - timedelta(days=5), False),
+            (cls.old_fail, today - timedelta(days=400), False),
+        )
+        for strain, date_created, passed_test in freeze_groups:
+            nema_models.FreezeGroup.objects.create(strain=strain, date_created=date_created, passed_test=passed_test)
+        for strain in (cls.never_failed, cls.failed, cls.failed_then_passed, cls.passed_then_failed, cls.old_fail):
+            nema_models.FreezeRequest.objects.create(strain=strain, requester=cls.requester)
+
+    def test_with_refreeze_flag(self):
+        flags = dict(nema_models.FreezeRequest.objects.with_refreeze_flag().values_list('strain__wja', 'is_refreeze'))
+        self.assertEqual(flags, {1: False, 2: True, 3: False, 4: True, 5: False})
+
+    def test_is_a_refreeze_without_annotation(self):
+        freeze_request = nema_models.FreezeRequest.objects.get(strain=self.passed_then_failed)
+        with self.assertNumQueries(1):
+            self.assertTrue(freeze_request.is_a_refreeze())
+
+    def test_outstanding_freeze_requests_query_count_is_constant(self):
+        self.client.get(reverse('outstanding_freeze_requests'))  # Warms up the per-process caches (site settings, etc.)
+        with CaptureQueriesContext(connection) as few_requests:
+            self.client.get(reverse('outstanding_freeze_requests'))
+        for wja in range(100, 110):
+            strain = nema_models.Strain.objects.create(wja=wja)
+            nema_models.FreezeGroup.objects.create(strain=strain, passed_test=False)
+            nema_models.FreezeRequest.objects.create(strain=strain, requester=self.requester)
+        with CaptureQueriesContext(connection) as many_requests:
+            response = self.client.get(reverse('outstanding_freeze_requests'))
+        self.assertContains(response, 'WJA0105')
+        self.assertEqual(len(few_requests), len(many_requests))
+
+
+class TestImportLookups(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.box = nema_models.Box.objects.create(dewar=1, rack=2, box=3)
+        user = User.objects.create_user(username='testuser', password='12345')
+        cls.user_profile = profile_models.UserProfile.objects.create(user=user, initials='TU')
+        cls.user_profile.add_initials('OLD')
+        # Someone else's primary initials, that are also (still) an alias of this user:
+        other_user = User.objects.create_user(username='otheruser', password='12345')
+        cls.other_profile = profile_models.UserProfile.objects.create(user=other_user, initials='AB')
+        profile_models.UserInitials.objects.filter(initials='AB').update(user_profile=cls.user_profile)
+
+    def test_lookups_are_preloaded(self):
+        lookups = ImportLookups()
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.get_box('1', 2, '3'), self.box)
+            self.assertEqual(lookups.get_user_profile('TU'), self.user_profile)
+            self.assertEqual(lookups.get_user_profile_by_alias('OLD'), self.user_profile)
+            with self.assertRaises(nema_models.Box.DoesNotExist):
+                lookups.get_box(2, 2, 3)
+            with self.assertRaises(profile_models.UserProfile.DoesNotExist):
+                lookups.get_user_profile('NOPE')
+            with self.assertRaises(profile_models.UserInitials.DoesNotExist):
+                lookups.get_user_profile_by_alias('NOPE')
+
+    def test_lookups_match_the_queries_they_replace(self):
+        lookups = ImportLookups()
+        for initials in ('TU', 'OLD', 'AB'):
+            for lookup, query in ((lookups.get_user_profile,
+                                   lambda: profile_models.UserProfile.objects.get(initials=initials)),
+                                  (lookups.get_user_profile_by_alias,
+                                   lambda: profile_models.UserInitials.objects.get(initials=initials).user_profile)):
+                try:
+                    expected = query()
+                except ObjectDoesNotExist:
+                    with self.assertRaises(ObjectDoesNotExist):
+                        lookup(initials)
+                else:
+                    self.assertEqual(lookup(initials), expected)
+        self.assertEqual(lookups.get_user_profile('AB'), self.other_profile)
+        self.assertEqual(lookups.get_user_profile_by_alias('AB'), self.user_profile)
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class TestQueryBudgetMiddleware(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='12345')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('about'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[-\d.]+, total;dur=[\d.]+$')
+        with override_settings(QUERY_BUDGET_STRICT=False, DEBUG=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('about')))
+
+    def test_over_budget_raises_when_strict(self):
+        with mock.patch.dict(nema_middleware.QUERY_BUDGETS, {'about': 0}):
+            with override_settings(QUERY_BUDGET_STRICT=True):
+                with self.assertRaises(nema_middleware.QueryBudgetExceeded):
+                    self.client.get(reverse('about'))
+            with override_settings(QUERY_BUDGET_STRICT=False):
+                with self.assertLogs('ArribereNemaStocks.performance', level='WARNING') as logs:
+                    response = self.client.get(reverse('about'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('about made', logs.output[0])
+
+    def test_over_budget_posts_only_warn(self):
+        # Whatever a POST saved is committed by the time its queries are counted, so it doesn't get an error page:
+        with mock.patch.dict(nema_middleware.QUERY_BUDGETS, {'about': 0}):
+            with self.assertLogs('ArribereNemaStocks.performance', level='WARNING') as logs:
+                response = self.client.post(reverse('about'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('about made', logs.output[0])
+
+
+def seed_large_dataset(number_of_strains=5000, tubes_per_strain=6, number_of_users=30,
+                       open_requests=300, ongoing_requests=40):
+    """
+    Fills the database with roughly the size of a busy lab's stocks (~5k strains, ~30k tubes,
+    all 96 boxes and hundreds of open freeze/thaw requests), using bulk_create so it only takes a few seconds.
+    """
+    boxes = nema_models.Box.objects.bulk_create([nema_models.Box(dewar=dewar, rack=rack, box=box)
+                                                 for dewar in range(1, 3)
+                                                 for rack in range(1, 7)
+                                                 for box in range(1, 9)])
+    admin_user = User.objects.create_superuser(username='admin', password='12345', email='admin@example.com')
+    users = [admin_user] + [User.objects.create_user(username=f'user{i:02}', password='12345')
+                            for i in range(1, number_of_users)]
+    user_profiles = [profile_models.UserProfile.objects.create(user=user, initials=f'U{i:02}',
+                                                               active_status=bool(i % 3))
+                     for i, user in enumerate(users)]
+    strains_per_user = number_of_strains // number_of_users + 1
+    profile_models.StrainRange.objects.bulk_create([
+        profile_models.StrainRange(user_profile=user_profile,
+                                   strain_numbers_start=i * strains_per_user + 1,
+                                   strain_numbers_end=(i + 1) * strains_per_user)
+        for i, user_profile in enumerate(user_profiles)
+    ])
+    strains = nema_models.Strain.objects.bulk_create([
+        nema_models.Strain(wja=wja, formatted_wja=f'WJA{wja:0>4}', genotype=f'dpy-{wja % 30}(e{wja})',
+                           phenotype='dumpy' if wja % 2 else 'uncoordinated', source='seeded')
+        for wja in range(1, number_of_strains + 1)
+    ])
+    long_ago = timezone.now().date() - timedelta(days=200)
+    freeze_groups = nema_models.FreezeGroup.objects.bulk_create([
+        nema_models.FreezeGroup(strain=strain, date_created=long_ago, freezer=user_profiles[i % number_of_users],
+                                tester=user_profiles[(i + 1) % number_of_users],
+                                started_test=True, completed_test=True, passed_test=True, stored=True,
+                                date_stored=long_ago)
+        for i, strain in enumerate(strains)
+    ])
+    # Every 10th strain also has a more recent (today) failed freeze:
+    nema_models.FreezeGroup.objects.bulk_create([
+        nema_models.FreezeGroup(strain=strain, freezer=user_profiles[0], started_test=True,
+                                completed_test=True, passed_test=False)
+        for strain in strains[::10]
+    ])
+    nema_models.Tube.objects.bulk_create([
+        nema_models.Tube(strain=freeze_group.strain, freeze_group=freeze_group,
+                         box=boxes[(i * tubes_per_strain + set_number) % len(boxes)],
+                         set_number=set_number, cap_color='blue',
+                         thawed=set_number == 0, date_thawed=long_ago if set_number == 0 else None)
+        for i, freeze_group in enumerate(freeze_groups)
+        for set_number in range(tubes_per_strain)
+    ], batch_size=2000)
+    nema_models.FreezeRequest.objects.bulk_create(
+        [nema_models.FreezeRequest(strain=strains[i * 7], requester=user_profiles[i % number_of_users],
+                                   number_of_tubes=4, cap_color='red', status='R')
+         for i in range(open_requests)] +
+        [nema_models.FreezeRequest(strain=strains[i * 11 + 1], requester=user_profiles[i % number_of_users],
+                                   number_of_tubes=4, cap_color='red', status='A')
+         for i in range(ongoing_requests)]
+    )
+    nema_models.ThawRequest.objects.bulk_create(
+        [nema_models.ThawRequest(strain=strains[i * 13], requester=user_profiles[i % number_of_users],
+                                 status='R')
+         for i in range(open_requests)] +
+        [nema_models.ThawRequest(strain=strains[i * 17 + 2], requester=user_profiles[i % number_of_users],
+                                 status='O')
+         for i in range(ongoing_requests)]
+    )
+    return admin_user
+
+
+# Rendering bootstrap icons can fetch them from the CDN, which these tests shouldn't depend on:
+@mock.patch('django_bootstrap_icons.templatetags.bootstrap_icons.get_icon', mock.Mock(return_value=''))
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+@override_settings(QUERY_BUDGET_STRICT=True)
+@tag('performance')
+class TestLargeDatasetPerformance(TestCase):
+    """
+    Guards against N+1 regressions: every page below has to stay under a fixed number of queries
+    with a full-sized database. Skip these with --exclude-tag performance.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = seed_large_dataset()
+        cls.wja = nema_models.Strain.objects.order_by('wja')[1200].wja
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def assertPageWithinBudget(self, url, max_queries):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), max_queries, f'{url} made {len(queries)} queries')
+        return response
+
+    def test_strain_list_datatable(self):
+        self.assertPageWithinBudget(reverse('strain_list_datatable'), 8)
+        self.assertPageWithinBudget(reverse('strain_list_datatable') + '?page=200', 8)
+        self.assertPageWithinBudget(reverse('strain_list_datatable') + '?q=dumpy', 8)
+
+    def test_strain_details(self):
+        self.assertPageWithinBudget(reverse('strain_details', args=[self.wja]), 15)
+
+    def test_outstanding_requests(self):
+        self.assertPageWithinBudget(reverse('outstanding_freeze_requests'), 8)
+        self.assertPageWithinBudget(reverse('outstanding_thaw_requests'), 8)
+
+    def test_ongoing_requests(self):
+        self.assertPageWithinBudget(reverse('ongoing_freezes'), 10)
+        self.assertPageWithinBudget(reverse('ongoing_thaws'), 10)
+
+    def test_strain_assignments(self):
+        self.assertPageWithinBudget(reverse('strain_assignments'), 8)
+
+    def test_scary_stuff(self):
+        self.assertPageWithinBudget(reverse('scary_stuff'), 5)
+
+    def test_admin_changelists(self):
+        max_queries_by_model = {'strain': 8, 'box': 10, 'tube': 8, 'freezegroup': 8,
+                                'freezerequest': 8, 'thawrequest': 8}
+        for model_name, max_queries in max_queries_by_model.items():
+            self.assertPageWithinBudget(reverse(f'admin:ArribereNemaStocks_{model_name}_changelist'), max_queries)
+
+
+class TestLookupIndexes(TestCase):
+    """
+    The hot lookups have to be SEARCHes on the indexes from migration 0038, not SCANs of the whole table.
+    (SQLite picks these even with empty tables, since equality on an indexed column always wins.)
+    """
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_unthawed_tube_lookups(self):
+        self.assertUsesIndex(nema_models.Tube.objects.filter(strain_id=1, thawed=False), 'tube_unthawed_strain_idx')
+        self.assertUsesIndex(nema_models.Tube.objects.filter(box_id=1, thawed=False), 'tube_unthawed_box_idx')
+        self.assertUsesIndex(nema_models.Tube.objects.filter(freeze_group_id=1, thawed=False),
+                             'tube_unthawed_freeze_group_idx')
+
+    def test_request_status_lookups(self):
+        self.assertUsesIndex(nema_models.ThawRequest.objects.filter(status='R'), 'thawrequest_status_idx')
+        self.assertUsesIndex(nema_models.FreezeRequest.objects.filter(status='A'), 'freezerequest_status_idx')
+
+    def test_strain_by_formatted_wja(self):
+        self.assertUsesIndex(nema_models.Strain.objects.filter(formatted_wja='WJA0001'), 'strain_formatted_wja_idx')
+
+    def test_refreeze_flag_subqueries(self):
+        plan = nema_models.FreezeRequest.objects.filter(status='R').with_refreeze_flag().explain()
+        self.assertIn('USING INDEX freezegroup_passed_idx', plan)
+        self.assertIn('USING INDEX freezegroup_failed_idx', plan)
+        self.assertNotIn('SCAN', plan)
+        self.assertNotIn('TEMP B-TREE', plan)  # The ORDER BY date_created comes straight off the index
+
+
+class TestSiteSettings(TestCase):
+    def setUp(self):
+        # The settings are cached for the whole process, so start every test from a clean slate:
+        invalidate_site_settings()
+
+    def test_index_with_no_settings_rows(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'User Registration</strong> is closed')
+        self.assertContains(response, 'Strain Editing</strong> is closed')
+
+    def test_settings_are_cached_until_changed(self):
+        open_registration = profile_models.OpenRegistration.objects.create(is_open=True)
+        nema_models.OpenStrainEditing.objects.create(edit_ability='O')
+        self.client.get(reverse('index'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('index'))
+        self.assertFalse(any('openregistration' in query['sql'].lower() for query in queries))
+        self.assertContains(response, 'User Registration</strong> is open')
+        self.assertContains(response, 'Strain Editing</strong> is open for owned strains')
+        open_registration.is_open = False
+        open_registration.save()
+        self.assertFalse(get_site_settings().registration_is_open)
+        self.assertEqual(self.client.get(reverse('register')).templates[0].name,
+                         'authentication/registration_closed.html')
@@ -0,0 +1,96 @@
+"""
+Reserving tubes for thaw requests.
+
+A tube is reserved by the ongoing ('O') thaw request that points at it, and the database won't let two
+ongoing requests point at the same tube (the unique_ongoing_thaw_tube constraint on ThawRequest), so
+two czars thawing the same strain at once can't both end up with one tube. The reservation goes away
+by itself once the request is completed (the tube is thawed) or cancelled.
+
+reserve_tubes_for_thaws() picks the tubes when requests advance to 'O', so the czar normally doesn't
+have to choose one at all.
+"""
+import copy
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from django.db.models import QuerySet
+
+from .bulk_history import bulk_save_with_audit
+from .models import ThawRequest, Tube
+from .transactions import immediate_atomic
+
+RESERVING_STATUSES = ('O',)
+
+
+def reserved_tube_ids(exclude_thaw_requests: Iterable[ThawRequest] = ()) -> QuerySet:
+    """
+    Subquery of the pks of tubes reserved by ongoing thaw requests (other than the excluded ones).
+    """
+    reservations = ThawRequest.objects.filter(status__in=RESERVING_STATUSES, tube__isnull=False)
+    excluded_pks = [thaw_request.pk for thaw_request in exclude_thaw_requests if thaw_request.pk]
+    if excluded_pks:
+        reservations = reservations.exclude(pk__in=excluded_pks)
+    return reservations.values('tube_id')
+
+
+def available_tubes(strain_ids: Iterable[int], exclude_thaw_requests: Iterable[ThawRequest] = ()) -> QuerySet:
+    """
+    Unthawed tubes of these strains that no (other) ongoing thaw request has reserved.
+    """
+    return Tube.objects.filter(strain_id__in=strain_ids, thawed=False).exclude(
+        pk__in=reserved_tube_ids(exclude_thaw_requests))
+
+
+def pick_tube(candidates: List[Tube]) -> Optional[Tube]:
+    """
+    Picks which of a strain's free tubes to thaw:
+      1. From the dewar that has the most of them, so we don't use up the copies in the other dewar.
+      2. From the freeze group that has the most of them there, so we keep as many separate freezes as we can.
+      3. The oldest of those.
+    """
+    if not candidates:
+        return None
+    tubes_per_dewar = Counter(tube.box.dewar if tube.box else None for tube in candidates)
+    tubes_per_freeze_group = Counter(
+        (tube.box.dewar if tube.box else None, tube.freeze_group_id) for tube in candidates)
+
+    def sort_key(tube):
+        dewar = tube.box.dewar if tube.box else None
+        return (-tubes_per_dewar[dewar], dewar is None, dewar or 0,
+                -tubes_per_freeze_group[(dewar, tube.freeze_group_id)],
+                tube.date_created, tube.pk)
+
+    return min(candidates, key=sort_key)
+
+
+@immediate_atomic()
+def reserve_tubes_for_thaws(thaw_requests: Iterable[ThawRequest], actor=None) -> List[ThawRequest]:
+    """
+    Advances these thaw requests to ongoing ('O') and reserves a tube for each of them. All the free
+    tubes for the batch are loaded (and locked, we hold the write lock on SQLite) with one query, then
+    handed out urgent requests first, then oldest requests first. The requests are all saved together
+    with one bulk update (actor is who gets the history/auditlog entries).
+    :return: The requests that didn't get a tube because their strain ran out of free ones.
+    """
+    thaw_requests = sorted(thaw_requests, key=lambda thaw_request: (not thaw_request.is_urgent,
+                                                                    thaw_request.date_created,
+                                                                    thaw_request.pk))
+    candidates_by_strain = {}
+    for tube in available_tubes({thaw_request.strain_id for thaw_request in thaw_requests},
+                                exclude_thaw_requests=thaw_requests
+                                ).select_related('box', 'strain').select_for_update().order_by('pk'):
+        candidates_by_strain.setdefault(tube.strain_id, []).append(tube)
+
+    old_thaw_requests = [copy.copy(thaw_request) for thaw_request in thaw_requests]
+    without_tubes = []
+    for thaw_request in thaw_requests:
+        candidates = candidates_by_strain.get(thaw_request.strain_id, [])
+        tube = pick_tube(candidates)
+        if tube is None:
+            without_tubes.append(thaw_request)
+        else:
+            candidates.remove(tube)
+        thaw_request.tube = tube
+        thaw_request.status = 'O'
+    bulk_save_with_audit(thaw_requests, ['tube', 'status'], old_thaw_requests, actor=actor)
+    return without_tubes
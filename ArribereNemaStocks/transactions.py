@@ -0,0 +1,40 @@
+"""
+Transaction helpers.
+
+SQLite's normal ("deferred") transactions only take the database's write lock at their first write.
+If two requests both read something (like how full a box is) and then both try to write, the second
+one fails straight away with "database is locked", and waiting doesn't help because what it read is
+already out of date. immediate_atomic() starts the transaction with BEGIN IMMEDIATE instead, so it
+waits for the write lock (up to the connection's timeout) before reading anything. Other databases
+lock the rows they update, so there it's just transaction.atomic(). (With SQLITE_PRODUCTION_PROFILE on,
+every atomic() block already starts this way, see sqlite_backend/base.py.)
+"""
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+@contextmanager
+def immediate_atomic(using=None):
+    """
+    Works like transaction.atomic() (as a context manager or decorator). Only the outermost block
+    can take the lock up front, nested blocks just become savepoints of whatever transaction they're in.
+    """
+    connection = transaction.get_connection(using)
+    if connection.vendor != 'sqlite' or connection.in_atomic_block or not connection.get_autocommit():
+        with transaction.atomic(using=using):
+            yield
+        return
+    # atomic() would open its own (deferred) transaction, so open ours by hand first. Inside a transaction
+    # that's already open, atomic() just works in a savepoint, and the commit (and on_commit hooks) are ours:
+    transaction.set_autocommit(False, using=using)
+    try:
+        connection.cursor().execute('BEGIN IMMEDIATE')
+        with transaction.atomic(using=using, durable=True):
+            yield
+        transaction.commit(using=using)
+    except BaseException:
+        transaction.rollback(using=using)
+        raise
+    finally:
+        transaction.set_autocommit(True, using=using)
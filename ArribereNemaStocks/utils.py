@@ -1,4 +1,6 @@
+import re
 from pprint import pprint
+from typing import List, Optional, Tuple
 
 
 def parse_strain_data(data, separator='\t', number_of_fields=6,
@@ -49,3 +51,37 @@ def parse_strain_data(data, separator='\t', number_of_fields=6,
         strain_data = fields_dict
         parsed_data.append(strain_data)
     return parsed_data
+
+
+# Matches one WJA range, either "WJA0100-WJA0250" / "100-250" style or "wja:100..250" style.
+WJA_RANGE_PATTERN = re.compile(
+    r'^\s*(?:wja:\s*(?P<colon_start>\d+)\s*\.\.\s*(?P<colon_end>\d+)'
+    r'|(?:wja)?(?P<dash_start>\d+)\s*-\s*(?:wja)?(?P<dash_end>\d+))\s*$',
+    re.IGNORECASE,
+)
+
+
+def parse_wja_ranges(query: str) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a search string made up of one or more (comma separated) WJA ranges, like:
+        "WJA0100-WJA0250", "100-250", "wja:100..250" or "WJA0100-WJA0150, WJA0300-WJA0310"
+    Returns a list of (start, end) tuples (with start <= end), or None if the string isn't a range query.
+    """
+    if not query:
+        return None
+    wja_ranges = []
+    for range_string in query.split(','):
+        match = WJA_RANGE_PATTERN.match(range_string)
+        if not match:
+            return None
+        start = int(match.group('colon_start') or match.group('dash_start'))
+        end = int(match.group('colon_end') or match.group('dash_end'))
+        wja_ranges.append((min(start, end), max(start, end)))
+    return wja_ranges
+
+
+def format_wja_range(start: int, end: int) -> str:
+    """
+    The inverse of parse_wja_ranges for a single range, used to build search links.
+    """
+    return f'WJA{start:0>4}-WJA{end:0>4}'
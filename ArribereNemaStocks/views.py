@@ -1,14 +1,17 @@
 from datetime import date
 
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
 from django.shortcuts import render, redirect, get_object_or_404, HttpResponseRedirect, reverse
 from django.contrib import messages
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse
 from django.utils.safestring import mark_safe
-from django.forms import formset_factory, modelformset_factory, BaseModelFormSet
+from django.template.defaultfilters import pluralize
+from django.forms import formset_factory, modelformset_factory
 
-from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.conf import settings
 
@@ -17,9 +20,19 @@ from django_tables2 import RequestConfig
 from . import models as nema_models
 from . import forms as nema_forms
 from . import tables as nema_tables
-from .utils import parse_strain_data
+from .utils import parse_strain_data, parse_wja_ranges
+from .outbox import queue_email
+from .pagination import KeysetPaginator, CachedCountPaginator, cached_count
+from .site_settings import get_site_settings
+from .exports import EXPORTS, export_response
+from .bulk_history import bulk_delete_with_audit, bulk_update_with_audit
+from .selections import save_selection, load_selection, discard_selection
+from .strain_staging import STRAIN_FIELDS, commit_strain_upload, stage_strain_upload, validate_strain_upload
+from .thaw_reservations import reserve_tubes_for_thaws
+from .transactions import immediate_atomic
 
 import profiles.models as profile_models
+from hardcoded import STAGED_STRAINS_PER_PAGE, TUBE_REMAINING_THRESHOLD
 
 # TODO: Implement a way to "bulk change" the fields in the ongoing freeze and thaw requests tables
 # TODO: Add a review slide for the ongoing freeze and thaw request tables, when submitting
@@ -28,19 +41,8 @@ import profiles.models as profile_models
 
 # General Navigation:
 def index(request, *args, **kwargs):
-    user_registration = profile_models.OpenRegistration.objects.first().is_open
-    registration_string = 'open' if user_registration else 'closed'
-    edit_permissions = nema_models.OpenStrainEditing.objects.first().edit_ability
-    edit_permissions_string = 'closed'
-    if edit_permissions == 'N':
-        edit_permissions_string = 'closed'
-    elif edit_permissions == 'O':
-        edit_permissions_string = 'open for owned strains'
-    elif edit_permissions == 'A':
-        edit_permissions_string = 'open for all strains'
-    return render(request, 'basic_navigation/index.html',
-                  {'registration': registration_string,
-                   'edit_permissions': edit_permissions_string})
+    # The registration/editing status comes from the site_settings context processor
+    return render(request, 'basic_navigation/index.html')
 
 
 def about(request, *args, **kwargs):
@@ -49,7 +51,8 @@ def about(request, *args, **kwargs):
 
 # Strain Navigation:
 def strain_assignments(request, *args, **kwargs):
-    user_profiles = profile_models.UserProfile.objects.all()
+    user_profiles = profile_models.UserProfile.objects.select_related('user').prefetch_related(
+        Prefetch('strain_ranges', queryset=profile_models.StrainRange.objects.with_strain_counts()))
     active_user_profiles = [user_profile for user_profile in user_profiles if user_profile.active_status]
     inactive_user_profiles = [user_profile for user_profile in user_profiles if not user_profile.active_status]
     return render(request, 'strains/strain_assignments.html',
@@ -61,36 +64,94 @@ def strain_search(request, *args, **kwargs):
     return render(request, 'strains/strain_search.html')
 
 
-def strain_list_datatable(request, *args, **kwargs):
+def _filtered_strains(request):
+    """
+    The strains matching the strain list's search/filter GET parameters (also used by the exports).
+    """
     search_type = request.GET.get('search_type', 'search')
     search_term = request.GET.get('q')
     user_id = request.GET.get('user_id')
     user_profile_initials = request.GET.get('user_profile_initials')
-    
+
     if user_profile_initials:
         user_profile = profile_models.UserProfile.objects.get(initials=user_profile_initials)
-        strains = user_profile.get_all_strains()
+        return user_profile.get_all_strains()
     elif user_id:
         user_profile = profile_models.UserProfile.objects.get(user__id=user_id)
-        strains = user_profile.get_all_strains()
+        return user_profile.get_all_strains()
+    elif search_term and parse_wja_ranges(search_term):
+        return nema_models.Strain.objects.in_wja_ranges(parse_wja_ranges(search_term))
     elif search_term:
         if search_type and search_type == 'deep_search':
-            strains = nema_models.Strain.objects.deep_search(search_term)
+            return nema_models.Strain.objects.deep_search(search_term)
         else:
-            strains = nema_models.Strain.objects.search(search_term)
-    else:
-        strains = nema_models.Strain.objects.all()
-    
+            return nema_models.Strain.objects.search(search_term)
+    return nema_models.Strain.objects.all()
+
+
+def strain_list_datatable(request, *args, **kwargs):
+    search_term = request.GET.get('q')
+    strains = _filtered_strains(request)
+
+    results_count = cached_count(strains)
     # If there is only one result we can redirect to the details page! But we'll add a message first.
-    if strains.count() == 1:
+    # (The count can be a few minutes stale in other workers, see cached_count, so check it's really there.)
+    only_strain = strains.first() if results_count == 1 else None
+    if only_strain is not None:
         messages.info(request, f'Only one result found for "{search_term}"! Redirected to its details page.')
-        return redirect('strain_details', wja=strains.first().wja)
+        return redirect('strain_details', wja=only_strain.wja)
     
-    table = nema_tables.StrainTable(strains)
-    RequestConfig(request, paginate={"per_page": 15}).configure(table)
+    # Search results are ordered by relevance, so only seek (keyset) paginate when we are listing
+    # strains in a sort order that keyset pagination supports, and the user hasn't asked for a page number.
+    is_ranked_search = bool(search_term) and not parse_wja_ranges(search_term)
+    sort = request.GET.get('sort') or (None if is_ranked_search else 'formatted_wja')
+    keyset_page = None
+    if sort and KeysetPaginator.supports(sort) and 'page' not in request.GET:
+        keyset_page = KeysetPaginator(strains, sort, per_page=15).page(after=request.GET.get('after'),
+                                                                       before=request.GET.get('before'))
+        table = nema_tables.StrainTable(keyset_page.object_list, order_by=sort)
+        RequestConfig(request, paginate=False).configure(table)
+    else:
+        table = nema_tables.StrainTable(strains)
+        RequestConfig(request, paginate={"per_page": 15,
+                                         "paginator_class": CachedCountPaginator,
+                                         "count": results_count}).configure(table)
+
+    export_query = request.GET.copy()
+    for pagination_parameter in ('page', 'after', 'before', 'sort'):
+        export_query.pop(pagination_parameter, None)
 
     return render(request, 'strains/strain_list_datatable.html',
-                  {'table': table, 'results_count': strains.count()})
+                  {'table': table, 'results_count': results_count,
+                   'export_query': export_query.urlencode(),
+                   'export_kinds': [('strains', 'Strains'), ('tubes', 'Tubes'),
+                                    ('freeze_requests', 'Freeze Requests'), ('thaw_requests', 'Thaw Requests')],
+                   'keyset_page': keyset_page,
+                   'next_page_query': _keyset_page_query(request, after=keyset_page.next_cursor)
+                   if keyset_page and keyset_page.has_next() else None,
+                   'previous_page_query': _keyset_page_query(request, before=keyset_page.previous_cursor)
+                   if keyset_page and keyset_page.has_previous() else None})
+
+
+def export_table(request, kind, *args, **kwargs):
+    """
+    Streams a CSV/TSV of the strains (or their tubes, freeze requests or thaw requests) that match
+    the same search/filters as strain_list_datatable. Add ?format=tsv for tab separated.
+    """
+    if kind not in EXPORTS:
+        raise Http404(f'Unknown export: {kind}')
+    return export_response(kind, _filtered_strains(request), file_format=request.GET.get('format', 'csv'))
+
+
+def _keyset_page_query(request, after=None, before=None):
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    if after:
+        query['after'] = after
+    if before:
+        query['before'] = before
+    return query.urlencode()
 
 
 def new_strain(request, *args, **kwargs):
@@ -111,6 +172,7 @@ def new_strain(request, *args, **kwargs):
 
 
 # Things for Bulk Upload
+@login_required
 def bulk_upload_strains(request):
     if request.method == 'POST':
         form = nema_forms.BulkStrainUploadForm(request.POST)
@@ -120,42 +182,56 @@ def bulk_upload_strains(request):
             if not parsed_strains:
                 form.add_error('data', 'No valid data found.')
                 return render(request, 'strains/bulk_upload_strains.html', {'form': form})
-            request.session['parsed_strains'] = parsed_strains
-            return redirect('bulk_confirm_strains')
+            batch = stage_strain_upload(parsed_strains, request.user)
+            return redirect('bulk_confirm_strains', batch_id=batch.pk)
     else:
         form = nema_forms.BulkStrainUploadForm()
     return render(request, 'strains/bulk_upload_strains.html', {'form': form})
 
 
-@transaction.atomic
-def bulk_confirm_strains(request):
-    if request.method == 'POST':
-        # Reconstruct the formset without specifying 'extra'
-        StrainFormSet = modelformset_factory(
-            nema_models.Strain, form=nema_forms.MiniStrainForm, formset=BaseModelFormSet
-        )
-        formset = StrainFormSet(request.POST, queryset=nema_models.Strain.objects.none())
-        if formset.is_valid():
-            formset.save()
-            request.session.pop('parsed_strains', None)
-            return redirect('strain_list_datatable')
-    else:
-        parsed_strains = request.session.get('parsed_strains')
-        if not parsed_strains:
-            return redirect('bulk_upload_strains')
-        total_forms = len(parsed_strains)
-        # Set 'extra' to the number of parsed strains
-        StrainFormSet = modelformset_factory(
-            nema_models.Strain,
-            form=nema_forms.MiniStrainForm,
-            formset=BaseModelFormSet,
-            extra=total_forms
-        )
-        formset = StrainFormSet(
-            queryset=nema_models.Strain.objects.none(),
-            initial=parsed_strains
-        )
-    return render(request, 'strains/bulk_confirm_strains.html', {'formset': formset})
+@login_required
+def bulk_confirm_strains(request, batch_id):
+    """
+    The review page for a staged bulk upload, STAGED_STRAINS_PER_PAGE lines at a time (add ?problems=1
+    for just the lines that need fixing). Posting saves any fixes made on the page, and then either
+    stays on it ('save'), or creates all the strains if every line is OK now ('confirm').
+    """
+    batch = get_object_or_404(nema_models.StrainUploadBatch, pk=batch_id, uploaded_by=request.user)
+    if request.method == 'POST' and request.POST.get('action') == 'discard':
+        batch.delete()
+        messages.info(request, 'Bulk upload discarded.')
+        return redirect('bulk_upload_strains')
+
+    only_problems = request.GET.get('problems') == '1'
+    rows = batch.rows.filter(is_valid=False) if only_problems else batch.rows.all()
+    page = Paginator(rows, STAGED_STRAINS_PER_PAGE).get_page(request.GET.get('page'))
+    StagedStrainFormSet = modelformset_factory(nema_models.StagedStrain, form=nema_forms.StagedStrainForm,
+                                               extra=0)
+    formset = StagedStrainFormSet(request.POST or None, prefix='rows',
+                                  queryset=rows.filter(pk__in=[row.pk for row in page.object_list]))
+    if request.method == 'POST' and formset.is_valid():
+        with transaction.atomic():
+            fixed_rows = formset.save(commit=False)
+            if fixed_rows:
+                nema_models.StagedStrain.objects.bulk_update(fixed_rows, STRAIN_FIELDS)
+                validate_strain_upload(batch)  # A fix can clear (or cause) other lines' duplicate WJAs too
+        if request.POST.get('action') == 'confirm':
+            try:
+                strains = commit_strain_upload(batch, actor=request.user)
+            except ValidationError as error:
+                messages.warning(request, error.message)
+            else:
+                messages.success(request, f'Created {len(strains)} strain{pluralize(len(strains))}!')
+                return redirect('strain_list_datatable')
+        elif fixed_rows:
+            messages.success(request, f'Saved your changes to {len(fixed_rows)} line{pluralize(len(fixed_rows))}.')
+        return HttpResponseRedirect(request.get_full_path())
+
+    total_rows = batch.rows.count()
+    invalid_rows = batch.rows.filter(is_valid=False).count()
+    return render(request, 'strains/bulk_confirm_strains.html',
+                  {'batch': batch, 'formset': formset, 'page': page, 'only_problems': only_problems,
+                   'total_rows': total_rows, 'invalid_rows': invalid_rows})
 # End Bulk Upload
 
 
@@ -163,7 +239,7 @@ def edit_strain(request, wja, *args, **kwargs):
     strain = get_object_or_404(nema_models.Strain, wja=wja)
     user = request.user
     
-    open_editing_status = nema_models.OpenStrainEditing.objects.first().edit_ability
+    open_editing_status = get_site_settings().edit_ability
     
     # Check if user has permission to edit strains (All users should be given this permission)
     if not user.has_perm('ArribereNemaStocks.change_strain'):
@@ -209,8 +285,7 @@ def edit_strain(request, wja, *args, **kwargs):
 def strain_details(request, wja, *args, **kwargs):
     strain = get_object_or_404(nema_models.Strain, wja=wja)
 
-    active_freeze_groups = [freeze_group for freeze_group in strain.freeze_groups.all()
-                            if freeze_group.active_tubes_count() > 0]
+    active_freeze_groups = strain.freeze_groups.filter(active_tube_counter__gt=0).select_related('tester')
     tubes_table = nema_tables.MiniFreezeGroupTable(active_freeze_groups)
     RequestConfig(request, paginate={"per_page": 10}).configure(tubes_table)
 
@@ -249,7 +324,7 @@ def thaw_request_form(request, *args, **kwargs):
     if form.is_valid():
         strain_from_form = form.cleaned_data['strain']
         strain = get_object_or_404(nema_models.Strain, formatted_wja=strain_from_form.formatted_wja)
-        if strain.tube_set.filter(thawed=False).count() == 0:
+        if strain.active_tubes_count() == 0:
             messages.warning(request, 'This strain has no tubes available to be thawed!')
             return redirect('strain_details', wja=strain_from_form.wja)
         # Redirect to the confirmation step
@@ -279,41 +354,14 @@ def thaw_request_confirmation(request, form=None, *args, **kwargs):
             'request_comments': request.POST.get('request_comments', None),
         }
     if request.method == 'POST' and 'confirm' in request.POST:
-        thaw_request = nema_models.ThawRequest.objects.create(**thaw_request_data)
+        with transaction.atomic():
+            thaw_request = nema_models.ThawRequest.objects.create(**thaw_request_data)
+            # let's email czars when a request is made
+            queue_thaw_request_email_to_czars(thaw_request)
         
         messages.success(request,
                          f'New thaw request created successfully! '
                          f'Target: {formatted_wja}; ID: {thaw_request.id:>05d}')
-        
-        # let's email czars when a request is made
-        def send_email_to_czars():
-            recipients_list = []
-            cc_list = []
-            strain_czars = profile_models.UserProfile.objects.filter(is_strain_czar=True)
-            for czar in strain_czars:
-                if czar.user.email and czar.active_status:
-                    recipients_list.append(czar.user.email)
-            thaw_requester = thaw_request.requester
-            thaw_requester_name = thaw_requester.user.first_name.title()
-            if thaw_requester.user.email and thaw_requester.active_status:
-                cc_list.append(thaw_requester.user.email)
-            context = {
-                'thaw_request': thaw_request,
-                'strain': thaw_request.strain,
-                'requester': thaw_request.requester,
-                'requester_name': thaw_requester_name,
-                'is_urgent': thaw_request.is_urgent,
-                'request_comments': thaw_request.request_comments,
-            }
-            if thaw_request.is_urgent == "True":
-                subject = (f"New URGENT Thaw Request by {thaw_requester.initials}: "
-                           f"{thaw_request.strain.formatted_wja} (ID#{thaw_request.id:0>6d})")
-            else:
-                subject = f"New Thaw Request"
-            message = render_to_string('freezes_and_thaws/thaw_request_email.txt', context)
-            email = EmailMessage(subject, message, settings.EMAIL_HOST_USER, recipients_list, cc=cc_list)
-            email.send()
-        send_email_to_czars()
 
         return redirect('outstanding_thaw_requests')
 
@@ -322,9 +370,41 @@ def thaw_request_confirmation(request, form=None, *args, **kwargs):
                    'form': form})
 
 
+def queue_thaw_request_email_to_czars(thaw_request):
+    recipients_list = []
+    cc_list = []
+    strain_czars = profile_models.UserProfile.objects.filter(is_strain_czar=True)
+    for czar in strain_czars:
+        if czar.user.email and czar.active_status:
+            recipients_list.append(czar.user.email)
+    thaw_requester = thaw_request.requester
+    thaw_requester_name = thaw_requester.user.first_name.title()
+    if thaw_requester.user.email and thaw_requester.active_status:
+        cc_list.append(thaw_requester.user.email)
+    context = {
+        'thaw_request': thaw_request,
+        'strain': thaw_request.strain,
+        'requester': thaw_request.requester,
+        'requester_name': thaw_requester_name,
+        'is_urgent': thaw_request.is_urgent,
+        'request_comments': thaw_request.request_comments,
+    }
+    if thaw_request.is_urgent == "True":
+        subject = (f"New URGENT Thaw Request by {thaw_requester.initials}: "
+                   f"{thaw_request.strain.formatted_wja} (ID#{thaw_request.id:0>6d})")
+    else:
+        subject = f"New Thaw Request"
+    message = render_to_string('freezes_and_thaws/thaw_request_email.txt', context)
+    queue_email(subject, message, recipients_list, cc=cc_list, from_email=settings.EMAIL_HOST_USER)
+
+
 def outstanding_thaw_requests(request):
-    thaw_requests = nema_models.ThawRequest.objects.filter(status__in=['R', 'O'])
-    requesting_users = profile_models.UserProfile.objects.filter(thaw_requests__in=thaw_requests).distinct()
+    thaw_requests = nema_models.ThawRequest.objects.filter(
+        status__in=['R', 'O']
+    ).select_related('strain', 'requester__user')
+    requesting_users = profile_models.UserProfile.objects.filter(
+        thaw_requests__status__in=['R', 'O']
+    ).select_related('user').distinct()
     requesting_users_initials = [user_profile.initials for user_profile in requesting_users]
 
     # Table using django-tables2
@@ -360,64 +440,79 @@ def outstanding_thaw_requests(request):
             messages.warning(request, 'No thaw requests to process!')
             return redirect('outstanding_thaw_requests')
 
-        selected_reqeust_ids_str = '&'.join([f"{request.id:>05d}" for request in selected_requests])
+        selection_token = save_selection(request.session, 'thaw_request',
+                                         selected_requests.values_list('pk', flat=True))
 
         # Redirect to the new page with selected ThawRequests
         return redirect('thaw_request_change_confirmation',
                         action=option,
-                        thaw_request_ids=selected_reqeust_ids_str)
+                        selection_token=selection_token)
 
     return render(request, 'freezes_and_thaws/outstanding_thaw_requests.html',
                   {'table': table, 'requesting_users': requesting_users})
 
 
-def thaw_request_change_confirmation(request, thaw_request_ids, action='NoAction', *args, **kwargs):
+def thaw_request_change_confirmation(request, selection_token, action='NoAction', *args, **kwargs):
     if action not in ['cancel', 'advance']:
         messages.warning(request, f'Invalid action! You provided {action}.')
         return redirect('outstanding_thaw_requests')
 
-    thaw_requests = nema_models.ThawRequest.objects.filter(pk__in=thaw_request_ids.split('&'))
+    thaw_request_pks = load_selection(request.session, 'thaw_request', selection_token)
+    if thaw_request_pks is None:
+        messages.warning(request, 'That selection of thaw requests has expired, please select them again.')
+        return redirect('outstanding_thaw_requests')
+    # Only the ones that can still be cancelled/advanced (this also makes resubmitting the page harmless):
+    thaw_requests = nema_models.ThawRequest.objects.filter(
+        pk__in=thaw_request_pks, status__in=['R', 'O'] if action == 'cancel' else ['R'],
+    ).select_related('strain', 'requester__user').order_by('pk')
 
     if request.method == 'POST':
-        if action == 'cancel':
-            for thaw_request in thaw_requests:
-                thaw_request.completed = True
-                thaw_request.status = 'X'
-                thaw_request.save()
-                thaw_str = thaw_request.__str__()
-                thaw_request.delete()
-                messages.success(request, mark_safe(f'Deleted thaw request:<br><strong>{thaw_str}</strong>'))
-            return redirect('outstanding_thaw_requests')
-        elif action == 'advance':
-            for thaw_request in thaw_requests:
-                thaw_request.status = 'O'
-                thaw_request.save()
-                messages.success(request, f'Thaw requests {thaw_request_ids} advanced successfully!')
-            return redirect('ongoing_thaws')
-        else:
-            messages.warning(request, f'Invalid action! You provided {action}.')
-            return redirect('outstanding_thaw_requests')
+        # Everything is done with a couple of bulk queries, however many requests there are:
+        with immediate_atomic():
+            if action == 'cancel':
+                cancelled = bulk_delete_with_audit(thaw_requests, actor=request.user, status='X', completed=True)
+                messages.success(request, f'Cancelled {len(cancelled)} thaw request{pluralize(len(cancelled))}.')
+            else:
+                thaw_requests = list(thaw_requests)
+                without_tubes = reserve_tubes_for_thaws(thaw_requests, actor=request.user)
+                messages.success(request, f'Advanced {len(thaw_requests)} thaw request'
+                                          f'{pluralize(len(thaw_requests))}.')
+                for thaw_request in without_tubes:
+                    messages.warning(request, f'There are no free tubes left to reserve '
+                                              f'for {thaw_request.strain.formatted_wja}!')
+        discard_selection(request.session, selection_token)
+        return redirect('outstanding_thaw_requests' if action == 'cancel' else 'ongoing_thaws')
 
     return render(request, 'freezes_and_thaws/thaw_request_change_confirmation.html',
-                  {'thaw_request_ids': thaw_request_ids,
+                  {'selection_token': selection_token,
                    'thaw_requests': thaw_requests,
                    'action': action})
 
 
 def ongoing_thaws(request):
-    ongoing_thaws = nema_models.ThawRequest.objects.filter(status__in=['O'])
+    ongoing_thaws = nema_models.ThawRequest.objects.filter(status__in=['O']).select_related('strain',
+                                                                                           'requester__user')
 
     AdvThawFormSet = modelformset_factory(nema_models.ThawRequest,
                                           form=nema_forms.AdvancingThawRequestForm,
+                                          formset=nema_forms.AdvancingThawRequestFormSet,
                                           extra=0)
     
     if request.method == 'POST':
         adv_thaw_formset = AdvThawFormSet(request.POST, queryset=ongoing_thaws)
         # print(adv_thaw_formset)
         if adv_thaw_formset.is_valid():
+            try:
+                with immediate_atomic():
+                    for form in adv_thaw_formset:
+                        form.save()
+            except IntegrityError:
+                # Someone else reserved one of the chosen tubes after this page was validated:
+                messages.warning(request, 'One of those tubes was just reserved by another thaw request, '
+                                          'nothing was saved. Please pick again.')
+                return redirect('ongoing_thaws')
             for form in adv_thaw_formset:
                 messages.success(request, mark_safe(f'Saved changes to<br><strong>{form.instance}</strong>'))
-                form.save()
             return redirect('ongoing_thaws')
         else:
             messages.warning(request, f'Invalid formset!{adv_thaw_formset.errors}')
@@ -491,8 +586,12 @@ def freeze_request_confirmation(request, form=None, *args, **kwargs):
 
 
 def outstanding_freeze_requests(request):
-    freeze_requests = nema_models.FreezeRequest.objects.filter(status__in=['R', 'A'])
-    requesting_users = profile_models.UserProfile.objects.filter(freeze_requests__in=freeze_requests).distinct()
+    freeze_requests = nema_models.FreezeRequest.objects.filter(
+        status__in=['R', 'A']
+    ).select_related('strain', 'requester__user').with_refreeze_flag()
+    requesting_users = profile_models.UserProfile.objects.filter(
+        freeze_requests__status__in=['R', 'A']
+    ).select_related('user').distinct()
     requesting_users_initials = [user_profile.initials for user_profile in requesting_users]
 
     # Table using django-tables2
@@ -538,64 +637,73 @@ def outstanding_freeze_requests(request):
             messages.warning(request, 'No freeze requests to process!')
             return redirect('outstanding_freeze_requests')
 
-        selected_reqeust_ids_str = '&'.join([f"{request.id:>05d}" for request in selected_requests])
+        selection_token = save_selection(request.session, 'freeze_request',
+                                         selected_requests.values_list('pk', flat=True))
 
         # Redirect to the new page with selected FreezeRequests
         return redirect('freeze_request_change_confirmation',
                         action=option,
-                        freeze_request_ids=selected_reqeust_ids_str)
+                        selection_token=selection_token)
 
     return render(request, 'freezes_and_thaws/outstanding_freeze_requests.html',
                   {'table': table, 'requesting_users': requesting_users})
 
 
-def freeze_request_change_confirmation(request, freeze_request_ids, action='NoAction', *args, **kwargs):
+def freeze_request_change_confirmation(request, selection_token, action='NoAction', *args, **kwargs):
     if action not in ['cancel', 'advance']:
         messages.warning(request, f'Invalid action! You provided {action}.')
         return redirect('outstanding_freeze_requests')
 
-    freeze_requests = nema_models.FreezeRequest.objects.filter(pk__in=freeze_request_ids.split('&'))
+    freeze_request_pks = load_selection(request.session, 'freeze_request', selection_token)
+    if freeze_request_pks is None:
+        messages.warning(request, 'That selection of freeze requests has expired, please select them again.')
+        return redirect('outstanding_freeze_requests')
+    # Only the ones that can still be cancelled/advanced, requests with freeze groups never get deleted from here:
+    freeze_requests = nema_models.FreezeRequest.objects.filter(
+        pk__in=freeze_request_pks, status__in=['R', 'A'] if action == 'cancel' else ['R'],
+    ).select_related('strain', 'requester__user').order_by('pk')
 
     if request.method == 'POST':
-        if action == 'cancel':
-            for freeze_request in freeze_requests:
-                freeze_request.status = 'X'
-                freeze_request.save()
-                freeze_str = freeze_request.__str__()
-                freeze_request.delete()
-                messages.success(request, mark_safe(f'Deleted thaw request:<br><strong>{freeze_str}</strong>'))
-            return redirect('outstanding_thaw_requests')
-        if action == 'advance':
-            for freeze_request in freeze_requests:
-                freeze_request.status = 'A'
-                freeze_request.save()
-                messages.success(request, f'Freeze request {freeze_request} advanced successfully!')
-            return redirect('ongoing_freezes')
-        else:
-            messages.warning(request, f'Invalid action! You provided {action}.')
-            return redirect('outstanding_freeze_requests')
+        # Everything is done with a couple of bulk queries, however many requests there are:
+        with immediate_atomic():
+            if action == 'cancel':
+                cancelled = bulk_delete_with_audit(freeze_requests, actor=request.user, status='X')
+                messages.success(request, f'Cancelled {len(cancelled)} freeze request{pluralize(len(cancelled))}.')
+            else:
+                advanced = bulk_update_with_audit(freeze_requests, actor=request.user, status='A')
+                messages.success(request, f'Advanced {len(advanced)} freeze request{pluralize(len(advanced))}.')
+        discard_selection(request.session, selection_token)
+        return redirect('outstanding_freeze_requests' if action == 'cancel' else 'ongoing_freezes')
 
     return render(request, 'freezes_and_thaws/freeze_request_change_confirmation.html',
-                  {'freeze_request_ids': freeze_request_ids,
+                  {'selection_token': selection_token,
                    'freeze_requests': freeze_requests,
                    'action': action})
 
 
 def ongoing_freezes(request):
-    ongoing_freeze_set = nema_models.FreezeRequest.objects.filter(status='A')
+    ongoing_freeze_set = nema_models.FreezeRequest.objects.filter(status='A').select_related('strain', 'requester')
 
     AdvFreezeFormSet = modelformset_factory(
         nema_models.FreezeRequest,
         form=nema_forms.AdvancingFreezeRequestForm,
+        formset=nema_forms.AdvancingFreezeRequestFormSet,
         extra=0
     )
 
     if request.method == 'POST':
-        formset = AdvFreezeFormSet(request.POST, queryset=ongoing_freeze_set)
+        formset = AdvFreezeFormSet(request.POST, queryset=ongoing_freeze_set, form_kwargs={'actor': request.user})
         if formset.is_valid():
-            formset.save()
-            messages.success(request, "Successfully updated freeze requests.")
-            return redirect('ongoing_freezes')
+            try:
+                # Takes the write lock up front, so concurrent submissions wait their turn instead of failing:
+                with immediate_atomic():
+                    formset.save()
+            except ValidationError as error:
+                # A box filled up after the page was loaded (see reserve_box_slots)
+                messages.warning(request, f"Nothing was saved: {' '.join(error.messages)}")
+            else:
+                messages.success(request, "Successfully updated freeze requests.")
+                return redirect('ongoing_freezes')
         else:
             for form in formset:
                 if form.errors:
@@ -606,10 +714,10 @@ def ongoing_freezes(request):
 
         for form in formset:
             # Set initial 'tester' to current user if not already set
-            if not form.instance.tester:
+            if not form.instance.tester_id:
                 form.initial['tester'] = request.user.userprofile
             # Set initial 'freezer' to requester if not already set
-            if not form.instance.freezer:
+            if not form.instance.freezer_id:
                 form.initial['freezer'] = form.instance.requester
 
             # Set other initial data if necessary
@@ -649,20 +757,13 @@ def func_tester_page(request):
 
 
 def scary_stuff(request):
-    failed_freeze_strains = nema_models.Strain.objects.filter(freeze_groups__passed_test=False).distinct()
-    strains_with_most_recent_failures = []
-    for strain in failed_freeze_strains:
-        most_recent_freeze = strain.freeze_groups.order_by('-date_created').first()
-        if most_recent_freeze.passed_test:
-            continue
-        strains_with_most_recent_failures.append(most_recent_freeze.strain)
-    print(f"Finished collecting strains with failed freeze groups, there are {len(strains_with_most_recent_failures)}.")
-    
-    strains_without_freezes = nema_models.Strain.objects.exclude(freeze_groups__isnull=False)
-    print(f"Finished collecting strains without freeze groups, there are {len(strains_without_freezes)}.")
+    # The report is kept up to date as freezes and tubes change (see StrainRiskReport), so this is a single query:
+    reports = list(nema_models.StrainRiskReport.objects.select_related('strain').order_by('strain__wja'))
     return render(request, 'basic_navigation/scary_stuff.html',
-                    {'strains_with_fails': strains_with_most_recent_failures,
-                     'strains_without_freezes': strains_without_freezes})
+                  {'strains_without_freezes': [report.strain for report in reports if report.no_freezes],
+                   'strains_with_fails': [report.strain for report in reports if report.latest_freeze_failed],
+                   'low_tube_reports': [report for report in reports if report.low_tubes and not report.no_freezes],
+                   'tube_remaining_threshold': TUBE_REMAINING_THRESHOLD})
     
     
 
@@ -21,10 +21,14 @@ from datetime import timedelta as dt_delta
 from tqdm import tqdm
 
 import bisect
+import argparse
+import time
+from contextlib import contextmanager
 
 import os
 import sys
 OLD_DB_NAME = "240821_OFFICIAL_WORMSTOCKS.json"
+DEFAULT_BATCH_SIZE = 500  # Rows per INSERT for the bulk_create steps
 
 
 SCRIPT_DIR = os.path.dirname(__file__)
@@ -41,6 +45,10 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, Group, Permission
 import ArribereNemaStocks.models as nema_models
 import profiles.models as profile_models
+from ArribereNemaStocks.bulk_history import bulk_create_with_audit
+from ArribereNemaStocks.import_lookups import ImportLookups
+from ArribereNemaStocks.pagination import bump_strain_count_version
+from ArribereNemaStocks.slots import assign_missing_positions
 from hardcoded import CAP_COLOR_OPTIONS, USER_INITIALS_DICT
 
 import environ
@@ -234,6 +242,7 @@ class SimpleFreeze:
         self.tester_comments = tester_comments
         self.test_check_date = test_check_date
         self.stored = stored
+        self.nema_freeze_group = None  # Set by create_freezes once this is saved
 
     def to_dict(self):
         return {'date_created': self.date_created,
@@ -249,25 +258,22 @@ class SimpleFreeze:
                 'stored': self.stored,
                 }
 
-    def to_nemaFreezeGroup(self) -> nema_models.FreezeGroup:
-        nema_strain = self.simple_strain.get_nemaStrain()
-        try:
-            nema_freeze = nema_models.FreezeGroup.objects.get_or_create(
-                date_created=self.date_created,
-                date_stored=self.date_stored,
-                strain=nema_strain,
-                freezer=self.freezer,
-                started_test=self.started_test,
-                completed_test=self.completed_test,
-                passed_test=self.passed_test,
-                tester=self.tester,
-                tester_comments=self.tester_comments,
-                test_check_date=self.test_check_date,
-                stored=self.stored)
-        except Exception as e:
-            ic(self)
-            raise e
-        return nema_freeze
+    def to_nemaFreezeGroup(self, nema_strain: nema_models.Strain) -> nema_models.FreezeGroup:
+        """
+        Returns an unsaved FreezeGroup (these get saved in bulk by create_freezes).
+        """
+        return nema_models.FreezeGroup(
+            date_created=self.date_created,
+            date_stored=self.date_stored,
+            strain=nema_strain,
+            freezer=self.freezer,
+            started_test=self.started_test,
+            completed_test=self.completed_test,
+            passed_test=self.passed_test,
+            tester=self.tester,
+            tester_comments=self.tester_comments,
+            test_check_date=self.test_check_date,
+            stored=self.stored)
 
     def get_nemaFreezeGroup(self) -> nema_models.FreezeGroup:
         try:
@@ -316,24 +322,21 @@ class SimpleTube:
                 'thaw_requester': self.thaw_requester,
                 }
 
-    def to_nemaTube(self) -> nema_models.Tube:
-        nema_strain = self.simple_strain.get_nemaStrain()
-        nema_freeze_group = self.simple_freeze_group.get_nemaFreezeGroup()
-        try:
-            nema_tube = nema_models.Tube.objects.get_or_create(
-                cap_color=self.cap_color,
-                date_created=self.date_created,
-                date_thawed=self.date_thawed,
-                box=self.box,
-                strain=nema_strain,
-                freeze_group=nema_freeze_group,
-                thawed=self.thawed,
-                thaw_requester=self.thaw_requester,
-                set_number=self.set_number)
-        except Exception as e:
-            ic(self)
-            raise e
-        return nema_tube
+    def to_nemaTube(self, nema_strain: nema_models.Strain,
+                    nema_freeze_group: nema_models.FreezeGroup) -> nema_models.Tube:
+        """
+        Returns an unsaved Tube (these get saved in bulk by create_tubes).
+        """
+        return nema_models.Tube(
+            cap_color=self.cap_color,
+            date_created=self.date_created,
+            date_thawed=self.date_thawed,
+            box=self.box,
+            strain=nema_strain,
+            freeze_group=nema_freeze_group,
+            thawed=self.thawed,
+            thaw_requester=self.thaw_requester,
+            set_number=self.set_number)
 
     def get_nemaTube(self) -> nema_models.Tube:
         return nema_models.Tube.objects.get(strain=self.simple_strain.get_nemaStrain(),
@@ -591,7 +594,10 @@ class OldStrainEntry:
                 freeze_dicts['general']['test_date'] = matches[freeze_date]
         return freeze_nest_dict
 
-    def to_simple_freeze_and_tube_list(self) -> Tuple[List[SimpleFreeze], List[SimpleTube]] | None:
+    def to_simple_freeze_and_tube_list(self, lookups: ImportLookups = None
+                                       ) -> Tuple[List[SimpleFreeze], List[SimpleTube]] | None:
+        # Pass in a shared ImportLookups when calling this for lots of entries!
+        lookups = lookups or ImportLookups()
         # date_created: date,
         # date_stored: date,
         # strain: nema_models.Strain,
@@ -674,12 +680,12 @@ class OldStrainEntry:
                 test_date = freeze_dicts['general']['test_date']
                 tester = freeze_dicts['general']['tester']
                 try:
-                    tester_profile = profile_models.UserProfile.objects.get(initials=tester)
+                    tester_profile = lookups.get_user_profile(tester)
                 except profile_models.UserProfile.DoesNotExist as e:
                     ic(freeze_dicts['general']['tester'])
                     raise e
             try:
-                unknown_freezer = profile_models.UserProfile.objects.get(initials='XXX')
+                unknown_freezer = lookups.get_user_profile('XXX')
             except profile_models.UserProfile.DoesNotExist as e:
                 ic(freeze_dicts['general']['tester'])
                 raise e
@@ -701,7 +707,7 @@ class OldStrainEntry:
                 if key == 'general':
                     continue
                 for tube_count in range(int(tube_set_dict['tube_no'])):
-                    box = nema_models.Box.objects.get(
+                    box = lookups.get_box(
                         dewar=tube_set_dict['tank_no'][-1:],
                         rack=tube_set_dict['rack_no'],
                         box=tube_set_dict['rack_box_no'].split("-")[-1],
@@ -931,7 +937,8 @@ class OldStrainEntry:
         elif self.wja == 'WJA ':
             pass
 
-    def parse_thaws(self):
+    def parse_thaws(self, lookups: ImportLookups = None):
+        lookups = lookups or ImportLookups()
         def _parse_no_tubes_thaw(no_tubes_thawed_item):
             pattern = r"(\d+)\((JA\s?\d+)\s{1,2}(\d+)-(\d+)\)"
             match = re.match(pattern, no_tubes_thawed_item)
@@ -982,7 +989,7 @@ class OldStrainEntry:
         for i, ((dewar, rack, box), thaw_list) in enumerate(thaws_dict.items()):
             # First lets find the right box:
             try:
-                box = nema_models.Box.objects.get(
+                box = lookups.get_box(
                     dewar=dewar,
                     rack=rack,
                     box=box,
@@ -996,7 +1003,7 @@ class OldStrainEntry:
             for thaw_dict, tube in zip(thaw_list, box_tubes):
                 # Get user:
                 try:
-                    user = profile_models.UserInitials.objects.get(initials=thaw_dict['user_initials']).user_profile
+                    user = lookups.get_user_profile_by_alias(thaw_dict['user_initials'])
                 except profile_models.UserInitials.DoesNotExist:
                     ic(thaw_dict['user_initials'], self)
                     self.pprint_lists()
@@ -1115,21 +1122,59 @@ def create_boxes(delete_old=True):
     ic("New boxes created.", len(boxes_to_create))
 
 
+# These are the fields the old get_or_create calls matched on, so we still skip duplicates the same way:
+STRAIN_KEY_FIELDS = ('wja',)
+FREEZE_GROUP_KEY_FIELDS = ('date_created', 'date_stored', 'strain_id', 'freezer_id', 'started_test',
+                           'completed_test', 'passed_test', 'tester_id', 'tester_comments',
+                           'test_check_date', 'stored')
+TUBE_KEY_FIELDS = ('cap_color', 'date_created', 'date_thawed', 'box_id', 'strain_id', 'freeze_group_id',
+                   'thawed', 'thaw_requester_id', 'set_number')
+
+
+@contextmanager
+def timed_stage(stage_name):
+    start_time = time.perf_counter()
+    yield
+    elapsed_seconds = round(time.perf_counter() - start_time, 2)
+    ic(stage_name, elapsed_seconds)
+
+
+def bulk_get_or_create(model, unsaved_objects, key_fields, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    The bulk version of get_or_create. Anything that matches (on key_fields) an object already in the
+    database, or one earlier in the list, is reused. Everything else is saved with bulk_create in
+    batches, along with its simple_history and auditlog rows (bulk_create doesn't send the signals for those).
+    :return: The saved objects, in the same order as unsaved_objects.
+    """
+    def get_key(obj):
+        return tuple(getattr(obj, field) for field in key_fields)
+    
+    known_objects = {get_key(obj): obj for obj in model.objects.all()}
+    objects_to_create = []
+    for obj in unsaved_objects:
+        if get_key(obj) not in known_objects:
+            known_objects[get_key(obj)] = obj
+            objects_to_create.append(obj)
+    bulk_create_with_audit(objects_to_create, batch_size=batch_size)
+    ic("New objects created.", model.__name__, len(objects_to_create))
+    return [known_objects[get_key(obj)] for obj in unsaved_objects]
+
+
 @transaction.atomic
-def make_strains_from_simple_strains(strains_dict, delete_old=True):
+def make_strains_from_simple_strains(strains_dict, delete_old=True, batch_size=DEFAULT_BATCH_SIZE):
     if delete_old:
         nema_models.Strain.objects.all().delete()
+    nema_strains = []
     for wja, simple_strain in strains_dict.items():
-        strain_dict = simple_strain.to_dict()
-        try:
-            db_strain = nema_models.Strain.objects.create(**strain_dict)
-        except django.db.utils.IntegrityError:
-            db_strain = nema_models.Strain.objects.get(wja=wja)
-        # ic(db_strain)
+        nema_strain = simple_strain.to_nemaStrain()
+        nema_strain.formatted_wja = f"WJA{nema_strain.wja:04d}"  # Strain.save() usually does this
+        nema_strains.append(nema_strain)
+    bulk_get_or_create(nema_models.Strain, nema_strains, STRAIN_KEY_FIELDS, batch_size=batch_size)
+    bump_strain_count_version()
     ic(nema_models.Strain.objects.all().count())
 
 
-def create_strains(old_db_entries, delete_old=True):
+def create_strains(old_db_entries, delete_old=True, batch_size=DEFAULT_BATCH_SIZE):
     new_strain_dict = {}
     
     iterator = tqdm(enumerate(old_db_entries), total=len(old_db_entries),
@@ -1139,7 +1184,7 @@ def create_strains(old_db_entries, delete_old=True):
         new_strain = entry.to_simple_strain()
         new_strain_dict[entry.wja] = new_strain
 
-    make_strains_from_simple_strains(new_strain_dict)
+    make_strains_from_simple_strains(new_strain_dict, delete_old=delete_old, batch_size=batch_size)
 
 
 def build_simple_user_list(input_dict, ) -> List[SimpleUserProfile]:
@@ -1171,45 +1216,54 @@ def get_thaw_requester_initials(_old_strain_entries):
 
 
 @transaction.atomic
-def create_freezes(super_freeze_list, delete_old=False):
+def create_freezes(super_freeze_list, delete_old=False, batch_size=DEFAULT_BATCH_SIZE):
     if delete_old:
         nema_models.FreezeGroup.objects.all().delete()
         ic("Old freezes deleted.")
     
-    nema_freezes = []
+    strains_by_wja = nema_models.Strain.objects.in_bulk(field_name='wja')
+    unsaved_freezes = []
     iterator = tqdm(super_freeze_list, total=len(super_freeze_list),
                     desc="Building database freeze list")
     for freeze in iterator:
-        nema_freeze = freeze.to_nemaFreezeGroup()
-        nema_freezes.append(nema_freeze)
+        unsaved_freezes.append(freeze.to_nemaFreezeGroup(strains_by_wja[freeze.simple_strain.wja]))
+    nema_freezes = bulk_get_or_create(nema_models.FreezeGroup, unsaved_freezes, FREEZE_GROUP_KEY_FIELDS,
+                                      batch_size=batch_size)
+    # Keep track of the saved freeze group on each SimpleFreeze, so the tubes can be wired up without a query:
+    for freeze, nema_freeze in zip(super_freeze_list, nema_freezes):
+        freeze.nema_freeze_group = nema_freeze
     ic("Freeze Groups Done!")
     return nema_freezes
 
 
 @transaction.atomic
-def create_tubes(super_tube_list, delete_old=False):
+def create_tubes(super_tube_list, delete_old=False, batch_size=DEFAULT_BATCH_SIZE):
     if delete_old:
         nema_models.Tube.objects.all().delete()
         ic("Old tubes deleted.")
     
-    nema_tubes = []
+    strains_by_wja = nema_models.Strain.objects.in_bulk(field_name='wja')
+    unsaved_tubes = []
     iterator = tqdm(super_tube_list, total=len(super_tube_list),
                     desc="Building database tube list")
     for tube in iterator:
-        nema_tube = tube.to_nemaTube()
-        nema_tubes.append(nema_tube)
+        unsaved_tubes.append(tube.to_nemaTube(strains_by_wja[tube.simple_strain.wja],
+                                              tube.simple_freeze_group.nema_freeze_group))
+    # The Tube bulk_create recounts the strain/freeze group/box tube counters once all the batches are in:
+    nema_tubes = bulk_get_or_create(nema_models.Tube, unsaved_tubes, TUBE_KEY_FIELDS, batch_size=batch_size)
     ic("Tubes Done!")
     return nema_tubes
 
 
-def create_freezes_and_tubes(_old_strain_entries, delete_old=True):
+def create_freezes_and_tubes(_old_strain_entries, delete_old=True, batch_size=DEFAULT_BATCH_SIZE):
     super_tube_list = []
     super_freeze_list = []
+    lookups = ImportLookups()  # Boxes and users are loaded once here, instead of once per tube/freeze
     
     iterator = tqdm(enumerate(_old_strain_entries), total=len(_old_strain_entries),
                     desc="Building database freeze and tube list")
     for i, entry in iterator:
-        results = entry.to_simple_freeze_and_tube_list()
+        results = entry.to_simple_freeze_and_tube_list(lookups)
         if results is None:
             # ic(entry.wja, "No results")
             continue
@@ -1220,8 +1274,10 @@ def create_freezes_and_tubes(_old_strain_entries, delete_old=True):
         if freezes is not None:
             super_freeze_list.extend(freezes)
             super_tube_list.extend(tubes)
-    create_freezes(super_freeze_list, delete_old=delete_old)
-    create_tubes(super_tube_list, delete_old=delete_old)
+    with timed_stage("Creating freeze groups"):
+        create_freezes(super_freeze_list, delete_old=delete_old, batch_size=batch_size)
+    with timed_stage("Creating tubes"):
+        create_tubes(super_tube_list, delete_old=delete_old, batch_size=batch_size)
 
 
 def create_users(user_initials_dict, delete_old=False, open_registration=True):
@@ -1259,10 +1315,11 @@ def thaw_used_tubes(_old_strain_entries: List[OldStrainEntry], reset_all=False):
                                               )
         ic("All tubes reset to unthawed")
     
+    lookups = ImportLookups()
     iterator = tqdm(_old_strain_entries, total=len(_old_strain_entries),
                     desc="Thawing used tubes")
     for old_strain in iterator:
-        old_strain.parse_thaws()
+        old_strain.parse_thaws(lookups)
 
 
 def create_groups(delete_old=True):
@@ -1318,33 +1375,54 @@ def create_groups(delete_old=True):
 
 if __name__ == '__main__':
     # Ideally we should be able to run this from a brand-new database and have it build everything!!
+    arg_parser = argparse.ArgumentParser(description="Rebuild the database from the old JSON database.")
+    arg_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help=f"Number of rows per bulk insert (default: {DEFAULT_BATCH_SIZE})")
+    args = arg_parser.parse_args()
 
     # This is the actual load step. The OldStrainEntry class does all the parsing and cleaning
     
-    json_db = load_old_db()
-    iterator = tqdm(json_db, total=len(json_db),
-                    desc="Parsing JSON database")
-    old_strain_entries = []
-    for entry in iterator:
-        old_strain_entries.append(OldStrainEntry(entry))
+    with timed_stage("Parsing JSON database"):
+        json_db = load_old_db()
+        iterator = tqdm(json_db, total=len(json_db),
+                        desc="Parsing JSON database")
+        old_strain_entries = []
+        for entry in iterator:
+            old_strain_entries.append(OldStrainEntry(entry))
 
     # Each of the following steps should be skip-able for databases that are already built:
 
-    create_users(USER_INITIALS_DICT,
-                 delete_old=True)
+    with timed_stage("Creating users"):
+        create_users(USER_INITIALS_DICT,
+                     delete_old=True)
+
+    with timed_stage("Creating groups"):
+        create_groups()
+
+    with timed_stage("Creating boxes"):
+        create_boxes(delete_old=True)
 
-    create_groups()
+    with timed_stage("Creating strains"):
+        create_strains(old_strain_entries,
+                       delete_old=True,
+                       batch_size=args.batch_size)
 
-    create_boxes(delete_old=True)
+    with timed_stage("Creating freezes and tubes"):
+        create_freezes_and_tubes(old_strain_entries,
+                                 delete_old=True,
+                                 batch_size=args.batch_size)
 
-    create_strains(old_strain_entries,
-                   delete_old=True)
+    with timed_stage("Thawing used tubes"):
+        thaw_used_tubes(old_strain_entries,
+                        reset_all=True)
 
-    create_freezes_and_tubes(old_strain_entries,
-                             delete_old=True)
+    with timed_stage("Assigning tube positions"):
+        # The old database doesn't know where in the boxes the tubes are, so just fill each box in order:
+        assign_missing_positions()
 
-    thaw_used_tubes(old_strain_entries,
-                    reset_all=True)
+    with timed_stage("Refreshing the scary stuff report"):
+        # The bulk inserts above skip the signals that usually keep this up to date:
+        nema_models.StrainRiskReport.refresh()
 
     set_default_permission_flags(open_reg=True,
                                  edit_any_strain=True,
@@ -27,7 +27,6 @@ STATICFILES_DIRS = [str(BASE_DIR / 'static')]
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
-
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -48,6 +47,12 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        # Per-request query counts and timings from ArribereNemaStocks.middleware.QueryBudgetMiddleware:
+        'ArribereNemaStocks.performance': {
+            'handlers': ['file'],
+            'level': env('PERFORMANCE_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
     },
 }
 
@@ -59,7 +64,12 @@ LOGGING = {
 SECRET_KEY = env('DJANGO_SECRET_KEY')  # Changed by Marcus, 1/29/2024
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = env('DEBUG', default=False)  # Changed by Marcus, 2/6/2024
+DEBUG = env.bool('DEBUG', default=False)  # Changed by Marcus, 2/6/2024
+
+# Raise an error (instead of just logging a warning) when a view goes over its query budget in
+# hardcoded.QUERY_BUDGETS, and send the Server-Timing header. On while debugging unless
+# QUERY_BUDGET_STRICT is set in the .env file (the query-count tests turn it on for themselves):
+QUERY_BUDGET_STRICT = env.bool('QUERY_BUDGET_STRICT', default=DEBUG)
 
 ALLOWED_HOSTS = ['arriberelab.pbsci.ucsc.edu', '128.114.144.55', '0.0.0.0', '128.114.0.0/16', '169.233.0.0/16']  # Modified by Eric Shell, 2/5/2024
 
@@ -85,6 +95,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'ArribereNemaStocks.middleware.QueryBudgetMiddleware',  # Query counts/timings, see hardcoded.QUERY_BUDGETS
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -109,6 +120,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'ArribereNemaStocks.context_processors.site_settings',
             ],
         },
     },
@@ -120,12 +132,27 @@ WSGI_APPLICATION = 'djangoNemaStocks.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Opt-in production profile for running several gunicorn workers on the one SQLite file: WAL mode,
+# connection PRAGMAs and BEGIN IMMEDIATE transactions (see ArribereNemaStocks/sqlite_backend/base.py).
+SQLITE_PRODUCTION_PROFILE = env.bool('SQLITE_PRODUCTION_PROFILE', default=False)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+if SQLITE_PRODUCTION_PROFILE:
+    DATABASES['default'].update({
+        'ENGINE': 'ArribereNemaStocks.sqlite_backend',
+        'OPTIONS': {
+            'timeout': 20,  # seconds, for sqlite3.connect()
+            'transaction_mode': 'IMMEDIATE',
+            'pragmas': {
+                'busy_timeout': 20000,
+            },
+        },
+    })
 
 
 # Password validation
@@ -174,6 +201,11 @@ DJANGO_TABLES2_TABLE_ATTRS = {
 
 # Added my Marcus on 10/18/2024 to get better transaction tracking!
 AUDITLOG_INCLUDE_ALL_MODELS = True
+# The email outbox is just a delivery queue, so there is no need to audit every retry, the
+# scary stuff report is rebuilt from the freezes and tubes (which are audited themselves), and
+# staged bulk uploads are scratch space until they're saved as strains (which are audited):
+AUDITLOG_EXCLUDE_TRACKING_MODELS = ('ArribereNemaStocks.outboxemail', 'ArribereNemaStocks.strainriskreport',
+                                    'ArribereNemaStocks.strainuploadbatch', 'ArribereNemaStocks.stagedstrain')
 
 
 # Added by Marcus based on: https://docs.djangoproject.com/en/3.1/topics/auth/default/#the-login-required-decorator
@@ -187,4 +219,6 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'arriberenemastocks@gmail.com'  # replace with your email
 EMAIL_HOST_PASSWORD = env('EMAIL_PASS')  # replace with your password
 DEFAULT_FROM_EMAIL = 'NemaStocks <arriberenemastocks@gmail.com>'
+# Notification emails are queued in the database (ArribereNemaStocks.OutboxEmail) and actually
+# sent by a separate worker process: python manage.py send_queued_emails --loop
 
@@ -47,12 +47,13 @@ urlpatterns = [
     path('strain_assignments/', nema_views.strain_assignments, name='strain_assignments'),
     # path('strain_list/', nema_views.strain_list, name='strain_list'),
     path('strain_list_datatable/', nema_views.strain_list_datatable, name='strain_list_datatable'),
+    path('export/<str:kind>/', nema_views.export_table, name='export_table'),
     path('new_strain/', nema_views.new_strain, name='new_strain'),
     path('edit_strain/<int:wja>/', nema_views.edit_strain, name='edit_strain'),
     path('strain_details/<int:wja>/', nema_views.strain_details, name='strain_details'),
     # BULK:
     path('bulk_upload_strains/', nema_views.bulk_upload_strains, name='bulk_upload_strains'),
-    path('bulk_confirm_strains/', nema_views.bulk_confirm_strains, name='bulk_confirm_strains'),
+    path('bulk_confirm_strains/<int:batch_id>/', nema_views.bulk_confirm_strains, name='bulk_confirm_strains'),
     # Make Requests:
     path('freeze_request_form/', nema_views.freeze_request_form, name='freeze_request_form'),
     path('freeze_request_form/confirmation/', nema_views.freeze_request_confirmation, name='freeze_request_confirmation'),
@@ -62,9 +63,9 @@ urlpatterns = [
     path('outstanding_freeze_requests/', nema_views.outstanding_freeze_requests, name='outstanding_freeze_requests'),
     path('ongoing_freezes/', nema_views.ongoing_freezes, name='ongoing_freezes'),
     path('ongoing_thaws/', nema_views.ongoing_thaws, name='ongoing_thaws'),
-    path('freeze_request_change_confirmation/action=<str:action>/requests=<str:freeze_request_ids>/',
+    path('freeze_request_change_confirmation/action=<str:action>/selection=<str:selection_token>/',
          nema_views.freeze_request_change_confirmation, name='freeze_request_change_confirmation'),
-    path('thaw_request_change_confirmation/action=<str:action>/requests=<str:thaw_request_ids>/',
+    path('thaw_request_change_confirmation/action=<str:action>/selection=<str:selection_token>/',
          nema_views.thaw_request_change_confirmation, name='thaw_request_change_confirmation'),
     path('outstanding_thaw_requests/', nema_views.outstanding_thaw_requests, name='outstanding_thaw_requests'),
     # Testing Functionality pages:
@@ -9,9 +9,57 @@ Editing them here should be the only place you need to change them.
 # Number of tubes remaining before sending refreeze email:
 TUBE_REMAINING_THRESHOLD = 2
 
+# Tube slots in each freezer box (a 9x9 grid):
+TUBES_PER_BOX = 81
+
 # Email all CZARs:
 EMAIL_ALL_CZARS = False
 
+# Queued (outbox) emails are retried this many times before being marked as dead,
+# waiting EMAIL_RETRY_BASE_DELAY * 2^(attempts - 1) seconds between tries:
+EMAIL_MAX_SEND_ATTEMPTS = 5
+EMAIL_RETRY_BASE_DELAY = 60
+
+# How many request selections (see selections.py) each user's session keeps around at once:
+MAX_SAVED_SELECTIONS = 10
+
+# How many rows the CSV/TSV exports fetch from the database at a time (see exports.py):
+EXPORT_CHUNK_SIZE = 2000
+
+# How many pasted lines the bulk strain upload review shows (and lets you fix) per page (see strain_staging.py):
+STAGED_STRAINS_PER_PAGE = 50
+
+# The most SQL queries each view (by URL name) should need. Going over logs a warning, or errors out
+# on page loads while debugging (see QueryBudgetMiddleware). Views not listed here aren't checked:
+QUERY_BUDGETS = {
+    'index': 10,
+    'strain_list_datatable': 10,
+    'strain_details': 25,
+    'new_strain': 10,
+    'edit_strain': 15,
+    'strain_assignments': 10,
+    # (bulk_upload_strains and bulk_confirm_strains aren't listed: their bulk_create/bulk_update batches grow
+    # with the length of the paste, which can be thousands of lines. Their WJA checks don't, see strain_staging.py)
+    'freeze_request_form': 50,
+    'thaw_request_form': 50,
+    'ongoing_freezes': 15,
+    'ongoing_thaws': 15,
+    'outstanding_freeze_requests': 20,
+    'outstanding_thaw_requests': 20,
+    'freeze_request_change_confirmation': 20,
+    'thaw_request_change_confirmation': 20,
+    'scary_stuff': 5,
+    'user_page': 15,
+    'admin:ArribereNemaStocks_strain_changelist': 10,
+    'admin:ArribereNemaStocks_box_changelist': 15,
+    'admin:ArribereNemaStocks_tube_changelist': 25,  # The (un)thaw actions post here too, and recount the tubes
+    'admin:ArribereNemaStocks_freezegroup_changelist': 10,
+    'admin:ArribereNemaStocks_freezerequest_changelist': 10,
+    'admin:ArribereNemaStocks_thawrequest_changelist': 10,
+    'admin:profiles_userprofile_changelist': 10,
+    'admin:profiles_strainrange_changelist': 10,
+}
+
 # Cap colors as options for the FreezeRequestForm:
 CAP_COLOR_OPTIONS = (
     ('', '---------'),
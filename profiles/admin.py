@@ -14,10 +14,22 @@ admin.site.register(OpenRegistration)
 register_history(Group)
 
 
+class UserProfileListFilter(admin.RelatedFieldListFilter):
+    """
+    The usual filter for a UserProfile foreign key, but it loads the users along with the profiles
+    (their names are in the choices) instead of with a query per profile.
+    """
+    def field_choices(self, field, request, model_admin):
+        ordering = self.field_admin_ordering(field, request, model_admin)
+        return [(user_profile.pk, str(user_profile))
+                for user_profile in UserProfile.objects.select_related('user').order_by(*ordering)]
+
+
 @admin.register(StrainRange)
 class StrainRangeAdmin(admin.ModelAdmin):
     list_display = ('user_profile', 'strain_numbers_start', 'strain_numbers_end')
-    list_filter = ('user_profile', 'strain_numbers_start', 'strain_numbers_end')
+    list_select_related = ('user_profile__user',)
+    list_filter = (('user_profile', UserProfileListFilter), 'strain_numbers_start', 'strain_numbers_end')
     search_fields = ('user_profile', 'strain_numbers_start', 'strain_numbers_end')
     
     def get_readonly_fields(self, request, obj=None):
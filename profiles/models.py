@@ -1,13 +1,19 @@
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F, Func, OuterRef, Subquery
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.models import User, Group, AbstractUser
 
 from simple_history.models import HistoricalRecords
 from auditlog.models import AuditlogHistoryField
 
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.http import urlencode
+
 from hardcoded import ROLE_CHOICES
 import ArribereNemaStocks.models as nema_models
+from ArribereNemaStocks.utils import format_wja_range
 
 from typing import List, Tuple, Union
 
@@ -50,27 +56,18 @@ class UserProfile(models.Model):
         return self.__repr__()
     
     def get_all_strains(self) -> Tuple[nema_models.Strain, ...]:
-        # First we can get all the strain numbers:
-        all_strain_numbers_lists = []
-        for strain_range in self.strain_ranges.all():
-            all_strain_numbers_lists.append(list(range(strain_range.strain_numbers_start,
-                                                 strain_range.strain_numbers_end + 1)))
-        # Then we can use those strain numbers to return all the associated strains:
-        all_strain_numbers = [strain_number for strain_number_list in all_strain_numbers_lists
-                              for strain_number in strain_number_list]
-        return nema_models.Strain.objects.filter(wja__in=all_strain_numbers)
+        wja_ranges = [(strain_range.strain_numbers_start, strain_range.strain_numbers_end)
+                      for strain_range in self.strain_ranges.all()]
+        return nema_models.Strain.objects.in_wja_ranges(wja_ranges)
     
     def check_if_strain_in_any_ranges(self, strain: nema_models.Strain) -> bool:
-        for strain_range in self.strain_ranges.all():
-            if strain_range.check_if_strain_in_range(strain):
-                return True
-        return False
+        return self.check_if_wja_int_in_any_ranges(strain.wja)
     
     def check_if_wja_int_in_any_ranges(self, wja_int: int) -> bool:
-        for strain_range in self.strain_ranges.all():
-            if strain_range.check_if_wja_int_in_range(wja_int):
-                return True
-        return False
+        # This decides edit permissions, so ask the database rather than the (per-process, possibly
+        # stale) range index, which other workers only refresh every RANGE_INDEX_MAX_AGE seconds:
+        return self.strain_ranges.filter(strain_numbers_start__lte=wja_int,
+                                         strain_numbers_end__gte=wja_int).exists()
 
 
 class UserInitials(models.Model):
@@ -86,11 +83,26 @@ class UserInitials(models.Model):
         return self.__repr__()
 
 
+class StrainRangeQuerySet(models.QuerySet):
+    def with_strain_counts(self):
+        """
+        Annotates each range with `strain_count`, how many strains are in it (what get_usage_string
+        shows), with a correlated subquery instead of a COUNT query per range.
+        """
+        strains_in_range = nema_models.Strain.objects.filter(
+            wja__gte=OuterRef('strain_numbers_start'),
+            wja__lte=OuterRef('strain_numbers_end'),
+        ).order_by().annotate(count=Func(F('pk'), function='COUNT')).values('count')
+        return self.annotate(strain_count=Subquery(strains_in_range))
+
+
 class StrainRange(models.Model):
     user_profile = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='strain_ranges')
     strain_numbers_start = models.IntegerField(default=-1)
     strain_numbers_end = models.IntegerField(default=-1)
 
+    objects = StrainRangeQuerySet.as_manager()
+
     def clean(self):
         # Skip overlap check if both values are -1
         if self.strain_numbers_start == -1 and self.strain_numbers_end == -1:
@@ -116,10 +128,7 @@ class StrainRange(models.Model):
         return self.__repr__()
     
     def get_strains(self) -> Tuple[nema_models.Strain, ...]:
-        # First we can get all the strain numbers:
-        all_strain_numbers = list(range(self.strain_numbers_start, self.strain_numbers_end + 1))
-        # Then we can use those strain numbers to return all the associated strains:
-        return nema_models.Strain.objects.filter(wja__in=all_strain_numbers)
+        return nema_models.Strain.objects.in_wja_ranges([(self.strain_numbers_start, self.strain_numbers_end)])
     
     def check_if_strain_in_range(self, strain: nema_models.Strain) -> bool:
         return self.strain_numbers_start <= strain.wja <= self.strain_numbers_end
@@ -128,8 +137,9 @@ class StrainRange(models.Model):
         return self.strain_numbers_start <= wja_int <= self.strain_numbers_end
     
     def get_usage_string(self) -> str:
-        strains = self.get_strains()
-        num_strains = len(strains)
+        num_strains = getattr(self, 'strain_count', None)  # From StrainRangeQuerySet.with_strain_counts()
+        if num_strains is None:
+            num_strains = self.get_strains().count()
         potential_num_strains = self.strain_numbers_end - self.strain_numbers_start+1
         return_str = (f"{num_strains} of {potential_num_strains} "
                       f"assigned WJA{'s' if potential_num_strains > 1 else ''} used")
@@ -144,10 +154,17 @@ class StrainRange(models.Model):
                            f"({self.get_usage_string()})")
         return summary_string
     
+    def get_search_query(self) -> str:
+        return format_wja_range(self.strain_numbers_start, self.strain_numbers_end)
+    
     def get_html_summer_with_link(self, with_initials=False) -> str:
-        summary_string = ("This would be really nice to get working. The idea would be to have "
-                          "it link to the strain datatables with the strain range pre-populated "
-                          "in the search bar). In order to do this I would need to implement a "
-                          "specific ability to query in a WJA range!!")
-        raise NotImplementedError(summary_string)
-
+        """
+        Same as get_short_summary, but the WJA range links to the strain datatable
+        with the range pre-populated in the search bar.
+        """
+        search_url = f"{reverse('strain_list_datatable')}?{urlencode({'q': self.get_search_query()})}"
+        initials_string = f"{self.user_profile.initials} " if with_initials else ""
+        return format_html('{}<a href="{}">WJA{:0>4} - WJA{:0>4}</a> ({})',
+                           initials_string, search_url,
+                           self.strain_numbers_start, self.strain_numbers_end,
+                           self.get_usage_string())
@@ -0,0 +1,78 @@
+"""
+An in-memory, sorted index of every StrainRange, for answering "who owns WJA####?" without a query.
+
+StrainRanges hardly ever change but get looked up on every strain details page and upload review,
+so we load them all once, sort them by their starting WJA and use bisect to find the candidates.
+The cached index is thrown away whenever a StrainRange or UserProfile is saved or deleted
+(see signals.py), and it also expires after RANGE_INDEX_MAX_AGE seconds so that other
+gunicorn workers (which don't see our signals) pick up changes too. Edit permissions
+(UserProfile.check_if_wja_int_in_any_ranges) don't use it, since they can't wait that long.
+"""
+import bisect
+import time
+from typing import Dict, Iterable, List, Optional
+
+RANGE_INDEX_MAX_AGE = 5 * 60  # seconds
+
+_cached_index = None
+_cached_index_time = 0.0
+
+
+class StrainRangeIndex:
+    def __init__(self, strain_ranges: Iterable):
+        # Ties on the start are kept in primary key order, so the "first" owner matches
+        # what looping over StrainRange.objects.all() used to give us.
+        self.ranges = sorted(strain_ranges, key=lambda strain_range: (strain_range.strain_numbers_start,
+                                                                      strain_range.pk))
+        self.starts = [strain_range.strain_numbers_start for strain_range in self.ranges]
+        # max_ends[i] is the furthest any of the first i+1 ranges reach, which tells us when
+        # we can stop walking backwards (ranges from different users are allowed to overlap).
+        self.max_ends = []
+        furthest_end = None
+        for strain_range in self.ranges:
+            if furthest_end is None or strain_range.strain_numbers_end > furthest_end:
+                furthest_end = strain_range.strain_numbers_end
+            self.max_ends.append(furthest_end)
+
+    def ranges_containing(self, wja: int) -> List:
+        """
+        Returns every StrainRange that includes this WJA number, in primary key order.
+        """
+        matches = []
+        index = bisect.bisect_right(self.starts, wja) - 1
+        while index >= 0 and self.max_ends[index] >= wja:
+            if self.ranges[index].strain_numbers_end >= wja:
+                matches.append(self.ranges[index])
+            index -= 1
+        return sorted(matches, key=lambda strain_range: strain_range.pk)
+
+    def owner_of(self, wja: int):
+        """
+        Returns the UserProfile that owns this WJA number (based on strain ranges), or None.
+        """
+        matches = self.ranges_containing(wja)
+        return matches[0].user_profile if matches else None
+
+    def owners_of(self, wjas: Iterable[int]) -> Dict[int, Optional[object]]:
+        """
+        The bulk version of owner_of, e.g. for a whole batch of strains: {wja: UserProfile or None}.
+        """
+        return {wja: self.owner_of(wja) for wja in set(wjas)}
+
+    def is_owned_by(self, wja: int, user_profile) -> bool:
+        return any(strain_range.user_profile_id == user_profile.pk
+                   for strain_range in self.ranges_containing(wja))
+
+
+def get_strain_range_index() -> StrainRangeIndex:
+    global _cached_index, _cached_index_time
+    if _cached_index is None or time.monotonic() - _cached_index_time > RANGE_INDEX_MAX_AGE:
+        from .models import StrainRange
+        _cached_index = StrainRangeIndex(StrainRange.objects.select_related('user_profile__user'))
+        _cached_index_time = time.monotonic()
+    return _cached_index
+
+
+def invalidate_strain_range_index():
+    global _cached_index
+    _cached_index = None
@@ -1,3 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import StrainRange, UserProfile
+from .range_index import invalidate_strain_range_index
+
+
+@receiver(post_save, sender=StrainRange)
+@receiver(post_delete, sender=StrainRange)
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def strain_ranges_changed(sender, **kwargs):
+    # The owner index holds StrainRanges (and their UserProfiles), so throw it away when either changes:
+    invalidate_strain_range_index()
+
+
 # I removed this b/c I changed the way registration works.
 
 # from django.db.models.signals import post_save
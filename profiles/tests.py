@@ -1,3 +1,100 @@
 from django.test import TestCase
+from django.contrib.auth.models import User
 
-# Create your tests here.
+import ArribereNemaStocks.models as nema_models
+from . import models as profile_models
+from .range_index import get_strain_range_index, invalidate_strain_range_index
+
+
+class TestStrainRanges(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='testuser', password='12345')
+        cls.user_profile = profile_models.UserProfile.objects.create(user=user, initials='TU')
+        cls.range_a = profile_models.StrainRange.objects.create(user_profile=cls.user_profile,
+                                                                strain_numbers_start=100,
+                                                                strain_numbers_end=5000)
+        cls.range_b = profile_models.StrainRange.objects.create(user_profile=cls.user_profile,
+                                                                strain_numbers_start=9000,
+                                                                strain_numbers_end=9010)
+        for wja in (99, 100, 4999, 5001, 9005):
+            nema_models.Strain.objects.create(wja=wja)
+
+    def test_get_strains_uses_range(self):
+        self.assertEqual(sorted(self.range_a.get_strains().values_list('wja', flat=True)), [100, 4999])
+        self.assertEqual(self.range_a.get_usage_string(), '2 of 4901 assigned WJAs used')
+
+    def test_with_strain_counts(self):
+        strain_ranges = list(profile_models.StrainRange.objects.with_strain_counts().order_by('pk'))
+        with self.assertNumQueries(0):
+            usage_strings = [strain_range.get_usage_string() for strain_range in strain_ranges]
+        self.assertEqual(usage_strings, ['2 of 4901 assigned WJAs used', '1 of 11 assigned WJAs used'])
+
+    def test_get_all_strains(self):
+        with self.assertNumQueries(2):
+            wjas = sorted(self.user_profile.get_all_strains().values_list('wja', flat=True))
+        self.assertEqual(wjas, [100, 4999, 9005])
+
+    def test_get_html_summer_with_link(self):
+        html = self.range_b.get_html_summer_with_link(with_initials=True)
+        self.assertIn('href="/strain_list_datatable/?q=WJA9000-WJA9010"', html)
+        self.assertTrue(html.startswith('TU '))
+
+
+class TestStrainRangeIndex(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        first_user = User.objects.create_user(username='firstuser', password='12345')
+        second_user = User.objects.create_user(username='seconduser', password='12345')
+        cls.first_profile = profile_models.UserProfile.objects.create(user=first_user, initials='FU')
+        cls.second_profile = profile_models.UserProfile.objects.create(user=second_user, initials='SU')
+        profile_models.StrainRange.objects.create(user_profile=cls.first_profile,
+                                                  strain_numbers_start=1, strain_numbers_end=1000)
+        # Different users are allowed to overlap, the earlier range wins:
+        profile_models.StrainRange.objects.create(user_profile=cls.second_profile,
+                                                  strain_numbers_start=500, strain_numbers_end=1500)
+        profile_models.StrainRange.objects.create(user_profile=cls.second_profile,
+                                                  strain_numbers_start=3000, strain_numbers_end=3010)
+
+    def setUp(self):
+        # The index is a process-level cache, so don't let other test classes' data leak in:
+        invalidate_strain_range_index()
+
+    def test_owner_of(self):
+        range_index = get_strain_range_index()
+        self.assertEqual(range_index.owner_of(1), self.first_profile)
+        self.assertEqual(range_index.owner_of(750), self.first_profile)
+        self.assertEqual(range_index.owner_of(1200), self.second_profile)
+        self.assertEqual(range_index.owner_of(3010), self.second_profile)
+        self.assertIsNone(range_index.owner_of(2000))
+        self.assertIsNone(range_index.owner_of(0))
+        self.assertEqual(len(range_index.ranges_containing(750)), 2)
+
+    def test_owner_lookups_are_cached(self):
+        strain = nema_models.Strain.objects.create(wja=1200)
+        strain.get_owner_from_ranges()
+        with self.assertNumQueries(0):
+            self.assertEqual(strain.get_owner_from_ranges(), self.second_profile)
+            self.assertEqual(str(strain.get_owner_from_ranges()), 'SU (Seconduser)')
+            self.assertEqual(get_strain_range_index().owners_of([1, 1200, 2000]),
+                             {1: self.first_profile, 1200: self.second_profile, 2000: None})
+
+    def test_permission_checks_ignore_a_stale_index(self):
+        strain = nema_models.Strain.objects.create(wja=1200)
+        self.assertTrue(self.second_profile.check_if_strain_in_any_ranges(strain))
+        self.assertFalse(self.first_profile.check_if_wja_int_in_any_ranges(1200))
+        self.assertEqual(get_strain_range_index().owner_of(1200), self.second_profile)
+        # A change that this process's index doesn't hear about (like one saved by another worker):
+        profile_models.StrainRange.objects.filter(strain_numbers_start=500).update(user_profile=self.first_profile)
+        self.assertEqual(get_strain_range_index().owner_of(1200), self.second_profile)  # Still the stale owner
+        self.assertFalse(self.second_profile.check_if_strain_in_any_ranges(strain))
+        self.assertTrue(self.first_profile.check_if_wja_int_in_any_ranges(1200))
+
+    def test_index_invalidated_on_change(self):
+        self.assertIsNone(get_strain_range_index().owner_of(2000))
+        new_range = profile_models.StrainRange.objects.create(user_profile=self.first_profile,
+                                                              strain_numbers_start=2000,
+                                                              strain_numbers_end=2005)
+        self.assertEqual(get_strain_range_index().owner_of(2000), self.first_profile)
+        new_range.delete()
+        self.assertIsNone(get_strain_range_index().owner_of(2000))
@@ -3,14 +3,13 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
 
-from . import models as profile_models
 from . import forms as profile_forms
+from ArribereNemaStocks.site_settings import get_site_settings
 # Create your views here.
 
 
 def register(request):
-    status = profile_models.OpenRegistration.objects.first()
-    if not status or not status.is_open:
+    if not get_site_settings().registration_is_open:
         return render(request, 'authentication/registration_closed.html')
     
     if request.method == 'POST':
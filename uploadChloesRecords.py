@@ -32,7 +32,8 @@ import django
 django.setup()
 
 import ArribereNemaStocks.models as nema_models
-import profiles.models as profile_models
+from ArribereNemaStocks.import_lookups import ImportLookups
+from ArribereNemaStocks.slots import assign_missing_positions
 
 import environ
 
@@ -100,18 +101,30 @@ def load_freezes_and_thaws():
     return freezes_df, thaws_df
 
 
+def get_strain(strains_by_wja, wja_num: int):
+    """
+    Same as Strain.objects.get(wja=...), but from a preloaded {wja: strain} dict.
+    """
+    try:
+        return strains_by_wja[wja_num]
+    except KeyError:
+        raise nema_models.Strain.DoesNotExist(f"Strain not found for WJA: {wja_num}")
+
+
 @transaction.atomic
-def make_freezes(freeze_df: pd.DataFrame, force_run: bool = False):
+def make_freezes(freeze_df: pd.DataFrame, force_run: bool = False, lookups: ImportLookups = None):
+    lookups = lookups or ImportLookups()
+    strains_by_wja = nema_models.Strain.objects.in_bulk(field_name='wja')
     for idx, row in tqdm(freeze_df.iterrows(), desc="Making Freezes and Tubes"):
         # We need to find the user who froze the tubes and the user that tested them
         # ic(f"Looking for users: {row['Who froze']} and CW")
-        user_froze = profile_models.UserProfile.objects.get(initials=row['Who froze'])
-        tester = profile_models.UserProfile.objects.get(initials="CW")
+        user_froze = lookups.get_user_profile(row['Who froze'])
+        tester = lookups.get_user_profile("CW")
 
         # ic(f"Looking for strain: {row['WJA']}")
         wja_num = int(row['WJA'])
         try:
-            strain = nema_models.Strain.objects.get(wja=wja_num)
+            strain = get_strain(strains_by_wja, wja_num)
         except nema_models.Strain.DoesNotExist:
             if force_run:
                 ic("STRAIN NOT FOUND, SKIPPING", wja_num)
@@ -141,7 +154,7 @@ def make_freezes(freeze_df: pd.DataFrame, force_run: bool = False):
         # ic(freeze_group)
         freeze_group.save()
         # Freeze the tubes for Dewar 1:
-        box1 = nema_models.Box.objects.get(dewar=row['Tank_1'][-1], rack=row['Rack_1'], box=row['Rack-Box_1'][-1])
+        box1 = lookups.get_box(dewar=row['Tank_1'][-1], rack=row['Rack_1'], box=row['Rack-Box_1'][-1])
         # ic(box1)
         for tube_index in range(row['# Tubes_1']):
             tube1 = nema_models.Tube(box=box1,
@@ -154,7 +167,7 @@ def make_freezes(freeze_df: pd.DataFrame, force_run: bool = False):
             # ic(tube1)
             tube1.save()
         # Freeze the tubes for Dewar 2:
-        box2 = nema_models.Box.objects.get(dewar=row['Tank_2'][-1], rack=row['Rack_2'], box=row['Rack-Box_2'][-1])
+        box2 = lookups.get_box(dewar=row['Tank_2'][-1], rack=row['Rack_2'], box=row['Rack-Box_2'][-1])
         # ic(box2)
         for tube_index in range(row['# Tubes_2']):
             tube2 = nema_models.Tube(box=box2,
@@ -169,14 +182,16 @@ def make_freezes(freeze_df: pd.DataFrame, force_run: bool = False):
 
 
 @transaction.atomic
-def make_thaws(thaw_df: pd.DataFrame, force_run: bool = False):
+def make_thaws(thaw_df: pd.DataFrame, force_run: bool = False, lookups: ImportLookups = None):
+    lookups = lookups or ImportLookups()
+    strains_by_wja = nema_models.Strain.objects.in_bulk(field_name='wja')
     for idx, row in tqdm(thaw_df.iterrows(), desc="Making Thaws"):
         # ic(f"Looking for user: {row['Who requested']}")
-        user_requested = profile_models.UserProfile.objects.get(initials=row['Who requested'])
+        user_requested = lookups.get_user_profile(row['Who requested'])
         # ic(f"Looking for strain: {row['WJA']}")
         wja_num = int(row['WJA'])
         try:
-            strain = nema_models.Strain.objects.get(wja=wja_num)
+            strain = get_strain(strains_by_wja, wja_num)
         except nema_models.Strain.DoesNotExist:
             if force_run:
                 ic("STRAIN NOT FOUND, SKIPPING", wja_num)
@@ -215,5 +230,9 @@ def make_thaws(thaw_df: pd.DataFrame, force_run: bool = False):
 if __name__ == '__main__':
     freezes_df, thaws_df = load_freezes_and_thaws()
     
-    make_freezes(freezes_df)
-    make_thaws(thaws_df)
+    # Boxes and users don't change during the upload, so load them once for both steps:
+    import_lookups = ImportLookups()
+    make_freezes(freezes_df, lookups=import_lookups)
+    make_thaws(thaws_df, lookups=import_lookups)
+    # Put the new (unthawed) tubes into free slots of their boxes:
+    assign_missing_positions(import_lookups.boxes.values())